@@ -0,0 +1,90 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Forward / backward time of the 3D ViT (models_vit_st_flash_attn, sdpa or naive attention) with
+# separate q, k, v projections against the fused qkv projection, on CPU by default, at the
+# resolution of the 3D fine-tuning (48 x 256 x 256, t_patch_size 3: 4096 tokens).
+
+import argparse
+import time
+
+import torch
+
+import models_vit_st_flash_attn
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark the attention of the 3D ViT', add_help=False)
+    parser.add_argument('--models', default='vit_base_patch16,vit_large_patch16', type=str, help='comma separated models of models_vit_st_flash_attn')
+    parser.add_argument('--attn_backends', default='sdpa', type=str, help='comma separated attention backends (sdpa, naive)')
+    parser.add_argument('--num_frames', default=48, type=int, help='number of frames')
+    parser.add_argument('--t_patch_size', default=3, type=int, help='temporal patch size')
+    parser.add_argument('--input_size', default=256, type=int, help='frame size')
+    parser.add_argument('--batch_size', default=1, type=int, help='batch size')
+    parser.add_argument('--repeat', default=3, type=int, help='number of timed iterations, the best one is reported')
+    parser.add_argument('--device', default='cpu', type=str, help='device')
+    parser.add_argument('--num_threads', default=0, type=int, help='torch threads, 0 keeps the default')
+    return parser
+
+
+def run(model, x, repeat, device):
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    forward_time, backward_time = float('inf'), float('inf')
+    # first iteration as warm-up
+    for _ in range(repeat + 1):
+        model.zero_grad(set_to_none=True)
+        sync()
+        start_time = time.perf_counter()
+        loss = model(x).float().sum()
+        sync()
+        forward_end = time.perf_counter()
+        loss.backward()
+        sync()
+        end_time = time.perf_counter()
+        forward_time = min(forward_time, forward_end - start_time)
+        backward_time = min(backward_time, end_time - forward_end)
+    return forward_time, backward_time
+
+
+def main(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+    x = torch.randn(args.batch_size, 1, args.num_frames, args.input_size, args.input_size, device=device)
+    print('input %s, %d threads' % (list(x.shape), torch.get_num_threads()))
+    for model_name in args.models.split(','):
+        for attn_backend in args.attn_backends.split(','):
+            results = {}
+            for fused_qkv in [False, True]:
+                torch.manual_seed(0)
+                model = models_vit_st_flash_attn.__dict__[model_name](
+                    num_frames=args.num_frames, t_patch_size=args.t_patch_size, img_size=args.input_size,
+                    num_classes=2, global_pool=True, sep_pos_embed=True, cls_embed=True,
+                    attn_backend=attn_backend, fused_qkv=fused_qkv).to(device)
+                if fused_qkv:
+                    # same weights through the state-dict hooks, the outputs must match
+                    model.load_state_dict(reference_state_dict)
+                    model.eval()
+                    reference_model.eval()
+                    with torch.no_grad():
+                        max_diff = (model(x[:1]) - reference_model(x[:1])).abs().max().item()
+                    model.train()
+                else:
+                    reference_model = model
+                    reference_state_dict = model.state_dict()
+                results[fused_qkv] = run(model, x, args.repeat, device)
+            print('%s %s: separate q/k/v fwd %.3fs bwd %.3fs | fused qkv fwd %.3fs bwd %.3fs (%.2fx fwd+bwd), max abs diff %.2e' % (
+                model_name, attn_backend, *results[False], *results[True], sum(results[False]) / sum(results[True]), max_diff))
+            del reference_model, model
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,62 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Volumes/sec of the dicom decoding of the datasets: pydicom.dcmread(...).pixel_array, as before,
+# against util.dicom_reader with 0 (serial) to N decoding threads. Run it on the dicom files of
+# the dataset, e.g., the AI-READI retinal_oct directory.
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import pydicom
+
+from util.dicom_reader import read_dicom_pixel_array
+
+home_directory = os.getenv('HOME')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark multi-frame dicom decoding', add_help=False)
+    parser.add_argument('--data_path', default=home_directory + '/AI-READI/dataset/retinal_oct/', type=str, help='directory searched for dicom files')
+    parser.add_argument('--pattern', default='**/*.dcm', type=str, help='glob pattern of the dicom files under data_path')
+    parser.add_argument('--num_files', default=32, type=int, help='number of dicom files to decode')
+    parser.add_argument('--num_threads', default='0,2,4,8', type=str, help='comma separated numbers of decoding threads')
+    parser.add_argument('--repeat', default=2, type=int, help='number of passes over the files, the best one is reported')
+    return parser
+
+
+def run(decode, paths, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for path in paths:
+            decode(path)
+        best = min(best, time.perf_counter() - start_time)
+    return len(paths) / best
+
+
+def main(args):
+    paths = sorted(glob.glob(os.path.join(args.data_path, args.pattern), recursive=True))[:args.num_files]
+    assert len(paths) > 0, 'no dicom file found in %s' % args.data_path
+    transfer_syntaxes = {str(pydicom.dcmread(path, stop_before_pixels=True).file_meta.TransferSyntaxUID.name) for path in paths}
+    print('%d files, transfer syntaxes: %s' % (len(paths), ', '.join(sorted(transfer_syntaxes))))
+
+    reference = pydicom.dcmread(paths[0]).pixel_array
+    baseline = run(lambda path: pydicom.dcmread(path).pixel_array, paths, args.repeat)
+    print('pydicom pixel_array: %.2f volumes/s' % baseline)
+    for num_threads in [int(n) for n in args.num_threads.split(',')]:
+        assert np.array_equal(read_dicom_pixel_array(paths[0], num_threads=num_threads), reference), 'decoded volume differs from pixel_array'
+        volumes_per_sec = run(lambda path: read_dicom_pixel_array(path, num_threads=num_threads), paths, args.repeat)
+        print('dicom_reader, %d threads: %.2f volumes/s (%.2fx)' % (num_threads, volumes_per_sec, volumes_per_sec / baseline))
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -32,6 +32,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 from util.focal_loss import FocalLoss2d # type: ignore
 from util.WeightedLabelSmoothingCrossEntropy import WeightedLabelSmoothingCrossEntropy # type: ignore
+from util.batch_augment import normalize_volumes
 
 def multi_label_target_to_multi_task_target(target,):
     num_classes = target.shape[1]
@@ -387,7 +388,7 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler, max_norm: float = 0,
                     mixup_fn: Optional[Mixup] = None, log_writer=None,
-                    args=None):
+                    args=None, batch_transform=None):
     model.train(True)
     metric_logger = misc.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
@@ -411,7 +412,11 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             samples, samples_high_res = samples
             samples_high_res = samples_high_res.to(device, non_blocking=True)
 
-        samples = samples.to(device, non_blocking=True)
+        if batch_transform is not None:
+            # augmentation of the collated batch on the device, see util.batch_augment
+            samples = batch_transform(samples)
+        # uint8 / float16 volumes are transferred as is and converted on the device
+        samples = normalize_volumes(samples.to(device, non_blocking=True))
         targets = targets.to(device, non_blocking=True)
 
         if args.patient_dataset_type == 'convnext_slivit':
@@ -495,7 +500,7 @@ def init_csv_writer(task, mode):
 
 
 @torch.no_grad()
-def evaluate(data_loader, model, device, task, epoch, mode, num_class, criterion=torch.nn.CrossEntropyLoss(), task_mode='binary_cls', disease_list=None, return_bal_acc=False, args=None):
+def evaluate(data_loader, model, device, task, epoch, mode, num_class, criterion=torch.nn.CrossEntropyLoss(), task_mode='binary_cls', disease_list=None, return_bal_acc=False, args=None, batch_transform=None):
 
     metric_logger = misc.MetricLogger(delimiter="  ")
     header = 'Test:'
@@ -565,7 +570,9 @@ def evaluate(data_loader, model, device, task, epoch, mode, num_class, criterion
             images, images_high_res = images
             images_high_res = images_high_res.to(device, non_blocking=True)
 
-        images = images.to(device, non_blocking=True)
+        if batch_transform is not None:
+            images = batch_transform(images)
+        images = normalize_volumes(images.to(device, non_blocking=True))
         target = target.to(device, non_blocking=True)
 
         true_label = F.one_hot(target.to(torch.int64), num_classes=num_class) if (task_mode == 'binary_cls' or task_mode == 'multi_cls') else target
@@ -123,15 +123,13 @@ def train_one_epoch_oph_new(model: torch.nn.Module,
         with torch.cuda.amp.autocast():
             loss, _, _, frame_loss = model(samples, mask_ratio=args.mask_ratio, return_frame_loss=True)
 
-        for i_batch in range(len(info[0])):
-            dataset_from = info[0][i_batch]
-            idx_in_dataset = info[1][i_batch]
-            if dataset_from == 1:
-                img_path = data_loader.dataset.dataset1.all_image_list[idx_in_dataset]
-                print(idx_in_dataset, img_path)
-                print(data_loader.dataset.dataset1.all_image_dict[img_path].keys())
-                data_loader.dataset.dataset1.all_image_dict[img_path]['mse_loss'] = frame_loss[i_batch].item()
-                data_loader.dataset.dataset1.all_image_dict[img_path]['hardness'] = frame_loss[i_batch].item()
+        # one device-to-host copy of the frame loss, then a single scatter to the hardness store of dataset1
+        frame_loss = frame_loss.detach().float().cpu().numpy()
+        from_dataset1 = (torch.as_tensor(info[0]) == 1).numpy()
+        if from_dataset1.any():
+            dataset1 = data_loader.dataset.dataset1
+            frame_ids = dataset1.all_image_frame_id[torch.as_tensor(info[1]).numpy()[from_dataset1]]
+            dataset1.update_hardness(frame_ids, frame_loss[from_dataset1])
 
         loss_value = loss.item()
 
@@ -275,11 +273,12 @@ def eval_one_epoch(
                     sample_2d_info = secondary_data[1]
                     img_names_2d = sample_2d_info[-1]
 
-                    pre_mask = torch.zeros_like(sample_2d)
-                    for i in range(len(sample_2d)):
-                        sample = sample_2d[i, 0]
-
-                        sample_2d[i, 0], pre_mask[i, 0] = misc.find_and_convert_large_white_region(sample)
+                    if len(secondary_data) > 2:
+                        # white regions already converted by misc.white_region_collate in the workers
+                        pre_mask = secondary_data[2].to(sample_2d.dtype)
+                    else:
+                        sample_2d[:, 0], pre_mask = misc.find_and_convert_large_white_region_batch(sample_2d[:, 0])
+                        pre_mask = pre_mask.unsqueeze(1).to(sample_2d.dtype)
 
                     with torch.cuda.amp.autocast(enabled=not fp32, dtype=torch.float16 if fp16 else None):
                         loss_2d, pred_2d, mask_2d = model(
@@ -0,0 +1,132 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Frozen-backbone embedding extraction for linear probing: the OCTCube 3D ViT
+# (models_vit_st_flash_attn) runs once over every visit of the in-house dataset with the val
+# transforms of main_finetune_downstream_inhouse_singlefold.py, and the embeddings of
+# forward(return_embeddings=True) are written to a memory-mapped [N, D] float16 store with its
+# targets and index (see util.embedding_store). main_probe_embeddings.py then fits the heads of the
+# single-fold / K-fold splits from the store, without running the backbone again.
+# Takes the arguments of main_finetune_downstream_inhouse_singlefold.py, plus --store_dir.
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from main_finetune_downstream_inhouse_singlefold import get_args_parser as get_finetune_args_parser
+from util.batch_augment import RawVolumed, collate_volumes, create_3d_batch_transforms
+from util.datasets import build_transform
+from util.embedding_store import EmbeddingStoreWriter, extract_embeddings
+from util.pos_embed import interpolate_pos_embed, interpolate_temporal_pos_embed
+from util.PatientDataset import TransformableSubset
+from util.PatientDataset_inhouse import PatientDataset3D_inhouse, create_3d_transforms
+from util.tensor_cache import is_random_transform
+
+import models_vit_st_flash_attn
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Extract frozen OCTCube embeddings', parents=[get_finetune_args_parser()])
+    parser.add_argument('--store_dir', required=True, type=str, help='output directory of the embedding store')
+    parser.add_argument('--store_dtype', default='float16', type=str, choices=['float16', 'float32'], help='storage dtype of the embeddings')
+    return parser
+
+
+def build_model(args):
+    assert args.patient_dataset_type == '3D_st_flash_attn', 'embedding extraction supports the 3D_st_flash_attn model (forward(return_embeddings=True))'
+    model = models_vit_st_flash_attn.__dict__[args.model](
+        num_frames=args.num_frames,
+        t_patch_size=args.t_patch_size,
+        img_size=args.input_size,
+        num_classes=args.nb_classes,
+        drop_path_rate=0.0,
+        global_pool=args.global_pool,
+        sep_pos_embed=args.sep_pos_embed,
+        cls_embed=args.cls_embed,
+        use_flash_attention=True,
+        attn_backend=args.attn_backend,
+        fused_qkv=args.fused_qkv,
+    )
+
+    if args.finetune:
+        # pre-trained or fine-tuned checkpoint, the head is only used if its shape matches --nb_classes
+        checkpoint = torch.load(args.finetune, map_location='cpu')
+        print("Load checkpoint from: %s" % args.finetune)
+        checkpoint_model = checkpoint['teacher_model'] if args.load_teacher_model else checkpoint['model']
+        state_dict = model.state_dict()
+        for k in ['head.weight', 'head.bias']:
+            if k in checkpoint_model and checkpoint_model[k].shape != state_dict[k].shape:
+                print(f"Removing key {k} from checkpoint")
+                del checkpoint_model[k]
+        interpolate_pos_embed(model, checkpoint_model)
+        if args.sep_pos_embed:
+            interpolate_temporal_pos_embed(model, checkpoint_model, smaller_interpolate_type=args.smaller_temporal_crop)
+        # flash-attn checkpoints are mapped to the sdpa / naive blocks by their load_state_dict pre-hook
+        if args.load_non_flash_attn_to_flash_attn:
+            msg = model.load_state_dict_to_backbone(checkpoint_model)
+        else:
+            msg = model.load_state_dict(checkpoint_model, strict=False)
+        print(msg)
+        # the embeddings are cached for every probe fit, only the head may be left at its initialization
+        missing_keys = [k for k in msg.missing_keys if not k.startswith('head.')]
+        assert not missing_keys, f'{len(missing_keys)} backbone weights not in the checkpoint: {missing_keys[:4]} ...'
+    else:
+        print('Warning: no --finetune checkpoint, extracting the embeddings of a randomly initialized model')
+
+    for p in model.parameters():
+        p.requires_grad = False
+    return model
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    val_batch_transform = None
+    if args.transform_type == 'frame_2D':
+        val_transform = build_transform(is_train='val', args=args)
+    else:
+        _, val_transform = create_3d_transforms(**vars(args))
+        if args.batch_augment:
+            _, val_batch_transform = create_3d_batch_transforms(**vars(args))
+            val_transform = RawVolumed(dtype=args.raw_volume_dtype)
+    # the embeddings are reused by every probe fit, they must not depend on the draw of an augmentation
+    assert not is_random_transform(val_transform) and not is_random_transform(val_batch_transform), 'the val transforms must be deterministic'
+
+    dataset = PatientDataset3D_inhouse(root_dir=args.data_path, transform=None, disease=args.disease, dataset_mode='frame', mode=args.color_mode, task_mode=args.task_mode, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, pad_to_num_frames=args.pad_to_num_frames, padding_num_frames=args.num_frames, transform_type=args.transform_type, same_3_frames=args.same_3_frames, multi_task_idx=args.multi_task_idx)
+    indices = list(range(len(dataset)))
+    dataset_all = TransformableSubset(dataset, indices)
+    dataset_all.update_dataset_transform(val_transform)
+    patient_ids = [dataset.mapping_visit2patient[idx] for idx in indices]
+    print('Number of visits: %d, patients: %d' % (len(indices), len(set(patient_ids))))
+
+    data_loader = torch.utils.data.DataLoader(
+        dataset_all, sampler=torch.utils.data.SequentialSampler(dataset_all),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
+        pin_memory=args.pin_mem,
+        collate_fn=collate_volumes if val_batch_transform is not None else None,
+        drop_last=False,
+    )
+
+    model = build_model(args).to(device)
+    embed_dim = model.head.in_features
+    writer = EmbeddingStoreWriter(args.store_dir, len(indices), embed_dim, dtype=np.dtype(args.store_dtype))
+
+    start_time = time.time()
+    num_rows = extract_embeddings(model, data_loader, writer, device, batch_transform=val_batch_transform)
+    writer.close(indices, patient_ids, args=vars(args))
+    print('Extracted %d embeddings of dim %d in %.1fs to %s' % (num_rows, embed_dim, time.time() - start_time, args.store_dir))
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
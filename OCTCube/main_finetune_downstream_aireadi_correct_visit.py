@@ -42,7 +42,10 @@ from util.misc import NativeScalerWithGradNormCount as NativeScaler
 from util.pos_embed import interpolate_pos_embed, interpolate_temporal_pos_embed
 from util.WeightedLabelSmoothingCrossEntropy import WeightedLabelSmoothingCrossEntropy
 
-from util.PatientDataset import TransformableSubset, PatientDataset3D, PatientDatasetCenter2D
+from util.PatientDataset import TransformableSubset, CachedTransformableSubset, PatientDataset3D, PatientDatasetCenter2D
+from util.tensor_cache import TensorCache
+from util.batch_augment import RawVolumed, collate_volumes, create_3d_batch_transforms
+from util.bucket_sampler import BucketBatchSampler, get_dataset_shapes
 from util.PatientDataset_inhouse import create_3d_transforms
 
 from engine_finetune import train_one_epoch, evaluate, init_csv_writer
@@ -85,6 +88,8 @@ def get_args_parser():
     parser.add_argument('--aireadi_pre_patient_cohort', default='All_have', type=str, help='pre_patient_cohort of the aireadi dataset')
     parser.add_argument('--aireadi_abnormal_file_tsv', default=None, type=str, help='abnormal abnormal file tsv')
     parser.add_argument('--aireadi_normalize_retfound', default=False, action='store_true', help='normalize aireadi dataset with retfound mean and std')
+    parser.add_argument('--lazy_dicom_frames', action='store_true', default=False, help='2D: decode only the middle B-scan of the dicom volume, normalized by its own min / max instead of the volume min / max')
+    parser.add_argument('--aireadi_crop_params_tsv', default=None, type=str, help='Topcon crop params tsv from precompute_aireadi_crop_params.py, under retinal_oct/')
     parser.add_argument('--shift_mean_std', default=False, action='store_true', help='shift mean and std')
 
     parser.add_argument('--lock_tower', default=False, action='store_true', help='lock image tower')
@@ -247,6 +252,15 @@ def get_args_parser():
     parser.add_argument('--dist_eval', action='store_true', default=False,
                         help='Enabling distributed evaluation (recommended during training for faster monitor')
     parser.add_argument('--num_workers', default=10, type=int)
+    parser.add_argument('--cache_eval_tensors', default=False, action='store_true', help='cache the transformed val / test tensors across epochs and folds')
+    parser.add_argument('--eval_cache_gb', default=8, type=float, help='shared memory budget of the eval tensor cache')
+    parser.add_argument('--eval_cache_spill_dir', default=None, type=str, help='directory the eval tensor cache spills to once the shared memory budget is used, None to not cache the rest')
+    parser.add_argument('--eval_cache_dtype', default='float16', type=str, choices=['float16', 'float32', 'uint8'], help='storage dtype of the eval tensor cache, uint8 only for tensors in [0, 1]')
+    parser.add_argument('--batch_augment', default=False, action='store_true', help='run the monai_3D augmentation on the collated batch on the device instead of per sample in the DataLoader workers')
+    parser.add_argument('--bucket_by_shape', default=False, action='store_true', help='batch the visits by native volume shape (from the manifest) with --batch_augment, instead of padding them to the largest of the batch')
+    parser.add_argument('--raw_volume_dtype', default='uint8', type=str, choices=['uint8', 'float16'], help='dtype of the volumes shipped by the DataLoader workers with --batch_augment')
+    parser.add_argument('--volume_dtype', default='float32', type=str, choices=['float32', 'float16', 'uint8'], help='dtype of the volumes of PatientDataset3D, uint8 / float16 are converted on the device (uint8 needs --batch_augment with monai_3D)')
+    parser.add_argument('--manifest_cache', default=False, nargs='?', const=True, help='cache the directory listings of PatientDataset3D / PatientDatasetCenter2D across folds and runs: next to --data_path if given alone, or in the given directory (e.g., the output dir, when --data_path is read-only or shared)')
     parser.add_argument('--pin_mem', action='store_true',
                         help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
     parser.add_argument('--no_pin_mem', action='store_false', dest='pin_mem')
@@ -299,6 +313,7 @@ def main(args):
         train_transform_high_res = None
         val_transform_high_res = None
 
+    train_batch_transform, val_batch_transform = None, None
     if not args.patient_dataset:
 
         dataset_train = build_dataset(is_train='train', args=args)
@@ -313,8 +328,15 @@ def main(args):
             val_transform = train_transform
         elif args.transform_type == 'monai_3D':
             train_transform, val_transform = create_3d_transforms(**vars(args))
+            if args.batch_augment:
+                assert not args.variable_joint, 'batch_augment does not support variable_joint'
+                # the DataLoader workers only ship the raw volumes, crop / resize / flips run on the batch
+                train_batch_transform, val_batch_transform = create_3d_batch_transforms(**vars(args))
+                train_transform = val_transform = RawVolumed(dtype=args.raw_volume_dtype)
+            assert args.batch_augment or args.volume_dtype == 'float32', 'the per-sample monai transforms need float32 volumes, use --batch_augment'
+        assert args.batch_augment or not args.bucket_by_shape, 'bucket_by_shape batches the raw volumes of --batch_augment'
         if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type == '3D_st_joint' or args.patient_dataset_type.startswith('3D'):
-            dataset_for_Kfold = PatientDataset3D(root_dir=args.data_path, patient_idx_loc=args.patient_idx_loc, transform=None, dataset_mode=args.dataset_mode, name_split_char=args.name_split_char, cls_unique=args.cls_unique, iterate_mode=args.iterate_mode,  max_frames=args.max_frames, mode=args.color_mode, transform_type=args.transform_type, volume_resize=args.input_size, same_3_frames=args.same_3_frames, aireadi_location=args.aireadi_location, aireadi_device=args.aireadi_device, aireadi_split=args.aireadi_split, aireadi_pre_patient_cohort=args.aireadi_pre_patient_cohort, shift_mean_std=args.shift_mean_std, aireadi_normalize_retfound=args.aireadi_normalize_retfound, aireadi_abnormal_file_tsv=args.aireadi_abnormal_file_tsv)
+            dataset_for_Kfold = PatientDataset3D(root_dir=args.data_path, patient_idx_loc=args.patient_idx_loc, transform=None, dataset_mode=args.dataset_mode, name_split_char=args.name_split_char, cls_unique=args.cls_unique, iterate_mode=args.iterate_mode,  max_frames=args.max_frames, mode=args.color_mode, transform_type=args.transform_type, volume_resize=args.input_size, same_3_frames=args.same_3_frames, aireadi_location=args.aireadi_location, aireadi_device=args.aireadi_device, aireadi_split=args.aireadi_split, aireadi_pre_patient_cohort=args.aireadi_pre_patient_cohort, shift_mean_std=args.shift_mean_std, aireadi_normalize_retfound=args.aireadi_normalize_retfound, aireadi_abnormal_file_tsv=args.aireadi_abnormal_file_tsv, aireadi_crop_params_tsv=args.aireadi_crop_params_tsv, volume_dtype=args.volume_dtype, manifest_cache=args.manifest_cache)
 
         elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
             train_transform = build_transform(is_train='train', args=args)
@@ -323,7 +345,11 @@ def main(args):
                 train_transform = build_transform(is_train='val', args=args)
                 val_transform = build_transform(is_train='val', args=args)
 
-            dataset_for_Kfold = PatientDatasetCenter2D(root_dir=args.data_path, patient_idx_loc=args.patient_idx_loc, transform=None, dataset_mode=args.dataset_mode, name_split_char=args.name_split_char, cls_unique=args.cls_unique, iterate_mode=args.iterate_mode, aireadi_location=args.aireadi_location, aireadi_device=args.aireadi_device, aireadi_split=args.aireadi_split, aireadi_pre_patient_cohort=args.aireadi_pre_patient_cohort, shift_mean_std=args.shift_mean_std, volume_resize=args.input_size, aireadi_abnormal_file_tsv=args.aireadi_abnormal_file_tsv)
+            dataset_for_Kfold = PatientDatasetCenter2D(root_dir=args.data_path, patient_idx_loc=args.patient_idx_loc, transform=None, dataset_mode=args.dataset_mode, name_split_char=args.name_split_char, cls_unique=args.cls_unique, iterate_mode=args.iterate_mode, aireadi_location=args.aireadi_location, aireadi_device=args.aireadi_device, aireadi_split=args.aireadi_split, aireadi_pre_patient_cohort=args.aireadi_pre_patient_cohort, shift_mean_std=args.shift_mean_std, volume_resize=args.input_size, aireadi_abnormal_file_tsv=args.aireadi_abnormal_file_tsv, lazy_dicom_frames=args.lazy_dicom_frames, manifest_cache=args.manifest_cache)
+
+        eval_tensor_cache = None
+        if args.cache_eval_tensors:
+            eval_tensor_cache = TensorCache(len(dataset_for_Kfold), shm_cache_gb=args.eval_cache_gb, spill_dir=args.eval_cache_spill_dir, cache_dtype=args.eval_cache_dtype)
 
         if args.k_fold:
             # Assuming KFold setup is external, and args.fold indicates the current fold
@@ -356,23 +382,23 @@ def main(args):
                     if args.few_shot:
                         val_indices = val_pat_indices
                         dataset_train = TransformableSubset(dataset_for_Kfold, val_indices)
-                        dataset_val = TransformableSubset(dataset_for_Kfold, train_pat_indices)
+                        dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_pat_indices, tensor_cache=eval_tensor_cache)
                     else:
                         train_indices = train_pat_indices
                         dataset_train = TransformableSubset(dataset_for_Kfold, train_indices)
-                        dataset_val = TransformableSubset(dataset_for_Kfold, val_pat_indices)
-                    dataset_test = TransformableSubset(dataset_for_Kfold, test_pat_indices)
+                        dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_pat_indices, tensor_cache=eval_tensor_cache)
+                    dataset_test = CachedTransformableSubset(dataset_for_Kfold, test_pat_indices, tensor_cache=eval_tensor_cache)
                     dataset_train.update_dataset_transform(train_transform)
                 elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
                     if args.few_shot:
                         val_indices = val_pat_indices
                         dataset_train = TransformableSubset(dataset_for_Kfold, val_indices, transform=train_transform)
-                        dataset_val = TransformableSubset(dataset_for_Kfold, train_pat_indices, transform=val_transform)
+                        dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_pat_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
                     else:
                         train_indices = train_pat_indices
                         dataset_train = TransformableSubset(dataset_for_Kfold, train_indices, transform=train_transform)
-                        dataset_val = TransformableSubset(dataset_for_Kfold, val_pat_indices, transform=val_transform)
-                    dataset_test = TransformableSubset(dataset_for_Kfold, test_pat_indices, transform=val_transform)
+                        dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_pat_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
+                    dataset_test = CachedTransformableSubset(dataset_for_Kfold, test_pat_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
 
     num_tasks = misc.get_world_size()
     global_rank = misc.get_rank()
@@ -397,19 +423,19 @@ def main(args):
             if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type == '3D_st_joint' or args.patient_dataset_type.startswith('3D'):
                 if args.few_shot:
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_indices, tensor_cache=eval_tensor_cache)
                 else:
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_indices, tensor_cache=eval_tensor_cache)
                 dataset_train.update_dataset_transform(train_transform)
 
             elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
                 if args.few_shot:
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
                 else:
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
             dataset_test = dataset_val
             sampler_train = torch.utils.data.DistributedSampler(
                 dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
@@ -440,6 +466,7 @@ def main(args):
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=True,
             )
 
@@ -448,6 +475,7 @@ def main(args):
                 batch_size=args.val_batch_size,
                 num_workers=args.num_workers,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -456,6 +484,7 @@ def main(args):
                 batch_size=args.val_batch_size,
                 num_workers=args.num_workers,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -677,7 +706,7 @@ def main(args):
             if args.eval:
                 test_mode = f'test_fold_{fold}'
                 init_csv_writer(args.task, mode=test_mode)
-                test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args)
+                test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                 if args.return_bal_acc:
                     test_auc_pr, test_bal_acc = auc_pr
                 exit(0)
@@ -720,7 +749,8 @@ def main(args):
                     optimizer, device, epoch, loss_scaler,
                     args.clip_grad, mixup_fn,
                     log_writer=log_writer,
-                    args=args
+                    args=args,
+                    batch_transform=train_batch_transform
                 )
                 if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type == '3D_st_joint' or args.patient_dataset_type.startswith('3D'):
                     dataset_train.remove_dataset_transform()
@@ -730,7 +760,7 @@ def main(args):
 
 
                 try:
-                    val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args)
+                    val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                     if args.return_bal_acc:
                         val_auc_pr, val_bal_acc = val_auc_pr
                 except ValueError as e:
@@ -818,7 +848,7 @@ def main(args):
                     test_mode = f'test_fold_{fold}'
                     init_csv_writer(args.task, mode=test_mode)
                     try:
-                        test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, return_bal_acc=args.return_bal_acc, args=args)
+                        test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                         if args.return_bal_acc:
                             test_auc_pr, test_bal_acc = test_auc_pr
                     except ValueError as e:
@@ -1000,29 +1030,61 @@ def main(args):
         else:
             log_writer = None
 
-        data_loader_train = torch.utils.data.DataLoader(
-            dataset_train, sampler=sampler_train,
-            batch_size=args.batch_size,
-            num_workers=args.num_workers,
-            pin_memory=args.pin_mem,
-            drop_last=True,
-        )
+        if args.bucket_by_shape:
+            # one native volume shape per batch, the batch transforms resize them on the device
+            eval_num_replicas, eval_rank = (num_tasks, global_rank) if args.dist_eval else (1, 0)
+            batch_sampler_train = BucketBatchSampler(get_dataset_shapes(dataset_train), args.batch_size, num_replicas=num_tasks, rank=global_rank, shuffle=True, seed=args.seed, drop_last=True)
+            batch_sampler_val = BucketBatchSampler(get_dataset_shapes(dataset_val), args.batch_size, num_replicas=eval_num_replicas, rank=eval_rank, shuffle=False)
+            batch_sampler_test = BucketBatchSampler(get_dataset_shapes(dataset_test), args.batch_size, num_replicas=eval_num_replicas, rank=eval_rank, shuffle=False)
+            print('Shape buckets of the train set:', batch_sampler_train.get_bucket_stats())
 
-        data_loader_val = torch.utils.data.DataLoader(
-            dataset_val, sampler=sampler_val,
-            batch_size=args.batch_size,
-            num_workers=args.num_workers,
-            pin_memory=args.pin_mem,
-            drop_last=False
-        )
+            data_loader_train = torch.utils.data.DataLoader(
+                dataset_train, batch_sampler=batch_sampler_train,
+                num_workers=args.num_workers,
+                pin_memory=args.pin_mem,
+                collate_fn=collate_volumes,
+            )
 
-        data_loader_test = torch.utils.data.DataLoader(
-            dataset_test, sampler=sampler_test,
-            batch_size=args.batch_size,
-            num_workers=args.num_workers,
-            pin_memory=args.pin_mem,
-            drop_last=False
-        )
+            data_loader_val = torch.utils.data.DataLoader(
+                dataset_val, batch_sampler=batch_sampler_val,
+                num_workers=args.num_workers,
+                pin_memory=args.pin_mem,
+                collate_fn=collate_volumes,
+            )
+
+            data_loader_test = torch.utils.data.DataLoader(
+                dataset_test, batch_sampler=batch_sampler_test,
+                num_workers=args.num_workers,
+                pin_memory=args.pin_mem,
+                collate_fn=collate_volumes,
+            )
+        else:
+            data_loader_train = torch.utils.data.DataLoader(
+                dataset_train, sampler=sampler_train,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+                pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
+                drop_last=True,
+            )
+
+            data_loader_val = torch.utils.data.DataLoader(
+                dataset_val, sampler=sampler_val,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+                pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
+                drop_last=False
+            )
+
+            data_loader_test = torch.utils.data.DataLoader(
+                dataset_test, sampler=sampler_test,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+                pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
+                drop_last=False
+            )
 
         print('Length of train, val, test:', len(data_loader_train), len(data_loader_val), len(data_loader_test))
 
@@ -1252,7 +1314,7 @@ def main(args):
         if args.eval:
             test_mode = f'test_singlefold'
             init_csv_writer(args.task, mode=test_mode)
-            test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args)
+            test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
             if args.return_bal_acc:
                 auc_pr, test_bal_acc = auc_pr
             exit(0)
@@ -1286,14 +1348,17 @@ def main(args):
             early_stop_counter = 0
 
         for epoch in range(args.start_epoch, args.epochs):
-            if args.distributed:
+            if args.bucket_by_shape:
+                data_loader_train.batch_sampler.set_epoch(epoch)
+            elif args.distributed:
                 data_loader_train.sampler.set_epoch(epoch)
             train_stats = train_one_epoch(
                 model, criterion, data_loader_train,
                 optimizer, device, epoch, loss_scaler,
                 args.clip_grad, mixup_fn,
                 log_writer=log_writer,
-                args=args
+                args=args,
+                batch_transform=train_batch_transform
             )
 
             if train_stats is None:
@@ -1306,7 +1371,7 @@ def main(args):
                 dataset_train.remove_dataset_transform()
                 dataset_val.update_dataset_transform(val_transform)
 
-            val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, return_bal_acc=args.return_bal_acc, args=args)
+            val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
             if args.return_bal_acc:
                 val_auc_pr, val_bal_acc = val_auc_pr
 
@@ -1364,7 +1429,7 @@ def main(args):
 
             if max_flag or epoch == (args.epochs - 1) or args.always_test:
                 try:
-                    test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, return_bal_acc=args.return_bal_acc, args=args)
+                    test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                     if args.return_bal_acc:
                         test_auc_pr, test_bal_acc = test_auc_pr
                 except ValueError as e:
@@ -42,7 +42,9 @@ from util.misc import NativeScalerWithGradNormCount as NativeScaler
 from util.pos_embed import interpolate_pos_embed, interpolate_temporal_pos_embed
 from util.WeightedLabelSmoothingCrossEntropy import WeightedLabelSmoothingCrossEntropy
 
-from util.PatientDataset import TransformableSubset, PatientDataset3D, PatientDatasetCenter2D
+from util.PatientDataset import TransformableSubset, CachedTransformableSubset, PatientDataset3D, PatientDatasetCenter2D
+from util.tensor_cache import TensorCache
+from util.batch_augment import RawVolumed, collate_volumes, create_3d_batch_transforms
 from util.PatientDataset_inhouse import create_3d_transforms
 from util.datasets import build_transform
 
@@ -238,6 +240,14 @@ def get_args_parser():
     parser.add_argument('--dist_eval', action='store_true', default=False,
                         help='Enabling distributed evaluation (recommended during training for faster monitor')
     parser.add_argument('--num_workers', default=10, type=int)
+    parser.add_argument('--cache_eval_tensors', default=False, action='store_true', help='cache the transformed val / test tensors across epochs and folds')
+    parser.add_argument('--eval_cache_gb', default=8, type=float, help='shared memory budget of the eval tensor cache')
+    parser.add_argument('--eval_cache_spill_dir', default=None, type=str, help='directory the eval tensor cache spills to once the shared memory budget is used, None to not cache the rest')
+    parser.add_argument('--eval_cache_dtype', default='float16', type=str, choices=['float16', 'float32', 'uint8'], help='storage dtype of the eval tensor cache, uint8 only for tensors in [0, 1]')
+    parser.add_argument('--batch_augment', default=False, action='store_true', help='run the monai_3D augmentation on the collated batch on the device instead of per sample in the DataLoader workers')
+    parser.add_argument('--raw_volume_dtype', default='uint8', type=str, choices=['uint8', 'float16'], help='dtype of the volumes shipped by the DataLoader workers with --batch_augment')
+    parser.add_argument('--volume_dtype', default='float32', type=str, choices=['float32', 'float16', 'uint8'], help='dtype of the volumes of PatientDataset3D, uint8 / float16 are converted on the device (uint8 needs --batch_augment with monai_3D)')
+    parser.add_argument('--manifest_cache', default=False, nargs='?', const=True, help='cache the directory listings of PatientDataset3D / PatientDatasetCenter2D across folds and runs: next to --data_path if given alone, or in the given directory (e.g., the output dir, when --data_path is read-only or shared)')
     parser.add_argument('--pin_mem', action='store_true',
                         help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
     parser.add_argument('--no_pin_mem', action='store_false', dest='pin_mem')
@@ -278,6 +288,7 @@ def main(args):
         test_bal_acc = None
 
     cudnn.benchmark = True
+    train_batch_transform, val_batch_transform = None, None
     if not args.patient_dataset:
         dataset_train = build_dataset(is_train='train', args=args)
         dataset_val = build_dataset(is_train='val', args=args)
@@ -289,11 +300,21 @@ def main(args):
             val_transform = build_transform(is_train='val', args=args)
         elif args.transform_type == 'monai_3D':
             train_transform, val_transform = create_3d_transforms(**vars(args))
+            if args.batch_augment:
+                assert not args.variable_joint, 'batch_augment does not support variable_joint'
+                # the DataLoader workers only ship the raw volumes, crop / resize / flips run on the batch
+                train_batch_transform, val_batch_transform = create_3d_batch_transforms(**vars(args))
+                train_transform = val_transform = RawVolumed(dtype=args.raw_volume_dtype)
+            assert args.batch_augment or args.volume_dtype == 'float32', 'the per-sample monai transforms need float32 volumes, use --batch_augment'
 
         if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type.startswith('3D') or args.patient_dataset_type == 'convnext_slivit':
-            dataset_for_Kfold = PatientDataset3D(root_dir=args.data_path, patient_idx_loc=args.patient_idx_loc, transform=None, dataset_mode=args.dataset_mode, name_split_char=args.name_split_char, cls_unique=args.cls_unique, iterate_mode=args.iterate_mode, max_frames=args.max_frames, mode=args.color_mode, transform_type=args.transform_type, same_3_frames=args.same_3_frames, downsample_width=True, random_shuffle_patient=not args.not_dataset_random_reshuffle_patient)
+            dataset_for_Kfold = PatientDataset3D(root_dir=args.data_path, patient_idx_loc=args.patient_idx_loc, transform=None, dataset_mode=args.dataset_mode, name_split_char=args.name_split_char, cls_unique=args.cls_unique, iterate_mode=args.iterate_mode, max_frames=args.max_frames, mode=args.color_mode, transform_type=args.transform_type, same_3_frames=args.same_3_frames, downsample_width=True, random_shuffle_patient=not args.not_dataset_random_reshuffle_patient, volume_dtype=args.volume_dtype, manifest_cache=args.manifest_cache)
         elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
-            dataset_for_Kfold = PatientDatasetCenter2D(root_dir=args.data_path, patient_idx_loc=args.patient_idx_loc, transform=None, dataset_mode=args.dataset_mode, name_split_char=args.name_split_char, cls_unique=args.cls_unique, iterate_mode=args.iterate_mode, downsample_width=True, random_shuffle_patient=not args.not_dataset_random_reshuffle_patient)
+            dataset_for_Kfold = PatientDatasetCenter2D(root_dir=args.data_path, patient_idx_loc=args.patient_idx_loc, transform=None, dataset_mode=args.dataset_mode, name_split_char=args.name_split_char, cls_unique=args.cls_unique, iterate_mode=args.iterate_mode, downsample_width=True, random_shuffle_patient=not args.not_dataset_random_reshuffle_patient, manifest_cache=args.manifest_cache)
+
+        eval_tensor_cache = None
+        if args.cache_eval_tensors:
+            eval_tensor_cache = TensorCache(len(dataset_for_Kfold), shm_cache_gb=args.eval_cache_gb, spill_dir=args.eval_cache_spill_dir, cache_dtype=args.eval_cache_dtype)
 
         if args.k_fold:
             # Assuming KFold setup is external, and args.fold indicates the current fold
@@ -334,19 +355,19 @@ def main(args):
             if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type.startswith('3D') or args.patient_dataset_type == 'convnext_slivit':
                 if args.few_shot:
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_indices, tensor_cache=eval_tensor_cache)
                 else:
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_indices, tensor_cache=eval_tensor_cache)
                 dataset_train.update_dataset_transform(train_transform)
 
             elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
                 if args.few_shot:
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
                 else:
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
 
             dataset_test = dataset_val
             sampler_train = torch.utils.data.DistributedSampler(
@@ -378,6 +399,7 @@ def main(args):
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=True,
             )
 
@@ -386,6 +408,7 @@ def main(args):
                 batch_size=args.val_batch_size,
                 num_workers=args.num_workers,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -394,6 +417,7 @@ def main(args):
                 batch_size=args.val_batch_size,
                 num_workers=args.num_workers,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -586,7 +610,7 @@ def main(args):
             if args.eval:
                 test_mode = f'test_fold_{fold}'
                 init_csv_writer(args.task, mode=test_mode)
-                test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args)
+                test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                 if args.return_bal_acc:
                     test_auc_pr, test_bal_acc = auc_pr
                 exit(0)
@@ -618,7 +642,8 @@ def main(args):
                     optimizer, device, epoch, loss_scaler,
                     args.clip_grad, mixup_fn,
                     log_writer=log_writer,
-                    args=args
+                    args=args,
+                    batch_transform=train_batch_transform
                 )
                 if train_stats is None:
                     # downscale the learning rate by 2
@@ -632,7 +657,7 @@ def main(args):
                     # print('go to val:', dataset_val.dataset.transform)
                 disease_list = None
                 try:
-                    val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                    val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                     if args.return_bal_acc:
                         val_auc_pr, val_bal_acc = val_auc_pr
                 except ValueError as e:
@@ -719,7 +744,7 @@ def main(args):
                     test_mode = f'test_fold_{fold}'
                     init_csv_writer(args.task, mode=test_mode)
                     try:
-                        test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                        test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                         if args.return_bal_acc:
                             test_auc_pr, test_bal_acc = test_auc_pr
                     except ValueError as e:
@@ -909,6 +934,7 @@ def main(args):
             batch_size=args.batch_size,
             num_workers=args.num_workers,
             pin_memory=args.pin_mem,
+            collate_fn=collate_volumes if train_batch_transform is not None else None,
             drop_last=True,
         )
 
@@ -917,6 +943,7 @@ def main(args):
             batch_size=args.batch_size,
             num_workers=args.num_workers,
             pin_memory=args.pin_mem,
+            collate_fn=collate_volumes if train_batch_transform is not None else None,
             drop_last=False
         )
 
@@ -925,6 +952,7 @@ def main(args):
             batch_size=args.batch_size,
             num_workers=args.num_workers,
             pin_memory=args.pin_mem,
+            collate_fn=collate_volumes if train_batch_transform is not None else None,
             drop_last=False
         )
 
@@ -1015,7 +1043,7 @@ def main(args):
         misc.load_model(args=args, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler)
 
         if args.eval:
-            test_stats,auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode='test', num_class=args.nb_classes)
+            test_stats,auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode='test', num_class=args.nb_classes, args=args, batch_transform=val_batch_transform)
             exit(0)
 
         print(f"Start training for {args.epochs} epochs")
@@ -1030,10 +1058,11 @@ def main(args):
                 optimizer, device, epoch, loss_scaler,
                 args.clip_grad, mixup_fn,
                 log_writer=log_writer,
-                args=args
+                args=args,
+                batch_transform=train_batch_transform
             )
 
-            val_stats,val_auc_roc, auc_pr = evaluate(data_loader_val, model, device, args.task,epoch, mode='val', num_class=args.nb_classes)
+            val_stats,val_auc_roc, auc_pr = evaluate(data_loader_val, model, device, args.task,epoch, mode='val', num_class=args.nb_classes, args=args, batch_transform=val_batch_transform)
             if max_auc <= val_auc_roc:
                 max_auc = val_auc_roc
 
@@ -1046,7 +1075,7 @@ def main(args):
 
 
             if epoch==(args.epochs-1):
-                test_stats,auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task,epoch, mode='test', num_class=args.nb_classes)
+                test_stats,auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task,epoch, mode='test', num_class=args.nb_classes, args=args, batch_transform=val_batch_transform)
 
 
             if log_writer is not None:
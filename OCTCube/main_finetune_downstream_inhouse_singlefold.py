@@ -40,9 +40,13 @@ from util.datasets import build_transform, load_patient_list
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
 
 from util.pos_embed import interpolate_pos_embed, interpolate_temporal_pos_embed
+from util.video_vit import check_attention_keys_loaded
 from util.WeightedLabelSmoothingCrossEntropy import WeightedLabelSmoothingCrossEntropy
 
-from util.PatientDataset import TransformableSubset, PatientDataset3D, PatientDatasetCenter2D
+from util.PatientDataset import TransformableSubset, CachedTransformableSubset, PatientDataset3D, PatientDatasetCenter2D
+from util.tensor_cache import TensorCache
+from util.batch_augment import RawVolumed, collate_volumes, create_3d_batch_transforms
+from util.epoch_sampler import DownsampleNormalSampler
 from util.PatientDataset_inhouse import PatientDatasetCenter2D_inhouse, PatientDataset3D_inhouse, create_3d_transforms
 
 from engine_finetune import train_one_epoch, evaluate, init_csv_writer
@@ -87,6 +91,8 @@ def get_args_parser():
     parser.add_argument('--high_res_input_size', default=512, type=int, help='high resolution patch size')
     parser.add_argument('--focal_loss', default=False, action='store_true', help='use focal loss')
     parser.add_argument('--load_non_flash_attn_to_flash_attn', default=False, action='store_true', help='use focal loss')
+    parser.add_argument('--attn_backend', default=None, type=str, choices=['flash', 'sdpa', 'naive'], help='attention kernel of the 3D_st_flash_attn models, defaults to flash if installed, else sdpa')
+    parser.add_argument('--fused_qkv', default=False, action='store_true', help='one qkv Linear in the sdpa / naive attention blocks of the 3D_st_flash_attn models')
     parser.add_argument('--always_test', default=False, action='store_true', help='always run test if specified')
     parser.add_argument('--use_cls_idx', default=None, nargs='+', type=int, help='List of integers')
     parser.add_argument('--linear_probe', default=False, action='store_true', help='linear probe')
@@ -226,6 +232,14 @@ def get_args_parser():
     parser.add_argument('--dist_eval', action='store_true', default=False,
                         help='Enabling distributed evaluation (recommended during training for faster monitor')
     parser.add_argument('--num_workers', default=8, type=int)
+    parser.add_argument('--persistent_workers', default=False, action='store_true', help='keep the DataLoader workers alive across epochs')
+    parser.add_argument('--prefetch_factor', default=2, type=int, help='number of batches prefetched by each DataLoader worker')
+    parser.add_argument('--cache_eval_tensors', default=False, action='store_true', help='cache the transformed val / test tensors across epochs and folds')
+    parser.add_argument('--eval_cache_gb', default=8, type=float, help='shared memory budget of the eval tensor cache')
+    parser.add_argument('--eval_cache_spill_dir', default=None, type=str, help='directory the eval tensor cache spills to once the shared memory budget is used, None to not cache the rest')
+    parser.add_argument('--eval_cache_dtype', default='float16', type=str, choices=['float16', 'float32', 'uint8'], help='storage dtype of the eval tensor cache, uint8 only for tensors in [0, 1]')
+    parser.add_argument('--batch_augment', default=False, action='store_true', help='run the monai_3D augmentation on the collated batch on the device instead of per sample in the DataLoader workers')
+    parser.add_argument('--raw_volume_dtype', default='uint8', type=str, choices=['uint8', 'float16'], help='dtype of the volumes shipped by the DataLoader workers with --batch_augment')
     parser.add_argument('--pin_mem', action='store_true',
                         help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
     parser.add_argument('--no_pin_mem', action='store_false', dest='pin_mem')
@@ -274,6 +288,7 @@ def main(args):
         train_transform_high_res = None
         val_transform_high_res = None
 
+    train_batch_transform, val_batch_transform = None, None
     if not args.patient_dataset:
 
         dataset_train = build_dataset(is_train='train', args=args)
@@ -286,10 +301,19 @@ def main(args):
             val_transform = build_transform(is_train='val', args=args)
         elif args.transform_type == 'monai_3D':
             train_transform, val_transform = create_3d_transforms(**vars(args))
+            if args.batch_augment:
+                assert not args.variable_joint, 'batch_augment does not support variable_joint'
+                # the DataLoader workers only ship the raw volumes, crop / resize / flips run on the batch
+                train_batch_transform, val_batch_transform = create_3d_batch_transforms(**vars(args))
+                train_transform = val_transform = RawVolumed(dtype=args.raw_volume_dtype)
         if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type == '3D_st_joint' or args.patient_dataset_type.startswith('3D'):
-            dataset_for_Kfold = PatientDataset3D_inhouse(root_dir=args.data_path, transform=None, disease=args.disease, dataset_mode='frame', mode=args.color_mode, task_mode=args.task_mode, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, pad_to_num_frames=args.pad_to_num_frames, padding_num_frames=args.num_frames, transform_type=args.transform_type, downsample_normal=args.downsample_normal, same_3_frames=args.same_3_frames, return_both_res_image=args.variable_joint, high_res_transform=None, high_res_num_frames=args.high_res_num_frames, downsample_normal_factor=args.downsample_normal_factor, multi_task_idx=args.multi_task_idx)
+            dataset_for_Kfold = PatientDataset3D_inhouse(root_dir=args.data_path, transform=None, disease=args.disease, dataset_mode='frame', mode=args.color_mode, task_mode=args.task_mode, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, pad_to_num_frames=args.pad_to_num_frames, padding_num_frames=args.num_frames, transform_type=args.transform_type, same_3_frames=args.same_3_frames, return_both_res_image=args.variable_joint, high_res_transform=None, high_res_num_frames=args.high_res_num_frames, multi_task_idx=args.multi_task_idx)
         elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
-            dataset_for_Kfold = PatientDatasetCenter2D_inhouse(root_dir=args.data_path, transform=None, disease=args.disease, dataset_mode='frame', mode='rgb', task_mode=args.task_mode, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, downsample_normal=args.downsample_normal, multi_task_idx=args.multi_task_idx)
+            dataset_for_Kfold = PatientDatasetCenter2D_inhouse(root_dir=args.data_path, transform=None, disease=args.disease, dataset_mode='frame', mode='rgb', task_mode=args.task_mode, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, multi_task_idx=args.multi_task_idx)
+
+        eval_tensor_cache = None
+        if args.cache_eval_tensors:
+            eval_tensor_cache = TensorCache(len(dataset_for_Kfold), shm_cache_gb=args.eval_cache_gb, spill_dir=args.eval_cache_spill_dir, cache_dtype=args.eval_cache_dtype)
 
         if args.k_fold:
             # Assuming KFold setup is external, and args.fold indicates the current fold
@@ -319,25 +343,14 @@ def main(args):
             # OCTCube or RETFound-all
             if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type == '3D_st_joint' or args.patient_dataset_type.startswith('3D'):
                 if args.few_shot:
-                    if args.downsample_normal:
-                        adjusted_indices = dataset_for_Kfold.adjusted_indices
-                        val_indices = sorted(list(set(val_pat_indices) & set(adjusted_indices)))
-                    else:
-                        val_indices = val_pat_indices
+                    val_indices = val_pat_indices
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_pat_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_pat_indices, tensor_cache=eval_tensor_cache)
                 else:
-                    if args.downsample_normal:
-                        adjusted_indices = dataset_for_Kfold.adjusted_indices
-                        print('len(adjusted_indices):', len(adjusted_indices))
-                        print('len(train_pat_indices):', len(train_pat_indices))
-                        train_indices = sorted(list(set(train_pat_indices) & set(adjusted_indices)))
-                        print('len(train_indices) after:', len(train_indices))
-                    else:
-                        train_indices = train_pat_indices
+                    train_indices = train_pat_indices
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_pat_indices)
-                dataset_test = TransformableSubset(dataset_for_Kfold, test_pat_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_pat_indices, tensor_cache=eval_tensor_cache)
+                dataset_test = CachedTransformableSubset(dataset_for_Kfold, test_pat_indices, tensor_cache=eval_tensor_cache)
                 dataset_train.update_dataset_transform(train_transform)
                 if args.variable_joint:
                     dataset_train.update_dataset_transform_high_res(train_transform_high_res)
@@ -345,25 +358,14 @@ def main(args):
             # RETFound-center
             elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
                 if args.few_shot:
-                    if args.downsample_normal:
-                        adjusted_indices = dataset_for_Kfold.adjusted_indices
-                        val_indices = sorted(list(set(val_pat_indices) & set(adjusted_indices)))
-                    else:
-                        val_indices = val_pat_indices
+                    val_indices = val_pat_indices
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_pat_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_pat_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
                 else:
-                    if args.downsample_normal:
-                        adjusted_indices = dataset_for_Kfold.adjusted_indices
-                        print('len(adjusted_indices):', len(adjusted_indices))
-                        print('len(train_pat_indices):', len(train_pat_indices))
-                        train_indices = sorted(list(set(train_pat_indices) & set(adjusted_indices)))
-                        print('len(train_indices) after:', len(train_indices))
-                    else:
-                        train_indices = train_pat_indices
+                    train_indices = train_pat_indices
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_pat_indices, transform=val_transform)
-                dataset_test = TransformableSubset(dataset_for_Kfold, test_pat_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_pat_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
+                dataset_test = CachedTransformableSubset(dataset_for_Kfold, test_pat_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
 
     num_tasks = misc.get_world_size()
     global_rank = misc.get_rank()
@@ -382,10 +384,10 @@ def main(args):
             if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type == '3D_st_joint' or args.patient_dataset_type.startswith('3D'):
                 if args.few_shot:
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_indices, tensor_cache=eval_tensor_cache)
                 else:
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_indices, tensor_cache=eval_tensor_cache)
                 dataset_train.update_dataset_transform(train_transform)
                 if args.variable_joint:
                     dataset_train.update_dataset_transform_high_res(train_transform_high_res)
@@ -393,10 +395,10 @@ def main(args):
             elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
                 if args.few_shot:
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
                 else:
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
             dataset_test = dataset_val
             sampler_train = torch.utils.data.DistributedSampler(
                 dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
@@ -425,7 +427,10 @@ def main(args):
                 dataset_train, sampler=sampler_train,
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
+                persistent_workers=args.persistent_workers and args.num_workers > 0,
+                prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=True,
             )
 
@@ -433,7 +438,10 @@ def main(args):
                 dataset_val, sampler=sampler_val,
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
+                persistent_workers=args.persistent_workers and args.num_workers > 0,
+                prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -441,7 +449,10 @@ def main(args):
                 dataset_test, sampler=sampler_test,
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
+                persistent_workers=args.persistent_workers and args.num_workers > 0,
+                prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -520,6 +531,8 @@ def main(args):
                         sep_pos_embed=args.sep_pos_embed,
                         cls_embed=args.cls_embed,
                         use_flash_attention=True,
+                        attn_backend=args.attn_backend,
+                        fused_qkv=args.fused_qkv,
                     )
             elif args.patient_dataset_type == '3D_st_flash_attn_nodrop':
                 print('Use 3D spatio-temporal model w/ flash attention and no dropout')
@@ -559,6 +572,7 @@ def main(args):
                 # load pre-trained model
                 msg = model.load_state_dict(checkpoint_model, strict=False)
                 print(msg)
+                check_attention_keys_loaded(msg)
                 print(msg.missing_keys)
                 if args.global_pool:
                     if args.patient_dataset_type == '3D':
@@ -629,7 +643,7 @@ def main(args):
             if args.eval:
                 test_mode = f'test_fold_{fold}'
                 init_csv_writer(args.task, mode=test_mode)
-                test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args)
+                test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                 if args.return_bal_acc:
                     test_auc_pr, test_bal_acc = auc_pr
                 exit(0)
@@ -662,7 +676,8 @@ def main(args):
                     optimizer, device, epoch, loss_scaler,
                     args.clip_grad, mixup_fn,
                     log_writer=log_writer,
-                    args=args
+                    args=args,
+                    batch_transform=train_batch_transform
                 )
                 if train_stats is None:
                     # downscale the learning rate by 2
@@ -682,7 +697,7 @@ def main(args):
                     disease_list = None
 
                 try:
-                    val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                    val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                     if args.return_bal_acc:
                         val_auc_pr, val_bal_acc = val_auc_pr
                 except ValueError as e:
@@ -742,7 +757,7 @@ def main(args):
                     test_mode = f'test_fold_{fold}'
                     init_csv_writer(args.task, mode=test_mode)
                     try:
-                        test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                        test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                         if args.return_bal_acc:
                             test_auc_pr, test_bal_acc = test_auc_pr
                     except ValueError as e:
@@ -860,9 +875,17 @@ def main(args):
 
         print(f"Start train val test for {len(train_pat_indices)} train, {len(val_pat_indices)} val, {len(test_pat_indices)} test")
 
-        sampler_train = torch.utils.data.DistributedSampler(
-            dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
-        )
+        if args.downsample_normal:
+            # a new subset of the normal visits every epoch, drawn by the sampler so the workers can persist
+            normal_visit_idx = set(dataset_for_Kfold.normal_visit_idx)
+            sampler_train = DownsampleNormalSampler(
+                dataset_train, [i for i, idx in enumerate(dataset_train.indices) if idx in normal_visit_idx], downsample_normal_factor=args.downsample_normal_factor,
+                num_replicas=num_tasks, rank=global_rank, shuffle=True, seed=args.seed
+            )
+        else:
+            sampler_train = torch.utils.data.DistributedSampler(
+                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
+            )
 
         print("Sampler_train = %s" % str(sampler_train))
         if args.dist_eval:
@@ -896,7 +919,10 @@ def main(args):
             dataset_train, sampler=sampler_train,
             batch_size=args.batch_size,
             num_workers=args.num_workers,
+            persistent_workers=args.persistent_workers and args.num_workers > 0,
+            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
             pin_memory=args.pin_mem,
+            collate_fn=collate_volumes if train_batch_transform is not None else None,
             drop_last=True,
         )
 
@@ -904,7 +930,10 @@ def main(args):
             dataset_val, sampler=sampler_val,
             batch_size=args.batch_size,
             num_workers=args.num_workers,
+            persistent_workers=args.persistent_workers and args.num_workers > 0,
+            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
             pin_memory=args.pin_mem,
+            collate_fn=collate_volumes if train_batch_transform is not None else None,
             drop_last=False
         )
 
@@ -912,7 +941,10 @@ def main(args):
             dataset_test, sampler=sampler_test,
             batch_size=args.batch_size,
             num_workers=args.num_workers,
+            persistent_workers=args.persistent_workers and args.num_workers > 0,
+            prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
             pin_memory=args.pin_mem,
+            collate_fn=collate_volumes if train_batch_transform is not None else None,
             drop_last=False
         )
 
@@ -993,7 +1025,9 @@ def main(args):
                     global_pool=args.global_pool,
                     sep_pos_embed=args.sep_pos_embed,
                     cls_embed=args.cls_embed,
-                    use_flash_attention=True
+                    use_flash_attention=True,
+                    attn_backend=args.attn_backend,
+                    fused_qkv=args.fused_qkv,
                 )
         elif args.patient_dataset_type == '3D_st_joint_flash_attn':
             model = models_vit_st_joint_flash_attn.__dict__[args.model](
@@ -1058,6 +1092,7 @@ def main(args):
             else:
                 msg = model.load_state_dict(checkpoint_model, strict=False)
             print(msg)
+            check_attention_keys_loaded(msg)
             print(msg.missing_keys)
             if args.global_pool:
                 if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_flash_attn':
@@ -1155,7 +1190,7 @@ def main(args):
         if args.eval:
             test_mode = f'test_singlefold'
             init_csv_writer(args.task, mode=test_mode)
-            test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args)
+            test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
             if args.return_bal_acc:
                 auc_pr, test_bal_acc = auc_pr
             exit(0)
@@ -1189,14 +1224,15 @@ def main(args):
             early_stop_counter = 0
 
         for epoch in range(args.start_epoch, args.epochs):
-            if args.distributed:
+            if args.distributed or args.downsample_normal:
                 data_loader_train.sampler.set_epoch(epoch)
             train_stats = train_one_epoch(
                 model, criterion, data_loader_train,
                 optimizer, device, epoch, loss_scaler,
                 args.clip_grad, mixup_fn,
                 log_writer=log_writer,
-                args=args
+                args=args,
+                batch_transform=train_batch_transform
             )
 
             if train_stats is None:
@@ -1216,9 +1252,9 @@ def main(args):
                 disease_list = dataset_for_Kfold.idx_to_disease
             else:
                 disease_list = None
-            val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+            val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
             try:
-                val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                 if args.return_bal_acc:
                     val_auc_pr, val_bal_acc = val_auc_pr
             except ValueError as e:
@@ -1281,7 +1317,7 @@ def main(args):
 
             if max_flag or epoch == (args.epochs - 1) or args.always_test:
                 try:
-                    test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                    test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                     if args.return_bal_acc:
                         test_auc_pr, test_bal_acc = test_auc_pr
                 except ValueError as e:
@@ -1377,27 +1413,6 @@ def main(args):
                     dataset_val.remove_dataset_transform_high_res()
                     dataset_train.update_dataset_transform_high_res(train_transform_high_res)
 
-
-            if args.downsample_normal:
-                dataset_train.dataset.on_epoch_end()
-                if args.few_shot:
-                    adjusted_indices = dataset_for_Kfold.adjusted_indices
-                    val_indices = sorted(list(set(val_pat_indices) & set(adjusted_indices)))
-                    dataset_train.update_indices(val_indices)
-                    data_loader_train.sampler.num_samples = math.ceil(len(dataset_train) / num_tasks)
-                    data_loader_train.sampler.total_size = data_loader_train.sampler.num_samples * num_tasks
-
-                else:
-                    print('len(train_indices) before:', len(train_indices))
-                    adjusted_indices = dataset_for_Kfold.adjusted_indices
-                    print('len(adjusted_indices):', len(adjusted_indices))
-                    print('len(train_pat_indices):', len(train_pat_indices))
-                    train_indices = sorted(list(set(train_pat_indices) & set(adjusted_indices)))
-                    print('len(train_indices) after:', len(train_indices))
-                    dataset_train.update_indices(train_indices)
-                    data_loader_train.sampler.num_samples = math.ceil(len(dataset_train) / num_tasks)
-                    data_loader_train.sampler.total_size = data_loader_train.sampler.num_samples * num_tasks
-
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('Training time {}'.format(total_time_str))
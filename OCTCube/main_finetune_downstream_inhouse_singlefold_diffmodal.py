@@ -42,7 +42,10 @@ from util.misc import NativeScalerWithGradNormCount as NativeScaler
 from util.pos_embed import interpolate_pos_embed, interpolate_temporal_pos_embed
 from util.WeightedLabelSmoothingCrossEntropy import WeightedLabelSmoothingCrossEntropy
 
-from util.PatientDataset import TransformableSubset, PatientDataset3D, PatientDatasetCenter2D
+from util.PatientDataset import TransformableSubset, CachedTransformableSubset, PatientDataset3D, PatientDatasetCenter2D
+from util.tensor_cache import TensorCache
+from util.batch_augment import RawVolumed, collate_volumes, create_3d_batch_transforms
+from util.epoch_sampler import DownsampleNormalSampler
 from util.PatientDataset_inhouse import PatientDatasetCenter2D_inhouse, PatientDataset3D_inhouse, create_3d_transforms
 
 from engine_finetune import train_one_epoch, evaluate, init_csv_writer
@@ -254,6 +257,14 @@ def get_args_parser():
     parser.add_argument('--dist_eval', action='store_true', default=False,
                         help='Enabling distributed evaluation (recommended during training for faster monitor')
     parser.add_argument('--num_workers', default=8, type=int)
+    parser.add_argument('--persistent_workers', default=False, action='store_true', help='keep the DataLoader workers alive across epochs')
+    parser.add_argument('--prefetch_factor', default=2, type=int, help='number of batches prefetched by each DataLoader worker')
+    parser.add_argument('--cache_eval_tensors', default=False, action='store_true', help='cache the transformed val / test tensors across epochs and folds')
+    parser.add_argument('--eval_cache_gb', default=8, type=float, help='shared memory budget of the eval tensor cache')
+    parser.add_argument('--eval_cache_spill_dir', default=None, type=str, help='directory the eval tensor cache spills to once the shared memory budget is used, None to not cache the rest')
+    parser.add_argument('--eval_cache_dtype', default='float16', type=str, choices=['float16', 'float32', 'uint8'], help='storage dtype of the eval tensor cache, uint8 only for tensors in [0, 1]')
+    parser.add_argument('--batch_augment', default=False, action='store_true', help='run the monai_3D augmentation on the collated batch on the device instead of per sample in the DataLoader workers')
+    parser.add_argument('--raw_volume_dtype', default='uint8', type=str, choices=['uint8', 'float16'], help='dtype of the volumes shipped by the DataLoader workers with --batch_augment')
     parser.add_argument('--pin_mem', action='store_true',
                         help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
     parser.add_argument('--no_pin_mem', action='store_false', dest='pin_mem')
@@ -329,6 +340,7 @@ def main(args):
         train_transform_high_res = None
         val_transform_high_res = None
 
+    train_batch_transform, val_batch_transform = None, None
     if not args.patient_dataset:
         if not args.slivit_exp:
             dataset_train = build_dataset(is_train='train', args=args)
@@ -345,10 +357,19 @@ def main(args):
             val_transform = build_transform(is_train='val', args=args)
         elif args.transform_type == 'monai_3D':
             train_transform, val_transform = create_3d_transforms(**vars(args))
+            if args.batch_augment:
+                assert not args.variable_joint, 'batch_augment does not support variable_joint'
+                # the DataLoader workers only ship the raw volumes, crop / resize / flips run on the batch
+                train_batch_transform, val_batch_transform = create_3d_batch_transforms(**vars(args))
+                train_transform = val_transform = RawVolumed(dtype=args.raw_volume_dtype)
         if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type == '3D_st_joint' or args.patient_dataset_type.startswith('3D'):
-            dataset_for_Kfold = PatientDataset3D_inhouse(root_dir=args.data_path, transform=None, disease=args.disease, dataset_mode='frame', mode=args.color_mode, task_mode=args.task_mode, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, pad_to_num_frames=args.pad_to_num_frames, padding_num_frames=args.num_frames, transform_type=args.transform_type, downsample_normal=args.downsample_normal, same_3_frames=args.same_3_frames, return_both_res_image=args.variable_joint, high_res_transform=None, high_res_num_frames=args.high_res_num_frames, downsample_normal_factor=args.downsample_normal_factor, multi_task_idx=args.multi_task_idx)
+            dataset_for_Kfold = PatientDataset3D_inhouse(root_dir=args.data_path, transform=None, disease=args.disease, dataset_mode='frame', mode=args.color_mode, task_mode=args.task_mode, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, pad_to_num_frames=args.pad_to_num_frames, padding_num_frames=args.num_frames, transform_type=args.transform_type, same_3_frames=args.same_3_frames, return_both_res_image=args.variable_joint, high_res_transform=None, high_res_num_frames=args.high_res_num_frames, multi_task_idx=args.multi_task_idx)
         elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
-            dataset_for_Kfold = PatientDatasetCenter2D_inhouse(root_dir=args.data_path, transform=None, disease=args.disease, dataset_mode='frame', mode='rgb', task_mode=args.task_mode, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, downsample_normal=args.downsample_normal, multi_task_idx=args.multi_task_idx)
+            dataset_for_Kfold = PatientDatasetCenter2D_inhouse(root_dir=args.data_path, transform=None, disease=args.disease, dataset_mode='frame', mode='rgb', task_mode=args.task_mode, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, multi_task_idx=args.multi_task_idx)
+
+        eval_tensor_cache = None
+        if args.cache_eval_tensors:
+            eval_tensor_cache = TensorCache(len(dataset_for_Kfold), shm_cache_gb=args.eval_cache_gb, spill_dir=args.eval_cache_spill_dir, cache_dtype=args.eval_cache_dtype)
 
         if args.k_fold:
             # Assuming KFold setup is external, and args.fold indicates the current fold
@@ -378,25 +399,14 @@ def main(args):
             # OCTCube or RETFound-all
             if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type == '3D_st_joint' or args.patient_dataset_type.startswith('3D'):
                 if args.few_shot:
-                    if args.downsample_normal:
-                        adjusted_indices = dataset_for_Kfold.adjusted_indices
-                        val_indices = sorted(list(set(val_pat_indices) & set(adjusted_indices)))
-                    else:
-                        val_indices = val_pat_indices
+                    val_indices = val_pat_indices
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_pat_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_pat_indices, tensor_cache=eval_tensor_cache)
                 else:
-                    if args.downsample_normal:
-                        adjusted_indices = dataset_for_Kfold.adjusted_indices
-                        print('len(adjusted_indices):', len(adjusted_indices))
-                        print('len(train_pat_indices):', len(train_pat_indices))
-                        train_indices = sorted(list(set(train_pat_indices) & set(adjusted_indices)))
-                        print('len(train_indices) after:', len(train_indices))
-                    else:
-                        train_indices = train_pat_indices
+                    train_indices = train_pat_indices
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_pat_indices)
-                dataset_test = TransformableSubset(dataset_for_Kfold, test_pat_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_pat_indices, tensor_cache=eval_tensor_cache)
+                dataset_test = CachedTransformableSubset(dataset_for_Kfold, test_pat_indices, tensor_cache=eval_tensor_cache)
                 dataset_train.update_dataset_transform(train_transform)
                 if args.variable_joint:
                     dataset_train.update_dataset_transform_high_res(train_transform_high_res)
@@ -404,25 +414,14 @@ def main(args):
             # RETFound-center
             elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
                 if args.few_shot:
-                    if args.downsample_normal:
-                        adjusted_indices = dataset_for_Kfold.adjusted_indices
-                        val_indices = sorted(list(set(val_pat_indices) & set(adjusted_indices)))
-                    else:
-                        val_indices = val_pat_indices
+                    val_indices = val_pat_indices
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_pat_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_pat_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
                 else:
-                    if args.downsample_normal:
-                        adjusted_indices = dataset_for_Kfold.adjusted_indices
-                        print('len(adjusted_indices):', len(adjusted_indices))
-                        print('len(train_pat_indices):', len(train_pat_indices))
-                        train_indices = sorted(list(set(train_pat_indices) & set(adjusted_indices)))
-                        print('len(train_indices) after:', len(train_indices))
-                    else:
-                        train_indices = train_pat_indices
+                    train_indices = train_pat_indices
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_pat_indices, transform=val_transform)
-                dataset_test = TransformableSubset(dataset_for_Kfold, test_pat_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_pat_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
+                dataset_test = CachedTransformableSubset(dataset_for_Kfold, test_pat_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
 
     num_tasks = misc.get_world_size()
     global_rank = misc.get_rank()
@@ -441,10 +440,10 @@ def main(args):
             if args.patient_dataset_type == '3D' or args.patient_dataset_type == '3D_st' or args.patient_dataset_type == '3D_st_joint' or args.patient_dataset_type.startswith('3D'):
                 if args.few_shot:
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_indices, tensor_cache=eval_tensor_cache)
                 else:
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_indices)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_indices, tensor_cache=eval_tensor_cache)
                 dataset_train.update_dataset_transform(train_transform)
                 if args.variable_joint:
                     dataset_train.update_dataset_transform_high_res(train_transform_high_res)
@@ -452,10 +451,10 @@ def main(args):
             elif args.patient_dataset_type == 'Center2D' or args.patient_dataset_type == 'Center2D_flash_attn':
                 if args.few_shot:
                     dataset_train = TransformableSubset(dataset_for_Kfold, val_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, train_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, train_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
                 else:
                     dataset_train = TransformableSubset(dataset_for_Kfold, train_indices, transform=train_transform)
-                    dataset_val = TransformableSubset(dataset_for_Kfold, val_indices, transform=val_transform)
+                    dataset_val = CachedTransformableSubset(dataset_for_Kfold, val_indices, transform=val_transform, tensor_cache=eval_tensor_cache)
             dataset_test = dataset_val
             sampler_train = torch.utils.data.DistributedSampler(
                 dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
@@ -484,7 +483,10 @@ def main(args):
                 dataset_train, sampler=sampler_train,
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
+                persistent_workers=args.persistent_workers and args.num_workers > 0,
+                prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=True,
             )
 
@@ -492,7 +494,10 @@ def main(args):
                 dataset_val, sampler=sampler_val,
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
+                persistent_workers=args.persistent_workers and args.num_workers > 0,
+                prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -500,7 +505,10 @@ def main(args):
                 dataset_test, sampler=sampler_test,
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
+                persistent_workers=args.persistent_workers and args.num_workers > 0,
+                prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -683,7 +691,7 @@ def main(args):
             if args.eval:
                 test_mode = f'test_fold_{fold}'
                 init_csv_writer(args.task, mode=test_mode)
-                test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args)
+                test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                 if args.return_bal_acc:
                     test_auc_pr, test_bal_acc = auc_pr
                 exit(0)
@@ -716,7 +724,8 @@ def main(args):
                     optimizer, device, epoch, loss_scaler,
                     args.clip_grad, mixup_fn,
                     log_writer=log_writer,
-                    args=args
+                    args=args,
+                    batch_transform=train_batch_transform
                 )
                 if train_stats is None:
                     # downscale the learning rate by 2
@@ -736,7 +745,7 @@ def main(args):
                     disease_list = None
 
                 try:
-                    val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                    val_stats, val_auc_roc, val_auc_pr = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                     if args.return_bal_acc:
                         val_auc_pr, val_bal_acc = val_auc_pr
                 except ValueError as e:
@@ -796,7 +805,7 @@ def main(args):
                     test_mode = f'test_fold_{fold}'
                     init_csv_writer(args.task, mode=test_mode)
                     try:
-                        test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                        test_stats, test_auc_roc, test_auc_pr = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                         if args.return_bal_acc:
                             test_auc_pr, test_bal_acc = test_auc_pr
                     except ValueError as e:
@@ -921,9 +930,17 @@ def main(args):
         if not args.slivit_exp:
             print(f"Start train val test for {len(train_pat_indices)} train, {len(val_pat_indices)} val, {len(test_pat_indices)} test")
 
-            sampler_train = torch.utils.data.DistributedSampler(
-                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
-            )
+            if args.downsample_normal:
+                # a new subset of the normal visits every epoch, drawn by the sampler so the workers can persist
+                normal_visit_idx = set(dataset_for_Kfold.normal_visit_idx)
+                sampler_train = DownsampleNormalSampler(
+                    dataset_train, [i for i, idx in enumerate(dataset_train.indices) if idx in normal_visit_idx], downsample_normal_factor=args.downsample_normal_factor,
+                    num_replicas=num_tasks, rank=global_rank, shuffle=True, seed=args.seed
+                )
+            else:
+                sampler_train = torch.utils.data.DistributedSampler(
+                    dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
+                )
 
             print("Sampler_train = %s" % str(sampler_train))
             if args.dist_eval:
@@ -952,7 +969,10 @@ def main(args):
                 dataset_train, sampler=sampler_train,
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
+                persistent_workers=args.persistent_workers and args.num_workers > 0,
+                prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=True,
             )
 
@@ -960,7 +980,10 @@ def main(args):
                 dataset_val, sampler=sampler_val,
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
+                persistent_workers=args.persistent_workers and args.num_workers > 0,
+                prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -968,7 +991,10 @@ def main(args):
                 dataset_test, sampler=sampler_test,
                 batch_size=args.batch_size,
                 num_workers=args.num_workers,
+                persistent_workers=args.persistent_workers and args.num_workers > 0,
+                prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
                 pin_memory=args.pin_mem,
+                collate_fn=collate_volumes if train_batch_transform is not None else None,
                 drop_last=False
             )
 
@@ -1300,7 +1326,7 @@ def main(args):
         if args.eval:
             test_mode = f'test_singlefold'
             init_csv_writer(args.task, mode=test_mode)
-            test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args)
+            test_stats, auc_roc, auc_pr = evaluate(data_loader_test, model, device, args.task, epoch=0, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=None, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
             if args.return_bal_acc:
                 auc_pr, test_bal_acc = auc_pr
             exit(0)
@@ -1335,14 +1361,15 @@ def main(args):
             early_stop_counter = 0
 
         for epoch in range(args.start_epoch, args.epochs):
-            if args.distributed:
+            if args.distributed or args.downsample_normal:
                 data_loader_train.sampler.set_epoch(epoch)
             train_stats = train_one_epoch(
                 model, criterion, data_loader_train,
                 optimizer, device, epoch, loss_scaler,
                 args.clip_grad, mixup_fn,
                 log_writer=log_writer,
-                args=args
+                args=args,
+                batch_transform=train_batch_transform
             )
 
             if train_stats is None:
@@ -1364,7 +1391,7 @@ def main(args):
                 disease_list = None
 
             try:
-                val_returned_all_results = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                val_returned_all_results = evaluate(data_loader_val, model, device, args.task, epoch, mode=val_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                 if args.task_mode == 'regression':
                     val_stats = val_returned_all_results
                     val_auc_pr = val_stats['r2']
@@ -1442,7 +1469,7 @@ def main(args):
 
             if max_flag or epoch == (args.epochs - 1) or args.always_test:
                 try:
-                    test_returned_all_results = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args)
+                    test_returned_all_results = evaluate(data_loader_test, model, device, args.task, epoch, mode=test_mode, num_class=args.nb_classes, criterion=criterion, task_mode=args.task_mode, disease_list=disease_list, return_bal_acc=args.return_bal_acc, args=args, batch_transform=val_batch_transform)
                     if args.task_mode == 'regression':
                         test_stats = test_returned_all_results
                         test_auc_pr = test_stats['r2']
@@ -1546,27 +1573,6 @@ def main(args):
                     dataset_val.remove_dataset_transform_high_res()
                     dataset_train.update_dataset_transform_high_res(train_transform_high_res)
 
-
-            if args.downsample_normal:
-                dataset_train.dataset.on_epoch_end()
-                if args.few_shot:
-                    adjusted_indices = dataset_for_Kfold.adjusted_indices
-                    val_indices = sorted(list(set(val_pat_indices) & set(adjusted_indices)))
-                    dataset_train.update_indices(val_indices)
-                    data_loader_train.sampler.num_samples = math.ceil(len(dataset_train) / num_tasks)
-                    data_loader_train.sampler.total_size = data_loader_train.sampler.num_samples * num_tasks
-
-                else:
-                    print('len(train_indices) before:', len(train_indices))
-                    adjusted_indices = dataset_for_Kfold.adjusted_indices
-                    print('len(adjusted_indices):', len(adjusted_indices))
-                    print('len(train_pat_indices):', len(train_pat_indices))
-                    train_indices = sorted(list(set(train_pat_indices) & set(adjusted_indices)))
-                    print('len(train_indices) after:', len(train_indices))
-                    dataset_train.update_indices(train_indices)
-                    data_loader_train.sampler.num_samples = math.ceil(len(dataset_train) / num_tasks)
-                    data_loader_train.sampler.total_size = data_loader_train.sampler.num_samples * num_tasks
-
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('Training time {}'.format(total_time_str))
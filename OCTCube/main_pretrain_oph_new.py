@@ -54,6 +54,8 @@ def get_args_parser():
     parser.set_defaults(fp16=True)
     parser.add_argument('--task', default='pretrain/', type=str)
     parser.add_argument('--use_flash_attn', action='store_true', help='Use Flash Attention')
+    parser.add_argument('--attn_backend', default=None, type=str, choices=['flash', 'sdpa', 'naive'], help='attention kernel, defaults to flash if installed for --use_flash_attn, else sdpa')
+    parser.add_argument('--fused_qkv', action='store_true', help='one qkv Linear in the sdpa / naive attention blocks')
     parser.add_argument('--batch_size', default=64, type=int,
                         help='Batch size per GPU (effective batch size is batch_size * accum_iter * # gpus')
     parser.add_argument('--epochs', default=400, type=int)
@@ -159,7 +161,7 @@ def main(args):
     # Loading the dataset
     if args.kermany_only:
         data_dir = home_directory + '/Ophthal/'
-        dataset_train = PatientDatasetCenter2D_inhouse_pretrain(root_dir=data_dir, task_mode='multi_label', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='frame', transform=transform_train, iterate_mode='visit', downsample_width=True, patient_id_list_dir='multi_label_expr_all_0319/')
+        dataset_train = PatientDatasetCenter2D_inhouse_pretrain(root_dir=data_dir, task_mode='multi_label', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='frame', transform=transform_train, iterate_mode='visit', downsample_width=True, patient_id_list_dir='multi_label_expr_all_0319/', return_otsu_mask=False)
         test_pat_id = load_patient_list(args.split_path, split='test', name_suffix='_pat_list.txt')
         included_patient = list(dataset_train.patients.keys())
         filtered_test_pat_id = sorted(list(set(test_pat_id) & set(included_patient)))
@@ -168,7 +170,8 @@ def main(args):
     else:
         datasset_train = []
 
-    dataset_train = Inhouse_and_Kermany_Dataset(dataset_train, dataset_train_kermany)
+    # train_one_epoch only uses the frames, the Otsu masks are not computed
+    dataset_train = Inhouse_and_Kermany_Dataset(dataset_train, dataset_train_kermany, return_otsu_mask=False)
 
 
     if True:  # args.distributed:
@@ -0,0 +1,206 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Linear probing from an embedding store of main_extract_embeddings.py: the heads of the
+# single-fold (--split_path patient lists) or K-fold (same patient folds as
+# main_finetune_downstream_inhouse_singlefold.py) splits are fitted on the cached embeddings for
+# every lr / weight decay of the grid. The epoch with the best val metric of each fit is reported
+# with its test metrics, and the results are written to <output_dir>/probe_results.json.
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.metrics import accuracy_score, average_precision_score, balanced_accuracy_score, roc_auc_score
+from sklearn.model_selection import KFold
+from timm.models.layers import trunc_normal_
+
+from util.datasets import load_patient_list
+from util.embedding_store import load_embedding_store
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Linear probing from cached embeddings', add_help=False)
+    parser.add_argument('--store_dir', required=True, type=str, help='embedding store of main_extract_embeddings.py')
+    parser.add_argument('--output_dir', default='./outputs_probe/', type=str, help='path where to save the results')
+    parser.add_argument('--task_mode', default='binary_cls', type=str, choices=['binary_cls', 'multi_cls', 'multi_label'], help='Task mode for the dataset')
+    parser.add_argument('--nb_classes', default=2, type=int, help='number of the classification types')
+    parser.add_argument('--val_metric', default='AUPRC', type=str, choices=['AUC', 'ACC', 'AUPRC'], help='Validation metric for the epoch selection')
+
+    # splits, as in main_finetune_downstream_inhouse_singlefold.py
+    parser.add_argument('--single_fold', default=False, action='store_true', help='use the train/val/test patient lists of --split_path')
+    parser.add_argument('--split_path', default=None, type=str, help='split path storing the train/val/test split of patient files')
+    parser.add_argument('--few_shot', default=False, action='store_true', help='train on the val split and validate on the train split')
+    parser.add_argument('--k_fold', default=False, action='store_true', help='Use K-fold cross validation')
+    parser.add_argument('--k_folds', default=5, type=int, help='number of folds for K-fold cross validation')
+
+    # head fits
+    parser.add_argument('--lrs', default=[1e-3, 3e-3, 1e-2, 3e-2], nargs='+', type=float, help='learning rate grid')
+    parser.add_argument('--weight_decays', default=[0.0, 1e-4, 1e-2], nargs='+', type=float, help='weight decay grid')
+    parser.add_argument('--epochs', default=100, type=int)
+    parser.add_argument('--batch_size', default=256, type=int, help='batch size of the head fits, 0 for full batch')
+    parser.add_argument('--standardize', default=False, action='store_true', help='standardize the embeddings with the train split statistics')
+    parser.add_argument('--device', default='cuda', help='device to use for the head fits')
+    parser.add_argument('--seed', default=0, type=int)
+    return parser
+
+
+def get_splits(args, patient_ids):
+    """
+    return: list of (name, train rows, val rows, test rows) of the store
+    """
+    patient_ids = np.array(patient_ids)
+    if args.single_fold:
+        splits = []
+        for split in ['train', 'val', 'test']:
+            pat_id = set(load_patient_list(args.split_path, split=split, name_suffix='_pat_list.txt'))
+            splits.append(np.flatnonzero(np.isin(patient_ids, list(pat_id))))
+        train_rows, val_rows, test_rows = splits
+        if args.few_shot:
+            train_rows, val_rows = val_rows, train_rows
+        return [('single_fold', train_rows, val_rows, test_rows)]
+
+    assert args.k_fold, 'set --single_fold or --k_fold'
+    # same patient folds as main_finetune_downstream_inhouse_singlefold.py
+    kf = KFold(n_splits=args.k_folds, shuffle=True, random_state=args.seed)
+    patient_mapping_visit_indices = sorted(set(patient_ids.tolist()))
+    rng = np.random.RandomState(args.seed)
+    patient_mapping_visit_indices = rng.permutation(patient_mapping_visit_indices)
+    splits = []
+    for fold, (idx_train_pat_id, idx_val_pat_id) in enumerate(kf.split(patient_mapping_visit_indices)):
+        train_rows = np.flatnonzero(np.isin(patient_ids, patient_mapping_visit_indices[idx_train_pat_id]))
+        val_rows = np.flatnonzero(np.isin(patient_ids, patient_mapping_visit_indices[idx_val_pat_id]))
+        if args.few_shot:
+            train_rows, val_rows = val_rows, train_rows
+        # the test split of a fold is its val split
+        splits.append((f'fold_{fold}', train_rows, val_rows, val_rows))
+    return splits
+
+
+def compute_metrics(probs, targets, task_mode, num_classes):
+    """
+    return: {'AUC', 'AUPRC', 'ACC', 'balanced_acc'}, macro averages over the classes
+    """
+    if task_mode == 'multi_label':
+        labels_onehot = targets
+        pred = (probs > 0.5).astype(int)
+        acc = accuracy_score(targets.reshape(-1), pred.reshape(-1))
+        balanced_acc = float(np.mean([balanced_accuracy_score(targets[:, i], pred[:, i]) for i in range(targets.shape[1])]))
+    else:
+        labels_onehot = np.eye(num_classes)[targets.astype(int)]
+        pred = probs.argmax(axis=1)
+        acc = accuracy_score(targets, pred)
+        balanced_acc = balanced_accuracy_score(targets, pred)
+    try:
+        auc_roc = roc_auc_score(labels_onehot, probs, multi_class='ovr', average='macro')
+    except ValueError:
+        # a class without positives in the split
+        auc_roc = float('nan')
+    auc_pr = average_precision_score(labels_onehot, probs, average='macro')
+    return {'AUC': float(auc_roc), 'AUPRC': float(auc_pr), 'ACC': float(acc), 'balanced_acc': float(balanced_acc)}
+
+
+@torch.no_grad()
+def predict(head, x, task_mode):
+    head.eval()
+    logits = head(x)
+    probs = torch.sigmoid(logits) if task_mode == 'multi_label' else torch.softmax(logits, dim=1)
+    return probs.cpu().numpy()
+
+
+def fit_head(args, x_train, y_train, x_val, y_val, x_test, y_test, lr, weight_decay):
+    """
+    Fit a linear head (initialized as the fine-tuning head) with AdamW
+
+    return: metrics of the epoch with the best val metric: {'epoch', 'val': {...}, 'test': {...}}
+    """
+    torch.manual_seed(args.seed)
+    head = nn.Linear(x_train.shape[1], args.nb_classes).to(x_train.device)
+    trunc_normal_(head.weight, std=2e-5)
+    nn.init.zeros_(head.bias)
+    optimizer = torch.optim.AdamW(head.parameters(), lr=lr, weight_decay=weight_decay)
+    if args.task_mode == 'multi_label':
+        criterion = nn.BCEWithLogitsLoss()
+        y_train_t = y_train.float()
+    else:
+        criterion = nn.CrossEntropyLoss()
+        y_train_t = y_train.long()
+
+    y_val_np, y_test_np = y_val.cpu().numpy(), y_test.cpu().numpy()
+    batch_size = args.batch_size if args.batch_size > 0 else len(x_train)
+    generator = torch.Generator(device='cpu').manual_seed(args.seed)
+    best = None
+    for epoch in range(args.epochs):
+        head.train()
+        perm = torch.randperm(len(x_train), generator=generator).to(x_train.device)
+        for start in range(0, len(x_train), batch_size):
+            rows = perm[start:start + batch_size]
+            loss = criterion(head(x_train[rows]), y_train_t[rows])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        val_metrics = compute_metrics(predict(head, x_val, args.task_mode), y_val_np, args.task_mode, args.nb_classes)
+        if best is None or val_metrics[args.val_metric] > best['val'][args.val_metric]:
+            test_metrics = compute_metrics(predict(head, x_test, args.task_mode), y_test_np, args.task_mode, args.nb_classes)
+            best = {'epoch': epoch, 'val': val_metrics, 'test': test_metrics}
+    return best
+
+
+def main(args):
+    device = torch.device(args.device)
+    embeddings, targets, index = load_embedding_store(args.store_dir)
+    print('Embedding store %s: %d samples, dim %d' % (args.store_dir, index['num_samples'], index['embed_dim']))
+    # the store is small ([N, D] float16), the fits run on the device from one float32 copy
+    x_all = torch.from_numpy(np.asarray(embeddings, dtype=np.float32)).to(device)
+    y_all = torch.from_numpy(targets).to(device)
+
+    results = {'args': vars(args), 'splits': {}}
+    start_time = time.time()
+    for name, train_rows, val_rows, test_rows in get_splits(args, index['patient_id']):
+        print('%s: train %d, val %d, test %d' % (name, len(train_rows), len(val_rows), len(test_rows)))
+        x_train, x_val, x_test = x_all[train_rows], x_all[val_rows], x_all[test_rows]
+        if args.standardize:
+            mean, std = x_train.mean(dim=0), x_train.std(dim=0).clamp_min(1e-6)
+            x_train, x_val, x_test = (x_train - mean) / std, (x_val - mean) / std, (x_test - mean) / std
+
+        split_results = {}
+        for lr in args.lrs:
+            for weight_decay in args.weight_decays:
+                best = fit_head(args, x_train, y_all[train_rows], x_val, y_all[val_rows], x_test, y_all[test_rows], lr, weight_decay)
+                split_results[f'lr_{lr}_wd_{weight_decay}'] = best
+                print('%s lr %g wd %g: best epoch %d, val %s %.4f, test AUC %.4f AUPRC %.4f ACC %.4f' % (
+                    name, lr, weight_decay, best['epoch'], args.val_metric, best['val'][args.val_metric],
+                    best['test']['AUC'], best['test']['AUPRC'], best['test']['ACC']))
+        results['splits'][name] = split_results
+
+    # grid point with the best mean val metric over the splits
+    configs = list(next(iter(results['splits'].values())).keys())
+    mean_val = {config: np.mean([split[config]['val'][args.val_metric] for split in results['splits'].values()]) for config in configs}
+    best_config = max(configs, key=lambda config: mean_val[config])
+    summary = {'config': best_config}
+    for metric in ['AUC', 'AUPRC', 'ACC', 'balanced_acc']:
+        values = [split[best_config]['test'][metric] for split in results['splits'].values()]
+        summary[metric] = {'mean': float(np.mean(values)), 'std': float(np.std(values))}
+    results['best'] = summary
+    print('Best %s (mean val %s %.4f): test AUC %.4f +- %.4f, AUPRC %.4f +- %.4f, %d fits in %.1fs' % (
+        best_config, args.val_metric, mean_val[best_config], summary['AUC']['mean'], summary['AUC']['std'],
+        summary['AUPRC']['mean'], summary['AUPRC']['std'], len(configs) * len(results['splits']), time.time() - start_time))
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, 'probe_results.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
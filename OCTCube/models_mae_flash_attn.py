@@ -21,7 +21,10 @@ from einops import rearrange
 from collections import OrderedDict
 
 import timm.models.vision_transformer
-from flash_attn.models.vit import create_block
+try:
+    from flash_attn.models.vit import create_block
+except ImportError:
+    create_block = None
 
 from timm.models.vision_transformer import Block
 from timm.layers import to_2tuple
@@ -29,19 +32,19 @@ from timm.layers import to_2tuple
 try:
     # Case 1: Running from OCTCubeM/
     from util.misc import master_print as print
-    from util.video_vit import Attention, Block, PatchEmbed
+    from util.video_vit import Attention, Block, PatchEmbed, PrenormBlock, check_attention_keys_loaded, convert_flash_to_qkv_state_dict, resolve_attention_backend
     from util.pos_embed import get_2d_sincos_pos_embed
 except ModuleNotFoundError:
     try:
         # Case 2: Running from OCTCube/
         from .util.misc import master_print as print
-        from .util.video_vit import Attention, Block, PatchEmbed
+        from .util.video_vit import Attention, Block, PatchEmbed, PrenormBlock, check_attention_keys_loaded, convert_flash_to_qkv_state_dict, resolve_attention_backend
         from .util.pos_embed import get_2d_sincos_pos_embed
     except ImportError:
         # Case 3: Running standalone, fix path
         sys.path.append('../')  # Add OCTCubeM/ to path
         from util.misc import master_print as print
-        from util.video_vit import Attention, Block, PatchEmbed
+        from util.video_vit import Attention, Block, PatchEmbed, PrenormBlock, check_attention_keys_loaded, convert_flash_to_qkv_state_dict, resolve_attention_backend
         from util.pos_embed import get_2d_sincos_pos_embed
 
 
@@ -77,13 +80,18 @@ class MaskedAutoencoderViT(nn.Module):
                  mlp_ratio=4., norm_layer=nn.LayerNorm, norm_pix_loss=False,
                  global_pool=True, cls_embed=True, use_flash_attn=True,
                  no_qkv_bias=False,qk_scale=None, drop_rate=0.0,
-                 attn_drop_rate=0.0, drop_path_rate=0.0, **kwargs):
+                 attn_drop_rate=0.0, drop_path_rate=0.0, attn_backend=None, fused_qkv=False, **kwargs):
         super().__init__()
 
         # --------------------------------------------------------------------------
         # MAE encoder specifics
 
+        # use_flash_attn: flash-attn block structure, attn_backend: attention kernel (flash, sdpa, naive),
+        # fused_qkv: one qkv Linear in the sdpa / naive blocks
         self.use_flash_attn = use_flash_attn
+        self.attn_backend = resolve_attention_backend(attn_backend, use_flash_attn)
+        if self.use_flash_attn and self.attn_backend == "flash":
+            assert create_block is not None, "flash_attn is not installed, use attn_backend='sdpa'"
         self.global_pool = global_pool
         self.embed_dim = embed_dim
         self.depth = depth
@@ -97,13 +105,10 @@ class MaskedAutoencoderViT(nn.Module):
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim), requires_grad=False)  # fixed sin-cos embedding
 
 
-        if self.use_flash_attn:
-
-            dpr = [
-                    x.item() for x in torch.linspace(0, drop_path_rate, depth)
-                ]  # stochastic depth decay rule
-
-
+        dpr = [
+                x.item() for x in torch.linspace(0, drop_path_rate, depth)
+            ]  # stochastic depth decay rule
+        if self.use_flash_attn and self.attn_backend == "flash":
             self.blocks = nn.ModuleList(
             [
                 create_block(
@@ -127,9 +132,15 @@ class MaskedAutoencoderViT(nn.Module):
                 )
                 for i in range(depth)
             ])
+        elif self.use_flash_attn:
+            self.blocks = nn.ModuleList([
+                PrenormBlock(embed_dim, num_heads, mlp_ratio, qkv_bias=not no_qkv_bias, drop=drop_rate, attn_drop=attn_drop_rate,
+                    drop_path1=dpr[i - 1] if i > 0 else 0.0, drop_path2=dpr[i], norm_layer=norm_layer,
+                    attn_func=partial(Attention, attn_backend=self.attn_backend, fused_qkv=fused_qkv))
+                for i in range(depth)])
         else:
             self.blocks = nn.ModuleList([
-            Block(embed_dim, num_heads, mlp_ratio, qkv_bias=True, qk_norm=None, norm_layer=norm_layer)
+            Block(embed_dim, num_heads, mlp_ratio, qkv_bias=True, norm_layer=norm_layer, attn_func=partial(Attention, attn_backend=self.attn_backend, fused_qkv=fused_qkv))
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
         # --------------------------------------------------------------------------
@@ -142,10 +153,10 @@ class MaskedAutoencoderViT(nn.Module):
 
         self.decoder_pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, decoder_embed_dim), requires_grad=False)  # fixed sin-cos embedding
 
-        if self.use_flash_attn:
-            dpr = [
-                x.item() for x in torch.linspace(0, drop_path_rate, decoder_depth)
-            ]
+        dpr = [
+            x.item() for x in torch.linspace(0, drop_path_rate, decoder_depth)
+        ]
+        if self.use_flash_attn and self.attn_backend == "flash":
             self.decoder_blocks = nn.ModuleList(
             [
                 create_block(
@@ -169,9 +180,15 @@ class MaskedAutoencoderViT(nn.Module):
                 )
                 for i in range(decoder_depth)
             ])
+        elif self.use_flash_attn:
+            self.decoder_blocks = nn.ModuleList([
+                PrenormBlock(decoder_embed_dim, decoder_num_heads, mlp_ratio, qkv_bias=not no_qkv_bias, drop=drop_rate, attn_drop=attn_drop_rate,
+                    drop_path1=dpr[i - 1] if i > 0 else 0.0, drop_path2=dpr[i], norm_layer=norm_layer,
+                    attn_func=partial(Attention, attn_backend=self.attn_backend, fused_qkv=fused_qkv))
+                for i in range(decoder_depth)])
         else:
             self.decoder_blocks = nn.ModuleList([
-                Block(decoder_embed_dim, decoder_num_heads, mlp_ratio, qkv_bias=True, qk_norm=None, norm_layer=norm_layer)
+                Block(decoder_embed_dim, decoder_num_heads, mlp_ratio, qkv_bias=True, norm_layer=norm_layer, attn_func=partial(Attention, attn_backend=self.attn_backend, fused_qkv=fused_qkv))
                 for i in range(decoder_depth)])
         self.decoder_norm = norm_layer(decoder_embed_dim)
         self.decoder_pred = nn.Linear(decoder_embed_dim, patch_size**2 * in_chans, bias=True) # decoder to patch
@@ -369,6 +386,12 @@ class MaskedAutoencoderViT(nn.Module):
         else:
             print("Skip loading patch_embed.proj.weight")
 
+        if not (self.use_flash_attn and self.attn_backend == "flash"):
+            # sdpa / naive blocks take the attn.q / attn.k / attn.v weights, flash-attn checkpoints are mapped back
+            state_dict = convert_flash_to_qkv_state_dict(state_dict)
+            state_dict = {k: v for k, v in state_dict.items() if not any([f in k for f in filter_keys])}
+            return check_attention_keys_loaded(super().load_state_dict(state_dict, strict=strict))
+
         def key_mapping_attn(key):
             key = re.sub(r"blocks.(\d+).attn.proj.", r"blocks.\1.mixer.out_proj.", key)
             return key
@@ -444,9 +467,13 @@ class MaskedAutoencoderViT(nn.Module):
                 state_dict[f"decoder_blocks.{i}.mixer.Wqkv.weight"] = Wqkv
                 state_dict[f"decoder_blocks.{i}.mixer.Wqkv.bias"] = bqkv
 
+        if not (self.use_flash_attn and self.attn_backend == "flash"):
+            # split the fused qkv for the sdpa / naive blocks
+            state_dict = convert_flash_to_qkv_state_dict(state_dict)
+
         # filter out pos_embed and patch_embed
         state_dict = {k: v for k, v in state_dict.items() if not any([f in k for f in filter_keys])}
-        return super().load_state_dict(state_dict, strict=strict)
+        return check_attention_keys_loaded(super().load_state_dict(state_dict, strict=strict))
 
 def mae_vit_large_patch16_dec512d8b(**kwargs):
     model = MaskedAutoencoderViT(
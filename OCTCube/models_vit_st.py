@@ -29,16 +29,19 @@ try:
     # Case 1: Running from OCTCubeM/
     from util.misc import master_print as print
     from util.video_vit import Attention, Block, PatchEmbed
+    from util.pos_embed import PosEmbedCache, get_pos_embed_params
 except ModuleNotFoundError:
     try:
         # Case 2: Running from OCTCube/
         from .util.misc import master_print as print
         from .util.video_vit import Attention, Block, PatchEmbed
+        from .util.pos_embed import PosEmbedCache, get_pos_embed_params
     except ImportError:
         # Case 3: Running standalone, fix path
         sys.path.append('../')  # Add OCTCubeM/ to path
         from util.misc import master_print as print
         from util.video_vit import Attention, Block, PatchEmbed
+        from util.pos_embed import PosEmbedCache, get_pos_embed_params
 
 
 
@@ -75,6 +78,7 @@ class VisionTransformer(nn.Module):
         print(locals())
         self.global_pool = global_pool
         self.sep_pos_embed = sep_pos_embed
+        self.pos_embed_cache = PosEmbedCache()
         # --------------------------------------------------------------------------
         # MAE encoder specifics
         self.patch_embed = PatchEmbed(
@@ -147,6 +151,27 @@ class VisionTransformer(nn.Module):
             "pos_embed_class",
         }
 
+    def build_sep_pos_embed(self):
+        """
+        return: [1, (1 +) T * H * W, C] pos embed of the separable spatial / temporal (/ class) pos embeds
+        """
+        pos_embed = self.pos_embed_spatial.repeat(
+            1, self.input_size[0], 1
+        ) + torch.repeat_interleave(
+            self.pos_embed_temporal,
+            self.input_size[1] * self.input_size[2],
+            dim=1,
+        )
+        if self.cls_embed:
+            pos_embed = torch.cat(
+                [
+                    self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
+                    pos_embed,
+                ],
+                1,
+            )
+        return pos_embed
+
     def forward(self, x):
 
         x = self.patch_embed(x)
@@ -161,21 +186,10 @@ class VisionTransformer(nn.Module):
             x = torch.cat((cls_tokens, x), dim=1)
 
         if self.sep_pos_embed:
-            pos_embed = self.pos_embed_spatial.repeat(
-                1, self.input_size[0], 1
-            ) + torch.repeat_interleave(
-                self.pos_embed_temporal,
-                self.input_size[1] * self.input_size[2],
-                dim=1,
+            # rebuilt only when the pos embed parameters change, see PosEmbedCache
+            pos_embed = self.pos_embed_cache.get(
+                tuple(self.input_size), get_pos_embed_params(self), self.build_sep_pos_embed
             )
-            if self.cls_embed:
-                pos_embed = torch.cat(
-                    [
-                        self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
-                        pos_embed,
-                    ],
-                    1,
-                )
         else:
             pos_embed = self.pos_embed[:, :, :]
         x = x + pos_embed
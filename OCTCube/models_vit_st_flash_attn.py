@@ -28,23 +28,29 @@ import torch.nn as nn
 try:
     # Case 1: Running from OCTCubeM/
     from util.misc import master_print as print
-    from util.video_vit import Attention, Block, PatchEmbed
+    from util.video_vit import Attention, Block, PatchEmbed, PrenormBlock, check_attention_keys_loaded, convert_flash_to_qkv_state_dict, resolve_attention_backend, LayerTaps
+    from util.pos_embed import PosEmbedCache, get_pos_embed_params
 except ModuleNotFoundError:
     try:
         # Case 2: Running from OCTCube/
         from .util.misc import master_print as print
-        from .util.video_vit import Attention, Block, PatchEmbed
+        from .util.video_vit import Attention, Block, PatchEmbed, PrenormBlock, check_attention_keys_loaded, convert_flash_to_qkv_state_dict, resolve_attention_backend, LayerTaps
+        from .util.pos_embed import PosEmbedCache, get_pos_embed_params
     except ImportError:
         # Case 3: Running standalone, fix path
         sys.path.append('../')  # Add OCTCubeM/ to path
         from util.misc import master_print as print
-        from util.video_vit import Attention, Block, PatchEmbed
+        from util.video_vit import Attention, Block, PatchEmbed, PrenormBlock, check_attention_keys_loaded, convert_flash_to_qkv_state_dict, resolve_attention_backend, LayerTaps
+        from util.pos_embed import PosEmbedCache, get_pos_embed_params
 
 
 from einops import rearrange
 from collections import OrderedDict
 
-from flash_attn.models.vit import create_block
+try:
+    from flash_attn.models.vit import create_block
+except ImportError:
+    create_block = None
 
 
 
@@ -74,12 +80,15 @@ class VisionTransformer(nn.Module):
         cls_embed=False,
         global_pool=False,
         use_flash_attn=False,
+        attn_backend=None,
+        fused_qkv=False,
         **kwargs,
     ):
         super().__init__()
         print(locals())
         self.global_pool = global_pool
         self.sep_pos_embed = sep_pos_embed
+        self.pos_embed_cache = PosEmbedCache()
         # --------------------------------------------------------------------------
         # MAE encoder specifics
         self.patch_embed = PatchEmbed(
@@ -116,8 +125,12 @@ class VisionTransformer(nn.Module):
             x.item() for x in torch.linspace(0, drop_path_rate, depth)
         ]  # stochastic depth decay rule
 
+        # use_flash_attn: flash-attn block structure, attn_backend: attention kernel (flash, sdpa, naive),
+        # fused_qkv: one qkv Linear in the sdpa / naive blocks
         self.use_flash_attn = use_flash_attn
-        if use_flash_attn:
+        self.attn_backend = resolve_attention_backend(attn_backend, use_flash_attn)
+        if use_flash_attn and self.attn_backend == "flash":
+            assert create_block is not None, "flash_attn is not installed, use attn_backend='sdpa'"
             self.blocks = nn.ModuleList(
             [
                 create_block(
@@ -141,6 +154,30 @@ class VisionTransformer(nn.Module):
                 )
                 for i in range(depth)
             ])
+        elif use_flash_attn:
+            self.blocks = nn.ModuleList(
+                [
+                    PrenormBlock(
+                        embed_dim,
+                        num_heads,
+                        mlp_ratio,
+                        qkv_bias=not no_qkv_bias,
+                        qk_scale=None,
+                        drop=drop_rate,
+                        attn_drop=attn_drop_rate,
+                        drop_path1=dpr[i - 1] if i > 0 else 0.0,
+                        drop_path2=dpr[i],
+                        norm_layer=norm_layer,
+                        attn_func=partial(
+                            Attention,
+                            input_size=self.patch_embed.input_size,
+                            attn_backend=self.attn_backend,
+                            fused_qkv=fused_qkv,
+                        ),
+                    )
+                    for i in range(depth)
+                ]
+            )
         else:
             self.blocks = nn.ModuleList(
                 [
@@ -155,6 +192,8 @@ class VisionTransformer(nn.Module):
                         attn_func=partial(
                             Attention,
                             input_size=self.patch_embed.input_size,
+                            attn_backend=self.attn_backend,
+                            fused_qkv=fused_qkv,
                         ),
                     )
                     for i in range(depth)
@@ -178,7 +217,28 @@ class VisionTransformer(nn.Module):
             "pos_embed_class",
         }
 
-    def forward(self, x, hidden_states=False, return_embeddings=False):
+    def build_sep_pos_embed(self):
+        """
+        return: [1, (1 +) T * H * W, C] pos embed of the separable spatial / temporal (/ class) pos embeds
+        """
+        pos_embed = self.pos_embed_spatial.repeat(
+            1, self.input_size[0], 1
+        ) + torch.repeat_interleave(
+            self.pos_embed_temporal,
+            self.input_size[1] * self.input_size[2],
+            dim=1,
+        )
+        if self.cls_embed:
+            pos_embed = torch.cat(
+                [
+                    self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
+                    pos_embed,
+                ],
+                1,
+            )
+        return pos_embed
+
+    def forward(self, x, hidden_states=False, return_embeddings=False, return_layers=None, tap_fn=None):
         # embed patches
 
         x = self.patch_embed(x)
@@ -193,21 +253,10 @@ class VisionTransformer(nn.Module):
             x = torch.cat((cls_tokens, x), dim=1)
 
         if self.sep_pos_embed:
-            pos_embed = self.pos_embed_spatial.repeat(
-                1, self.input_size[0], 1
-            ) + torch.repeat_interleave(
-                self.pos_embed_temporal,
-                self.input_size[1] * self.input_size[2],
-                dim=1,
+            # rebuilt only when the pos embed parameters change, see PosEmbedCache
+            pos_embed = self.pos_embed_cache.get(
+                tuple(self.input_size), get_pos_embed_params(self), self.build_sep_pos_embed
             )
-            if self.cls_embed:
-                pos_embed = torch.cat(
-                    [
-                        self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
-                        pos_embed,
-                    ],
-                    1,
-                )
         else:
             pos_embed = self.pos_embed[:, :, :]
         x = x + pos_embed
@@ -225,24 +274,28 @@ class VisionTransformer(nn.Module):
         if requires_t_shape:
             x = x.view([N, T, L, C])
 
-        # apply Transformer blocks
-        hidden_states_list = []
+        # apply Transformer blocks, only the outputs of the requested blocks are kept
+        if hidden_states:
+            return_layers = range(len(self.blocks))
+        taps = LayerTaps(return_layers, len(self.blocks), tap_fn) if return_layers is not None else None
         if self.use_flash_attn:
             residual = None
-            for blk in self.blocks:
+            for i, blk in enumerate(self.blocks):
                 x, residual = blk(x, residual)
-                hidden_states_list.append(x)
+                if taps is not None and taps(i, x):
+                    break
         else:
-            for blk in self.blocks:
+            for i, blk in enumerate(self.blocks):
                 x = blk(x)
-                hidden_states_list.append(x)
+                if taps is not None and taps(i, x):
+                    break
 
 
         if requires_t_shape:
             x = x.view([N, T * L, C])
 
-        if hidden_states:
-            return hidden_states_list
+        if taps is not None:
+            return taps.outputs
 
         if self.global_pool:
             x = x[:, 1:, :].mean(dim=1)  # global pool without cls token
@@ -268,6 +321,12 @@ class VisionTransformer(nn.Module):
         else:
             print("Skip loading patch_embed.proj.weight")
 
+        if not (self.use_flash_attn and self.attn_backend == "flash"):
+            # sdpa / naive blocks take the attn.q / attn.k / attn.v weights, flash-attn checkpoints are mapped back
+            state_dict = convert_flash_to_qkv_state_dict(state_dict)
+            state_dict = {k: v for k, v in state_dict.items() if not any([f in k for f in filter_keys])}
+            return check_attention_keys_loaded(super().load_state_dict(state_dict, strict=strict))
+
         def key_mapping_attn(key):
             key = re.sub(r"blocks.(\d+).attn.proj.", r"blocks.\1.mixer.out_proj.", key)
             return key
@@ -22,21 +22,25 @@ from functools import partial
 import sys
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 try:
     # Case 1: Running from OCTCubeM/
     from util.misc import master_print as print
     from util.video_vit import Attention, Block, PatchEmbed
+    from util.pos_embed import PosEmbedCache, get_pos_embed_params
 except ModuleNotFoundError:
     try:
         # Case 2: Running from OCTCube/
         from .util.misc import master_print as print
         from .util.video_vit import Attention, Block, PatchEmbed
+        from .util.pos_embed import PosEmbedCache, get_pos_embed_params
     except ImportError:
         # Case 3: Running standalone, fix path
         sys.path.append('../')  # Add OCTCubeM/ to path
         from util.misc import master_print as print
         from util.video_vit import Attention, Block, PatchEmbed
+        from util.pos_embed import PosEmbedCache, get_pos_embed_params
 
 
 
@@ -73,6 +77,7 @@ class VisionTransformer(nn.Module):
         print(locals())
         self.global_pool = global_pool
         self.sep_pos_embed = sep_pos_embed
+        self.pos_embed_cache = PosEmbedCache()
         # --------------------------------------------------------------------------
         # MAE encoder specifics
         self.patch_embed = PatchEmbed(
@@ -152,6 +157,40 @@ class VisionTransformer(nn.Module):
             "pos_embed_class",
         }
 
+    def build_sep_pos_embed(self, T, high_res):
+        """
+        return: [1, (1 +) T * H * W, C] pos embed of the separable spatial / temporal (/ class) pos
+        embeds, the spatial pos embed is resized from the high-res to the low-res grid if not high_res
+        """
+        if not high_res:
+            # pool pos_embed to match the input size
+            pos_embed = F.interpolate(
+                self.pos_embed_spatial.view(1, self.high_res_input_size[1], self.high_res_input_size[2], -1).permute(0, 3, 1, 2), [self.input_size[1], self.input_size[2]],mode='bicubic', align_corners=False
+            ).permute(0, 2, 3, 1).view(1, self.input_size[1] * self.input_size[2], -1)
+
+            pos_h, pos_w = self.input_size[1], self.input_size[2]
+        else:
+            pos_embed = self.pos_embed_spatial
+            pos_h, pos_w = self.high_res_input_size[1], self.high_res_input_size[2]
+
+        pos_embed = pos_embed.repeat(
+                1, T, 1
+            ) + torch.repeat_interleave(
+                self.pos_embed_temporal,
+                pos_h * pos_w,
+                dim=1,
+            )
+
+        if self.cls_embed:
+            pos_embed = torch.cat(
+                [
+                    self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
+                    pos_embed,
+                ],
+                1,
+            )
+        return pos_embed
+
     def forward(self, x):
 
         H, W = x.shape[-2:]
@@ -173,33 +212,11 @@ class VisionTransformer(nn.Module):
             x = torch.cat((cls_tokens, x), dim=1)
 
         if self.sep_pos_embed:
-            if not high_res:
-                # pool pos_embed to match the input size
-                pos_embed = F.interpolate(
-                    self.pos_embed_spatial.view(1, self.high_res_input_size[1], self.high_res_input_size[2], -1).permute(0, 3, 1, 2), [self.input_size[1], self.input_size[2]],mode='bicubic', align_corners=False
-                ).permute(0, 2, 3, 1).view(1, self.input_size[1] * self.input_size[2], -1)
-
-                pos_h, pos_w = self.input_size[1], self.input_size[2]
-            else:
-                pos_embed = self.pos_embed_spatial
-                pos_h, pos_w = self.high_res_input_size[1], self.high_res_input_size[2]
-
-            pos_embed = pos_embed.repeat(
-                    1, T, 1
-                ) + torch.repeat_interleave(
-                    self.pos_embed_temporal,
-                    pos_h * pos_w,
-                    dim=1,
-                )
-
-            if self.cls_embed:
-                pos_embed = torch.cat(
-                    [
-                        self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
-                        pos_embed,
-                    ],
-                    1,
-                )
+            # rebuilt only when the pos embed parameters change, see PosEmbedCache
+            pos_size = self.high_res_input_size[1:] if high_res else self.input_size[1:]
+            pos_embed = self.pos_embed_cache.get(
+                (T, *pos_size, high_res), get_pos_embed_params(self), partial(self.build_sep_pos_embed, T, high_res)
+            )
         else:
             pos_embed = self.pos_embed[:, :, :]
         x = x + pos_embed
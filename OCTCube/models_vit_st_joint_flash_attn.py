@@ -23,21 +23,25 @@ import sys
 import re
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 try:
     # Case 1: Running from OCTCubeM/
     from util.misc import master_print as print
-    from util.video_vit import Attention, Block, PatchEmbed
+    from util.video_vit import Attention, Block, PatchEmbed, LayerTaps
+    from util.pos_embed import PosEmbedCache, get_pos_embed_params
 except ModuleNotFoundError:
     try:
         # Case 2: Running from OCTCube/
         from .util.misc import master_print as print
-        from .util.video_vit import Attention, Block, PatchEmbed
+        from .util.video_vit import Attention, Block, PatchEmbed, LayerTaps
+        from .util.pos_embed import PosEmbedCache, get_pos_embed_params
     except ImportError:
         # Case 3: Running standalone, fix path
         sys.path.append('../')  # Add OCTCubeM/ to path
         from util.misc import master_print as print
-        from util.video_vit import Attention, Block, PatchEmbed
+        from util.video_vit import Attention, Block, PatchEmbed, LayerTaps
+        from util.pos_embed import PosEmbedCache, get_pos_embed_params
 
 
 from einops import rearrange
@@ -80,6 +84,7 @@ class VisionTransformer(nn.Module):
         print(locals())
         self.global_pool = global_pool
         self.sep_pos_embed = sep_pos_embed
+        self.pos_embed_cache = PosEmbedCache()
         # --------------------------------------------------------------------------
         # MAE encoder specifics
         self.patch_embed = PatchEmbed(
@@ -184,7 +189,42 @@ class VisionTransformer(nn.Module):
             "pos_embed_class",
         }
 
-    def forward(self, x, hidden_states=False):
+    def build_sep_pos_embed(self, T, high_res):
+        """
+        return: [1, (1 +) T * H * W, C] pos embed of the separable spatial / temporal (/ class) pos
+        embeds, the spatial pos embed is resized from the high-res to the low-res grid if not high_res
+        """
+        if not high_res:
+            # pool pos_embed to match the input size
+            pos_embed = F.interpolate(
+                self.pos_embed_spatial.view(1, self.high_res_input_size[1], self.high_res_input_size[2], -1).permute(0, 3, 1, 2), [self.input_size[1], self.input_size[2]],mode='bicubic', align_corners=False
+            ).permute(0, 2, 3, 1).view(1, self.input_size[1] * self.input_size[2], -1)
+
+            pos_h, pos_w = self.input_size[1], self.input_size[2]
+
+        else:
+            pos_embed = self.pos_embed_spatial
+            pos_h, pos_w = self.high_res_input_size[1], self.high_res_input_size[2]
+
+        pos_embed = pos_embed.repeat(
+                1, T, 1
+            ) + torch.repeat_interleave(
+                self.pos_embed_temporal,
+                pos_h * pos_w,
+                dim=1,
+            )
+
+        if self.cls_embed:
+            pos_embed = torch.cat(
+                [
+                    self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
+                    pos_embed,
+                ],
+                1,
+            )
+        return pos_embed
+
+    def forward(self, x, hidden_states=False, return_layers=None, tap_fn=None):
         H, W = x.shape[-2:]
         if H == self.high_res_input_size[1] * self.high_res_patch_embed.patch_size[0]:
             high_res = True
@@ -204,34 +244,11 @@ class VisionTransformer(nn.Module):
             x = torch.cat((cls_tokens, x), dim=1)
 
         if self.sep_pos_embed:
-            if not high_res:
-                # pool pos_embed to match the input size
-                pos_embed = F.interpolate(
-                    self.pos_embed_spatial.view(1, self.high_res_input_size[1], self.high_res_input_size[2], -1).permute(0, 3, 1, 2), [self.input_size[1], self.input_size[2]],mode='bicubic', align_corners=False
-                ).permute(0, 2, 3, 1).view(1, self.input_size[1] * self.input_size[2], -1)
-
-                pos_h, pos_w = self.input_size[1], self.input_size[2]
-
-            else:
-                pos_embed = self.pos_embed_spatial
-                pos_h, pos_w = self.high_res_input_size[1], self.high_res_input_size[2]
-
-            pos_embed = pos_embed.repeat(
-                    1, T, 1
-                ) + torch.repeat_interleave(
-                    self.pos_embed_temporal,
-                    pos_h * pos_w,
-                    dim=1,
-                )
-
-            if self.cls_embed:
-                pos_embed = torch.cat(
-                    [
-                        self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
-                        pos_embed,
-                    ],
-                    1,
-                )
+            # rebuilt only when the pos embed parameters change, see PosEmbedCache
+            pos_size = self.high_res_input_size[1:] if high_res else self.input_size[1:]
+            pos_embed = self.pos_embed_cache.get(
+                (T, *pos_size, high_res), get_pos_embed_params(self), partial(self.build_sep_pos_embed, T, high_res)
+            )
         else:
             pos_embed = self.pos_embed[:, :, :]
         x = x + pos_embed
@@ -248,22 +265,29 @@ class VisionTransformer(nn.Module):
         if requires_t_shape:
             x = x.view([N, T, L, C])
 
-        # apply Transformer blocks
-        hidden_states_list = []
+        # apply Transformer blocks, only the outputs of the requested blocks are kept
+        if hidden_states:
+            return_layers = range(len(self.blocks))
+        taps = LayerTaps(return_layers, len(self.blocks), tap_fn) if return_layers is not None else None
         if self.use_flash_attn:
             residual = None
-            for blk in self.blocks:
+            for i, blk in enumerate(self.blocks):
                 x, residual = blk(x, residual)
-                hidden_states_list.append(x)
+                if taps is not None and taps(i, x):
+                    break
         else:
-            for blk in self.blocks:
+            for i, blk in enumerate(self.blocks):
                 x = blk(x)
-                hidden_states_list.append(x)
+                if taps is not None and taps(i, x):
+                    break
 
 
         if requires_t_shape:
             x = x.view([N, T * L, C])
 
+        if taps is not None:
+            return taps.outputs
+
         if self.global_pool:
             x = x[:, 1:, :].mean(dim=1)  # global pool without cls token
             outcome = self.norm(x)
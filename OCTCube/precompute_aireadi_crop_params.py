@@ -0,0 +1,76 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Precompute the crop params of the AI-READI Topcon (Maestro2 / Triton) OCT volumes in parallel
+# and write them to a sidecar tsv under retinal_oct/. PatientDataset3D loads it with
+# aireadi_crop_params_tsv, so __getitem__ directly uses the params instead of recomputing them
+# in every DataLoader worker.
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import pandas as pd
+import pydicom
+
+from util.PatientDataset import get_topcon_crop_params, topcon_crop_param_keys
+
+home_directory = os.getenv('HOME')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Precompute AI-READI Topcon crop params', add_help=False)
+    parser.add_argument('--data_path', default=home_directory + '/AI-READI/', type=str, help='AI-READI dataset path')
+    parser.add_argument('--output_tsv', default='topcon_crop_params.tsv', type=str, help='output tsv, under retinal_oct/')
+    parser.add_argument('--num_workers', default=16, type=int, help='number of decoding processes')
+    parser.add_argument('--overwrite', default=False, action='store_true', help='recompute the files already in the output tsv')
+    return parser
+
+
+def compute_crop_params(item):
+    dataset_directory, file_path, manufacturers_model_name = item
+    volume = pydicom.dcmread(dataset_directory + file_path).pixel_array
+    crop_params = get_topcon_crop_params(volume, manufacturers_model_name)
+    crop_params['file_path'] = file_path
+    return crop_params
+
+
+def main(args):
+    dataset_directory = args.data_path + 'dataset/'
+    retinal_oct_directory = dataset_directory + 'retinal_oct/'
+    output_tsv = retinal_oct_directory + args.output_tsv
+
+    oct_manifest_df = pd.read_csv(retinal_oct_directory + 'manifest.tsv', sep='\t')
+    topcon_df = oct_manifest_df[oct_manifest_df['manufacturer'] == 'Topcon']
+    items = [(dataset_directory, row['filepath'], row['manufacturers_model_name']) for _, row in topcon_df.iterrows()]
+
+    rows = []
+    if os.path.exists(output_tsv) and not args.overwrite:
+        existing_df = pd.read_csv(output_tsv, sep='\t')
+        rows = existing_df.to_dict('records')
+        done = set(existing_df['file_path'])
+        items = [item for item in items if item[1] not in done]
+    print('Computing crop params of %d Topcon dicom files, %d already in %s' % (len(items), len(rows), output_tsv))
+
+    start_time = time.time()
+    with Pool(args.num_workers) as pool:
+        for i, crop_params in enumerate(pool.imap_unordered(compute_crop_params, items, chunksize=4)):
+            rows.append(crop_params)
+            if (i + 1) % 100 == 0:
+                print('%d/%d files, %.1f files/s' % (i + 1, len(items), (i + 1) / (time.time() - start_time)))
+
+    crop_params_df = pd.DataFrame(rows, columns=['file_path'] + topcon_crop_param_keys)
+    # write then rename, an interrupted run keeps the previous tsv
+    crop_params_df.to_csv(output_tsv + '.tmp', sep='\t', index=False)
+    os.replace(output_tsv + '.tmp', output_tsv)
+    print('Saved crop params of %d files to %s' % (len(crop_params_df), output_tsv))
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -22,6 +22,11 @@ from skimage import filters
 from skimage import exposure
 from skimage import io
 import math
+from .visit_index import get_patient_sample, set_visit_index
+from .manifest_cache import DirectoryManifest, get_manifest_path
+from .dicom_reader import DicomFrameReader, read_dicom_pixel_array
+from .tensor_cache import get_transform_fingerprint
+from .topcon_crop import apply_topcon_crop_params, topcon_crop_param_keys
 
 home_directory = os.getenv('HOME') + '/'
 
@@ -64,6 +69,33 @@ def create_3d_transforms(input_size, num_frames=64, RandFlipd_prob=0.5, RandRota
 
     return train_transform, val_transform
 
+def average_pairs(volume, dim):
+    """
+    Halve the size of dim by averaging neighbouring pairs, in the dtype of the volume:
+    integer volumes are averaged with rounding, without the float64 promotion of numpy
+    """
+    pairs = volume.unflatten(dim, (-1, 2))
+    pair_dim = dim if dim < 0 else dim + 1
+    first, second = pairs.select(pair_dim, 0), pairs.select(pair_dim, 1)
+    if volume.is_floating_point():
+        return (first + second) / 2
+    return ((first.to(torch.int32) + second + 1) // 2).to(volume.dtype)
+
+
+def convert_volume_dtype(volume, volume_dtype):
+    """
+    volume: float volume in [0, 1], or integer volume in [0, 255]
+    return: the volume in volume_dtype, 'uint8' (0-255) or a float dtype (0-1)
+    """
+    if volume_dtype == 'uint8':
+        if volume.is_floating_point():
+            return volume.clamp(0, 1).mul(255).round_().to(torch.uint8)
+        return volume.to(torch.uint8)
+    if not volume.is_floating_point():
+        volume = volume.float() / 255.0
+    return volume.to(getattr(torch, volume_dtype))
+
+
 class TransformableSubset(Dataset):
     def __init__(self, dataset, indices, transform=None):
         self.dataset = dataset
@@ -99,15 +131,64 @@ class TransformableSubset(Dataset):
         self.indices = indices
 
 
+class CachedTransformableSubset(TransformableSubset):
+    def __init__(self, dataset, indices, transform=None, tensor_cache=None):
+        """
+        TransformableSubset of the val / test splits that caches the transformed tensors in a
+        TensorCache, so the deterministic transforms (e.g., monai Resized) run once per visit
+        instead of at every evaluation epoch and fold. The cache key is the dataset idx and a
+        fingerprint of the subset and dataset transforms, so switching dataset.transform between
+        train and val transforms never returns stale tensors; random transforms are not cached.
+
+        Args:
+            dataset (Dataset): dataset returning (x, y)
+            indices (list): indices of the subset in the dataset
+            transform (callable): transform applied to x
+            tensor_cache (TensorCache): shared cache, None to behave as TransformableSubset
+        """
+        super().__init__(dataset, indices, transform=transform)
+        self.tensor_cache = tensor_cache
+        self.fingerprint_transforms = None
+        self.fingerprint = None
+
+    def get_fingerprint(self):
+        transforms = (self.transform, getattr(self.dataset, 'transform', None), getattr(self.dataset, 'high_res_transform', None))
+        if self.fingerprint_transforms is None or any(a is not b for a, b in zip(transforms, self.fingerprint_transforms)):
+            fingerprint = get_transform_fingerprint(*transforms)
+            if fingerprint is not None:
+                dataset_id = (type(self.dataset).__name__, len(self.dataset), getattr(self.dataset, 'root_dir', None), getattr(self.dataset, 'transform_type', None))
+                fingerprint = get_transform_fingerprint(fingerprint, dataset_id)
+            self.fingerprint_transforms = transforms
+            self.fingerprint = fingerprint
+        return self.fingerprint
+
+    def __getitem__(self, idx):
+        if self.tensor_cache is None:
+            return super().__getitem__(idx)
+        fingerprint = self.get_fingerprint()
+        if fingerprint is None:
+            return super().__getitem__(idx)
+        dataset_idx = self.indices[idx]
+        cached = self.tensor_cache.get(fingerprint, dataset_idx)
+        if cached is not None:
+            return cached
+        x, y = super().__getitem__(idx)
+        self.tensor_cache.put(fingerprint, dataset_idx, x, y)
+        return x, y
+
+
 class PatientDataset3D(Dataset):
     def __init__(self, root_dir, patient_idx_loc, dataset_mode='frame', transform=None, return_patient_id=False,
         convert_to_tensor=False, name_split_char='_', cls_unique=True, iterate_mode='patient', volume_resize=(224, 224), shift_mean_std=False,
-        downsample_width=True, max_frames=None, visit_idx_loc=None, visit_list=None, transform_type='frame_2D', mode='rgb', same_3_frames=False, aireadi_location='All', aireadi_split='train', aireadi_device='All', aireadi_pre_patient_cohort='All', aireadi_normalize_retfound=False, aireadi_abnormal_file_tsv=None, random_shuffle_patient=True, **kwargs):
+        downsample_width=True, max_frames=None, visit_idx_loc=None, visit_list=None, transform_type='frame_2D', mode='rgb', same_3_frames=False, aireadi_location='All', aireadi_split='train', aireadi_device='All', aireadi_pre_patient_cohort='All', aireadi_normalize_retfound=False, aireadi_abnormal_file_tsv=None, random_shuffle_patient=True, manifest_cache=False, aireadi_crop_params_tsv=None, dicom_decode_threads=4, volume_dtype='float32', **kwargs):
         """
         Args:
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied on a sample.
             cls_unique (bool): If True, the patient_id will be unique across classes.
+            volume_dtype (str): dtype of the returned volumes, 'float32' / 'float16' in [0, 1] or 'uint8' in [0, 255]
+                (normalized on the device, see util.batch_augment.normalize_volumes); with 'uint8', the transform
+                must accept uint8 volumes (e.g., util.batch_augment.RawVolumed)
         """
         self.root_dir = root_dir
         self.transform = transform
@@ -127,6 +208,12 @@ class PatientDataset3D(Dataset):
         # options for visit mode, only used for frame dataset, default is None
         self.visit_idx_loc = visit_idx_loc
         self.visit_list = visit_list
+        # cache the directory listings of _get_patients next to root_dir
+        self.manifest_cache = manifest_cache
+        # threads decoding the frames of a compressed dicom volume, per DataLoader worker
+        self.dicom_decode_threads = dicom_decode_threads
+        assert volume_dtype in ['float32', 'float16', 'uint8']
+        self.volume_dtype = volume_dtype
 
         self.aireadi_abnormal_file_tsv = aireadi_abnormal_file_tsv
 
@@ -160,10 +247,16 @@ class PatientDataset3D(Dataset):
 
             self.patients, self.class_to_idx, self.visits_dict, self.mapping_patient2visit = self._get_patients(0)
             self.mapping_visit2patient = {visit_idx: patient_id for patient_id, visit_idx_list in self.mapping_patient2visit.items() for visit_idx in visit_idx_list}
+            if aireadi_crop_params_tsv is not None:
+                self._load_topcon_crop_params(aireadi_crop_params_tsv)
 
             self.shift_mean_std = shift_mean_std
             self.aireadi_normalize_retfound = aireadi_normalize_retfound
 
+        if self.dataset_mode in ['frame', 'volume', 'dicom_aireadi']:
+            # columnar index of the samples, the dicts above become views of it
+            set_visit_index(self)
+
         self.transform_type = transform_type
         self.same_3_frames = same_3_frames
 
@@ -240,6 +333,18 @@ class PatientDataset3D(Dataset):
             print('Number of abnormal dicom files:', len(abnormal_oct_file_list))
 
 
+    def _load_topcon_crop_params(self, crop_params_tsv):
+        # Topcon crop params precomputed by precompute_aireadi_crop_params.py, so __getitem__ directly uses them
+        crop_params = load_topcon_crop_params(self.retinal_oct_directory + crop_params_tsv)
+        num_loaded = 0
+        for data_dict in self.visits_dict.values():
+            for oct_metadata in data_dict['oct_metadata']:
+                if oct_metadata['filepath'] in crop_params:
+                    oct_metadata.update(crop_params[oct_metadata['filepath']])
+                    num_loaded += 1
+        print('Loaded Topcon crop params of %d dicom files from %s' % (num_loaded, crop_params_tsv))
+
+
     def _get_aireadi_setting(self, split='train', device_model_name='All', location='All', pre_patient_cohort='All'):
         # split: 'train', 'val', 'test'
         # device_model_name: 'Spectralis', 'Maestro2', 'Triton', 'All'
@@ -348,15 +453,18 @@ class PatientDataset3D(Dataset):
 
     def _get_patients(self, patient_idx_loc):
         patients = {}
-        class_names = os.listdir(self.root_dir)
+        # with manifest_cache, directory listings come from the manifest cache, only changed class directories are listed again
+        manifest = DirectoryManifest(self.root_dir, cache_path=get_manifest_path(self.root_dir, self.manifest_cache) if self.dataset_mode != 'dicom_aireadi' else None)
+        class_names = manifest.names
         class_to_idx = {cls_name: idx for idx, cls_name in enumerate(class_names)}
         if self.dataset_mode == 'frame':
             if self.iterate_mode == 'patient':
-                for cls_dir in os.listdir(self.root_dir):
+                for cls_dir in class_names:
                     cls_path = os.path.join(self.root_dir, cls_dir)
-                    if os.path.isdir(cls_path):
-                        for img_name in os.listdir(cls_path):
-                            patient_id, frame_index = img_name.split(self.name_split_char)[patient_idx_loc], img_name.split(self.name_split_char)[patient_idx_loc + 1]
+                    if manifest.isdir(cls_dir):
+                        for img_name in manifest.listdir(cls_dir):
+                            name_parts = img_name.split(self.name_split_char)
+                            patient_id, frame_index = name_parts[patient_idx_loc], name_parts[patient_idx_loc + 1]
                             if self.cls_unique:
                                 unique_patient_id = f"{cls_dir}_{patient_id}"
                             else:
@@ -381,13 +489,14 @@ class PatientDataset3D(Dataset):
                 visit_idx = 0
                 visit_id_map2visit_idx = {}
                 assert self.visit_idx_loc is not None or self.visit_list is not None
-                for cls_dir in os.listdir(self.root_dir):
+                for cls_dir in class_names:
                     cls_path = os.path.join(self.root_dir, cls_dir)
-                    if os.path.isdir(cls_path):
-                        for img_name in os.listdir(cls_path):
-                            patient_id = img_name.split(self.name_split_char)[patient_idx_loc]
+                    if manifest.isdir(cls_dir):
+                        for img_name in manifest.listdir(cls_dir):
+                            name_parts = img_name.split(self.name_split_char)
+                            patient_id = name_parts[patient_idx_loc]
                             if self.visit_idx_loc is not None:
-                                visit_id = img_name.split(self.name_split_char)[self.visit_idx_loc]
+                                visit_id = name_parts[self.visit_idx_loc]
                             else:
                                 raise ValueError('visit_list must be provided [temporarily]')
 
@@ -436,10 +545,10 @@ class PatientDataset3D(Dataset):
             mapping_patient2visit = {}
             visit_idx = 0
 
-            for cls_dir in os.listdir(self.root_dir):
+            for cls_dir in class_names:
                 cls_path = os.path.join(self.root_dir, cls_dir)
-                if os.path.isdir(cls_path):
-                    for img_name in os.listdir(cls_path):
+                if manifest.isdir(cls_dir):
+                    for img_name in manifest.listdir(cls_dir):
                         patient_id = img_name.split(self.name_split_char)[patient_idx_loc]
                         if self.cls_unique:
                             unique_patient_id = f"{cls_dir}_{patient_id}"
@@ -502,6 +611,35 @@ class PatientDataset3D(Dataset):
         return visit_idx_list
 
 
+    def get_visit_shape(self, idx):
+        """
+        Shape of the volume of idx as returned by __getitem__ before the transform, from the
+        metadata (the AI-READI manifest resolution, the npy header, or the first frame header),
+        without decoding the pixels; used to bucket the visits by shape (see util.bucket_sampler)
+        return: (T, H, W)
+        """
+        data_dict = get_patient_sample(self, idx)[1] if self.iterate_mode == 'patient' else self.visits_dict[idx]
+        if self.dataset_mode == 'dicom_aireadi':
+            num_frames, height, width = [int(s) for s in data_dict['oct_metadata'][0]['resolution']]
+            # every dicom volume is resized to 496 rows, see __getitem__
+            height = 496
+        elif self.dataset_mode == 'volume':
+            shape = np.load(data_dict['frames'][0], mmap_mode='r').shape
+            num_frames, height, width = shape[0], shape[-2], shape[-1]
+        else:
+            num_frames = len(data_dict['frames'])
+            with Image.open(data_dict['frames'][0], mode='r') as frame:
+                width, height = frame.size
+        if self.downsample_width:
+            height = height // 2 if height == 1024 else height
+            width = width // 2 if width == 1024 else width
+        if self.volume_resize and self.dataset_mode in ['volume', 'dicom_aireadi']:
+            height, width = (self.volume_resize, self.volume_resize) if isinstance(self.volume_resize, int) else tuple(self.volume_resize)
+        if self.max_frames and self.dataset_mode in ['frame', 'volume']:
+            # cropped or padded to max_frames
+            num_frames = self.max_frames
+        return (num_frames, height, width)
+
     def __len__(self):
         if self.dataset_mode == 'frame':
             return len(self.patients)
@@ -514,8 +652,7 @@ class PatientDataset3D(Dataset):
     def __getitem__(self, idx):
 
         if self.iterate_mode == 'patient':
-            patient_id = list(self.patients.keys())[idx]
-            data_dict = self.patients[patient_id]
+            patient_id, data_dict = get_patient_sample(self, idx)
         elif self.iterate_mode == 'visit':
             data_dict = self.visits_dict[idx]
             patient_id = self.mapping_visit2patient[idx]
@@ -539,7 +676,10 @@ class PatientDataset3D(Dataset):
             if self.transform and self.transform_type == 'frame_2D':
                 frames = [self.transform(frame) for frame in frames]
             elif self.transform and self.transform_type == 'monai_3D':
-                frames = [transforms.ToTensor()(frame) for frame in frames]
+                if self.volume_dtype == 'uint8':
+                    frames = [transforms.PILToTensor()(frame) for frame in frames]
+                else:
+                    frames = [transforms.ToTensor()(frame) for frame in frames]
 
             # Convert frame to tensor (if not already done by transform)
             if self.convert_to_tensor and not isinstance(frames[0], torch.Tensor):
@@ -548,6 +688,8 @@ class PatientDataset3D(Dataset):
                 frames = [frame.permute(2, 0, 1) for frame in frames]
 
             frames_tensor = torch.stack(frames)
+            if self.transform and self.transform_type == 'monai_3D':
+                frames_tensor = convert_volume_dtype(frames_tensor, self.volume_dtype)
             num_frames = frames_tensor.shape[0]
             if self.max_frames:
                 if num_frames > self.max_frames:
@@ -566,8 +708,8 @@ class PatientDataset3D(Dataset):
                     pad_size = self.max_frames - num_frames
                     pad_left = pad_size // 2
                     pad_right = pad_size - pad_left
-                    pad_left_tensor = torch.zeros(pad_left, frames_tensor.shape[1], frames_tensor.shape[2], frames_tensor.shape[3])
-                    pad_right_tensor = torch.zeros(pad_right, frames_tensor.shape[1], frames_tensor.shape[2], frames_tensor.shape[3])
+                    pad_left_tensor = torch.zeros(pad_left, frames_tensor.shape[1], frames_tensor.shape[2], frames_tensor.shape[3], dtype=frames_tensor.dtype)
+                    pad_right_tensor = torch.zeros(pad_right, frames_tensor.shape[1], frames_tensor.shape[2], frames_tensor.shape[3], dtype=frames_tensor.dtype)
                     frames_tensor = torch.cat([pad_left_tensor, frames_tensor, pad_right_tensor], dim=0)
 
 
@@ -592,19 +734,22 @@ class PatientDataset3D(Dataset):
             if data_path.endswith('.npy'):
                 volume = np.load(data_path)
 
-            # Assume the volume shape is (D, H, W) or (D, C, H, W)
-            volume = volume / 255.0 # !!! Normalize to [0, 1], very crticial for 3D volume
+            # Assume the volume shape is (D, H, W) or (D, C, H, W), with values in [0, 255]
+            # uint8 volumes stay uint8 through the downsampling with volume_dtype='uint8', float32 (not float64) otherwise
+            volume = torch.from_numpy(volume)
+            if self.volume_dtype != 'uint8' or volume.is_floating_point():
+                volume = volume.float() / 255.0 # !!! Normalize to [0, 1], very crticial for 3D volume
             if self.downsample_width:
                 if volume.shape[-2] == 1024:
-                    volume = (volume[..., ::2, :] + volume[..., 1::2, :]) / 2
+                    volume = average_pairs(volume, dim=-2)
                 if volume.shape[-1] == 1024:
-                    volume = (volume[..., :, ::2] + volume[..., :, 1::2]) / 2
-
-            # Convert to tensor, currently must be converted to tensor
+                    volume = average_pairs(volume, dim=-1)
 
-            volume = torch.tensor(volume).unsqueeze(1).float() if len(volume.shape) == 3 else torch.tensor(volume).float()
+            volume = volume.unsqueeze(1) if len(volume.shape) == 3 else volume
             if self.volume_resize:
+                volume = volume if volume.is_floating_point() else volume.float() / 255.0
                 volume = F.interpolate(volume, size=self.volume_resize, mode='bicubic', align_corners=False)
+            volume = convert_volume_dtype(volume, self.volume_dtype)
 
             num_frames = volume.shape[0]
             if self.max_frames:
@@ -624,8 +769,8 @@ class PatientDataset3D(Dataset):
                     pad_size = self.max_frames - num_frames
                     pad_left = pad_size // 2
                     pad_right = pad_size - pad_left
-                    pad_left_tensor = torch.zeros(pad_left, frames_tensor.shape[1], frames_tensor.shape[2], frames_tensor.shape[3])
-                    pad_right_tensor = torch.zeros(pad_right, frames_tensor.shape[1], frames_tensor.shape[2], frames_tensor.shape[3])
+                    pad_left_tensor = torch.zeros(pad_left, volume.shape[1], volume.shape[2], volume.shape[3], dtype=volume.dtype)
+                    pad_right_tensor = torch.zeros(pad_right, volume.shape[1], volume.shape[2], volume.shape[3], dtype=volume.dtype)
                     volume = torch.cat([pad_left_tensor, volume, pad_right_tensor], dim=0)
 
                 else:
@@ -661,8 +806,7 @@ class PatientDataset3D(Dataset):
             data_class_idx = data_dict['class_idx']
             pat_idx = data_dict['pat_id']
 
-            dicom_file = pydicom.dcmread(self.dataset_directory + data_path)
-            volume = dicom_file.pixel_array
+            volume = read_dicom_pixel_array(self.dataset_directory + data_path, num_threads=self.dicom_decode_threads)
             if manufacturer == 'Heidelberg':
                 shift_mean = 0
                 shift_std = 1
@@ -690,66 +834,18 @@ class PatientDataset3D(Dataset):
 
                 if oct_metadata.get('crop_start_col') is not None and oct_metadata.get('crop_end_col') is not None and oct_metadata.get('min_pixel_val') is not None and oct_metadata.get('max_pixel_value') is not None:
                     print('Directly use')
-                    crop_start_col = oct_metadata['crop_start_col']
-                    crop_end_col = oct_metadata['crop_end_col']
-                    min_pixel_val = oct_metadata['min_pixel_val']
-                    max_pixel_value = oct_metadata['max_pixel_value']
-                    volume = volume[:, crop_start_col:crop_end_col, :]
-                    volume[volume < min_pixel_val] = min_pixel_val if manufacturers_model_name == 'Triton' else min_pixel_val - 10
-                    volume[volume > max_pixel_value] = max_pixel_value
+                    volume = apply_topcon_crop_params(volume, oct_metadata, manufacturers_model_name)
                 else:
                     print('Need to generate')
-                    max_pixel_value = 200
-
-                    mean_vol = np.mean(volume, axis=0)
-                    val = filters.threshold_otsu(mean_vol)
-                    hist, bins_center = exposure.histogram(mean_vol)
-                    min_pixel_val = max(math.ceil(bins_center[0]) - 5, 0)
-
-                    volume[volume < min_pixel_val] = min_pixel_val if manufacturers_model_name == 'Triton' else min_pixel_val
-                    volume[volume > max_pixel_value] = max_pixel_value
-
-                    foreground_vol = np.where(mean_vol > val - 10, 1, 0)  # Replace 0 with np.nan if you prefer
-
-                    start_col = 100
-                    end_col = 700 if manufacturers_model_name == 'Maestro2' else 750
-                    default_gap = end_col - start_col
-                    # check foreground[:start_col] and foreground[end_col:] is all 0
-                    # You can directly use np.any() to find rows that contain at least one non-zero
-                    not_all_zero = np.any(foreground_vol == 1, axis=1)
-
-                    # Find the first and last row that is not all zeros
-                    first_row_not_all_zero = np.where(not_all_zero)[0][0] if np.any(not_all_zero) else None
-                    last_row_not_all_zero = np.where(not_all_zero)[0][-1] if np.any(not_all_zero) else None
-
-                    actual_gap = last_row_not_all_zero - first_row_not_all_zero + 1 if first_row_not_all_zero is not None and last_row_not_all_zero is not None else None
-
-                    if actual_gap is not None:
-                        if actual_gap < default_gap - 200:
-                            crop_start_col = start_col if first_row_not_all_zero >= start_col + 100 else max(0, first_row_not_all_zero - 100)
-                            if crop_start_col < start_col:
-                                crop_end_col = crop_start_col + default_gap
-                            else:
-                                crop_end_col = end_col if last_row_not_all_zero <= end_col - 100 else min(volume.shape[1], last_row_not_all_zero + 100)
-                                if crop_end_col > end_col:
-                                    crop_start_col = crop_end_col - default_gap
-
-                        else:
-                            crop_start_col = max(0, first_row_not_all_zero - 100)
-                            crop_end_col = min(volume.shape[1], last_row_not_all_zero + 100)
-
-                    volume = volume[:, crop_start_col:crop_end_col, :]
-                    oct_metadata['crop_start_col'] = crop_start_col
-                    oct_metadata['crop_end_col'] = crop_end_col
-                    oct_metadata['first_row_not_all_zero'] = first_row_not_all_zero
-                    oct_metadata['last_row_not_all_zero'] = last_row_not_all_zero
-                    oct_metadata['actual_gap'] = actual_gap
-                    oct_metadata['min_pixel_val'] = min_pixel_val
-                    oct_metadata['max_pixel_value'] = max_pixel_value
+                    crop_params = get_topcon_crop_params(volume, manufacturers_model_name)
+                    volume = apply_topcon_crop_params(volume, crop_params, manufacturers_model_name)
+                    oct_metadata.update(crop_params)
 
             if manufacturers_model_name != 'Heidelberg':
                 volume = F.interpolate(torch.tensor(volume).unsqueeze(0).float(), size=(496, volume.shape[2]), mode='bilinear', align_corners=False).squeeze(0).numpy()
 
+            # float32, the integer dicom pixels would otherwise be promoted to float64
+            volume = volume.astype(np.float32, copy=False)
             volume = (volume - np.min(volume)) / (np.max(volume) - np.min(volume))
 
             if self.shift_mean_std:
@@ -765,6 +861,7 @@ class PatientDataset3D(Dataset):
             volume = torch.tensor(volume).unsqueeze(1).float() if len(volume.shape) == 3 else torch.tensor(volume).float()
             if self.volume_resize:
                 volume = F.interpolate(volume, size=self.volume_resize, mode='bicubic', align_corners=False)
+            volume = convert_volume_dtype(volume, self.volume_dtype)
 
             num_frames = volume.shape[0]
 
@@ -807,7 +904,7 @@ class PatientDataset3D(Dataset):
 
 
 class PatientDatasetCenter2D(Dataset):
-    def __init__(self, root_dir, patient_idx_loc, dataset_mode='frame', transform=None, convert_to_tensor=False, return_patient_id=False, out_frame_idx=False, name_split_char='_', cls_unique=True, iterate_mode='patient', volume_resize=(224, 224), downsample_width=True, visit_idx_loc=None, visit_list=None, aireadi_location='All', aireadi_split='train', aireadi_device='All', aireadi_pre_patient_cohort='All',  aireadi_abnormal_file_tsv=None, shift_mean_std=False, aireadi_normalize_retfound=False, random_shuffle_patient=True, **kwargs):
+    def __init__(self, root_dir, patient_idx_loc, dataset_mode='frame', transform=None, convert_to_tensor=False, return_patient_id=False, out_frame_idx=False, name_split_char='_', cls_unique=True, iterate_mode='patient', volume_resize=(224, 224), downsample_width=True, visit_idx_loc=None, visit_list=None, aireadi_location='All', aireadi_split='train', aireadi_device='All', aireadi_pre_patient_cohort='All',  aireadi_abnormal_file_tsv=None, shift_mean_std=False, aireadi_normalize_retfound=False, random_shuffle_patient=True, manifest_cache=False, lazy_dicom_frames=False, **kwargs):
         """
         Args:
             root_dir (string): Directory with all the images.
@@ -835,6 +932,10 @@ class PatientDatasetCenter2D(Dataset):
         # options for visit mode, only used for frame dataset, default is None
         self.visit_idx_loc = visit_idx_loc
         self.visit_list = visit_list
+        # cache the directory listings of _get_patients next to root_dir
+        self.manifest_cache = manifest_cache
+        # dicom_aireadi: decode only the middle B-scan, False decodes and normalizes the whole volume
+        self.lazy_dicom_frames = lazy_dicom_frames
 
         self.random_shuffle_patient = random_shuffle_patient
 
@@ -872,6 +973,10 @@ class PatientDatasetCenter2D(Dataset):
             self.shift_mean_std = shift_mean_std
             self.aireadi_normalize_retfound = aireadi_normalize_retfound
 
+        if self.dataset_mode in ['frame', 'volume', 'dicom_aireadi']:
+            # columnar index of the samples, the dicts above become views of it
+            set_visit_index(self)
+
         for key, value in kwargs.items():
             setattr(self, key, value)
 
@@ -1052,15 +1157,18 @@ class PatientDatasetCenter2D(Dataset):
 
     def _get_patients(self, patient_idx_loc):
         patients = {}
-        class_names = os.listdir(self.root_dir)
+        # with manifest_cache, directory listings come from the manifest cache, only changed class directories are listed again
+        manifest = DirectoryManifest(self.root_dir, cache_path=get_manifest_path(self.root_dir, self.manifest_cache) if self.dataset_mode != 'dicom_aireadi' else None)
+        class_names = manifest.names
         class_to_idx = {cls_name: idx for idx, cls_name in enumerate(class_names)}
         if self.dataset_mode == 'frame':
             if self.iterate_mode == 'patient':
-                for cls_dir in os.listdir(self.root_dir):
+                for cls_dir in class_names:
                     cls_path = os.path.join(self.root_dir, cls_dir)
-                    if os.path.isdir(cls_path):
-                        for img_name in os.listdir(cls_path):
-                            patient_id, frame_index = img_name.split(self.name_split_char)[patient_idx_loc], img_name.split(self.name_split_char)[patient_idx_loc + 1]
+                    if manifest.isdir(cls_dir):
+                        for img_name in manifest.listdir(cls_dir):
+                            name_parts = img_name.split(self.name_split_char)
+                            patient_id, frame_index = name_parts[patient_idx_loc], name_parts[patient_idx_loc + 1]
                             if self.cls_unique:
                                 unique_patient_id = f"{cls_dir}_{patient_id}"
                             else:
@@ -1086,13 +1194,14 @@ class PatientDatasetCenter2D(Dataset):
                 visit_idx = 0
                 visit_id_map2visit_idx = {}
                 assert self.visit_idx_loc is not None or self.visit_list is not None
-                for cls_dir in os.listdir(self.root_dir):
+                for cls_dir in class_names:
                     cls_path = os.path.join(self.root_dir, cls_dir)
-                    if os.path.isdir(cls_path):
-                        for img_name in os.listdir(cls_path):
-                            patient_id = img_name.split(self.name_split_char)[patient_idx_loc]
+                    if manifest.isdir(cls_dir):
+                        for img_name in manifest.listdir(cls_dir):
+                            name_parts = img_name.split(self.name_split_char)
+                            patient_id = name_parts[patient_idx_loc]
                             if self.visit_idx_loc is not None:
-                                visit_id = img_name.split(self.name_split_char)[self.visit_idx_loc]
+                                visit_id = name_parts[self.visit_idx_loc]
                             else:
                                 raise ValueError('visit_list must be provided [temporarily]')
 
@@ -1145,10 +1254,10 @@ class PatientDatasetCenter2D(Dataset):
             mapping_patient2visit = {}
             visit_idx = 0
 
-            for cls_dir in os.listdir(self.root_dir):
+            for cls_dir in class_names:
                 cls_path = os.path.join(self.root_dir, cls_dir)
-                if os.path.isdir(cls_path):
-                    for img_name in os.listdir(cls_path):
+                if manifest.isdir(cls_dir):
+                    for img_name in manifest.listdir(cls_dir):
                         patient_id = img_name.split(self.name_split_char)[patient_idx_loc]
                         if self.cls_unique:
                             unique_patient_id = f"{cls_dir}_{patient_id}"
@@ -1221,8 +1330,7 @@ class PatientDatasetCenter2D(Dataset):
     def __getitem__(self, idx):
 
         if self.iterate_mode == 'patient':
-            patient_id = list(self.patients.keys())[idx]
-            data_dict = self.patients[patient_id]
+            patient_id, data_dict = get_patient_sample(self, idx)
         elif self.iterate_mode == 'visit':
             data_dict = self.visits_dict[idx]
             patient_id = self.mapping_visit2patient[idx]
@@ -1319,8 +1427,17 @@ class PatientDatasetCenter2D(Dataset):
             data_class_idx = data_dict['class_idx']
             pat_idx = data_dict['pat_id']
 
-            dicom_file = pydicom.dcmread(self.dataset_directory + data_path)
-            volume = dicom_file.pixel_array
+            dicom_reader = DicomFrameReader(self.dataset_directory + data_path)
+            num_frames = dicom_reader.num_frames
+            middle_index = (num_frames // 2) - 1 if num_frames % 2 == 0 else num_frames // 2
+            if self.lazy_dicom_frames:
+                # only the middle B-scan is decoded, normalized below by its own min / max instead of
+                # the volume's, so the intensities differ from the default full-volume decode
+                volume = dicom_reader.get_frames([middle_index])
+                middle_index_in_volume = 0
+            else:
+                volume = dicom_reader.get_frames()
+                middle_index_in_volume = middle_index
             if manufacturer == 'Heidelberg':
                 shift_mean = 0
                 shift_std = 1
@@ -1360,9 +1477,7 @@ class PatientDatasetCenter2D(Dataset):
                     volume = (volume[..., :, ::2] + volume[..., :, 1::2]) / 2
 
 
-            num_frames = volume.shape[0]
-            middle_index = (num_frames // 2) - 1 if num_frames % 2 == 0 else num_frames // 2
-            frame = volume[middle_index]
+            frame = volume[middle_index_in_volume]
             # Convert numpy array to PIL image
             frame = Image.fromarray(frame)
             if self.mode == 'gray':
@@ -1581,5 +1696,66 @@ def filter_aireadi_patient_dict(patient_dict, condition=[('Spectralis', 'Macula'
     return return_patient_dict
 
 
-
-
+def get_topcon_crop_params(volume, manufacturers_model_name, max_pixel_value=200):
+    """
+    Crop rows and pixel range of a Topcon (Maestro2 / Triton) OCT volume, from the Otsu
+    foreground of its mean B-scan.
+
+    Args:
+        volume (np.ndarray): [D, H, W] pixel array of the dicom file
+        manufacturers_model_name (str): 'Maestro2' or 'Triton'
+    return: dict with the topcon_crop_param_keys, as stored in the oct_metadata of the dataset
+    """
+    mean_vol = np.mean(volume, axis=0)
+    val = filters.threshold_otsu(mean_vol)
+    hist, bins_center = exposure.histogram(mean_vol)
+    min_pixel_val = max(math.ceil(bins_center[0]) - 5, 0)
+
+    foreground_vol = np.where(mean_vol > val - 10, 1, 0)
+
+    start_col = 100
+    end_col = 700 if manufacturers_model_name == 'Maestro2' else 750
+    default_gap = end_col - start_col
+    # Find the first and last row with at least one foreground pixel
+    not_all_zero = np.any(foreground_vol == 1, axis=1)
+    first_row_not_all_zero = int(np.where(not_all_zero)[0][0]) if np.any(not_all_zero) else None
+    last_row_not_all_zero = int(np.where(not_all_zero)[0][-1]) if np.any(not_all_zero) else None
+
+    actual_gap = last_row_not_all_zero - first_row_not_all_zero + 1 if first_row_not_all_zero is not None and last_row_not_all_zero is not None else None
+
+    if actual_gap is None:
+        # no foreground, keep all rows
+        crop_start_col, crop_end_col = 0, volume.shape[1]
+    elif actual_gap < default_gap - 200:
+        crop_start_col = start_col if first_row_not_all_zero >= start_col + 100 else max(0, first_row_not_all_zero - 100)
+        if crop_start_col < start_col:
+            crop_end_col = crop_start_col + default_gap
+        else:
+            crop_end_col = end_col if last_row_not_all_zero <= end_col - 100 else min(volume.shape[1], last_row_not_all_zero + 100)
+            if crop_end_col > end_col:
+                crop_start_col = crop_end_col - default_gap
+    else:
+        crop_start_col = max(0, first_row_not_all_zero - 100)
+        crop_end_col = min(volume.shape[1], last_row_not_all_zero + 100)
+
+    return {
+        'crop_start_col': crop_start_col,
+        'crop_end_col': crop_end_col,
+        'first_row_not_all_zero': first_row_not_all_zero,
+        'last_row_not_all_zero': last_row_not_all_zero,
+        'actual_gap': actual_gap,
+        'min_pixel_val': min_pixel_val,
+        'max_pixel_value': max_pixel_value,
+    }
+
+
+def load_topcon_crop_params(crop_params_tsv):
+    """
+    return: {dicom file path: crop params} of a sidecar tsv written by precompute_aireadi_crop_params.py
+    """
+    crop_params_df = pd.read_csv(crop_params_tsv, sep='\t')
+    crop_params = {}
+    for row in crop_params_df.itertuples(index=False):
+        row = row._asdict()
+        crop_params[row['file_path']] = {key: (None if pd.isna(row[key]) else int(row[key])) for key in topcon_crop_param_keys}
+    return crop_params
@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import json
 from monai import transforms as monai_transforms
 from .PatientDataset import PatientDatasetCenter2D, PatientDataset3D # , create_3d_transforms
+from .visit_index import set_visit_index
 
 home_directory: str = os.getenv('HOME')
 
@@ -111,6 +112,7 @@ class PatientDatasetCenter2D_inhouse(PatientDatasetCenter2D):
 
         self.load_patient_id_list()
         self.patients, self.visits_dict, self.mapping_patient2visit, self.mapping_visit2patient = self._get_patients()
+        set_visit_index(self)
         self.normal_patient_idx, self.normal_visit_idx, self.abnormal_patient_idx, self.abnormal_visit_idx = self.get_all_normal_patient_idx()
         self.downsample_normal = downsample_normal
         self.downsample_normal_factor = downsample_normal_factor
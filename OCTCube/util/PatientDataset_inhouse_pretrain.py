@@ -25,9 +25,17 @@ from .PatientDataset_inhouse import PatientDatasetCenter2D_inhouse, PatientDatas
 home_directory = os.getenv('HOME')
 
 class Inhouse_and_Kermany_Dataset(Dataset):
-    def __init__(self, dataset1, dataset2):
+    def __init__(self, dataset1, dataset2, return_otsu_mask=True):
+        """
+        Args:
+            dataset1 (PatientDatasetCenter2D_inhouse_pretrain): in-house frames
+            dataset2 (ImageFolder): Kermany frames
+            return_otsu_mask (bool): If False, skip the Otsu thresholding of the Kermany frames and
+                return an empty mask, for training loops that do not use it
+        """
         self.dataset1 = dataset1
         self.dataset2 = dataset2
+        self.return_otsu_mask = return_otsu_mask
         # Optionally maintain indices to manage sampling from both datasets
 
     def __len__(self):
@@ -41,16 +49,26 @@ class Inhouse_and_Kermany_Dataset(Dataset):
         else:
             frame, _ = self.dataset2[idx - len(self.dataset1)]
             # print(frame.shape)
-            frame_img = np.array(frame)
+            return frame, (2, idx-len(self.dataset1), get_otsu_mask(frame) if self.return_otsu_mask else empty_otsu_mask())
+
+
+
+def get_otsu_mask(frame):
+    """
+    return: full-resolution Otsu foreground of a transformed frame, as a bool array of its shape
+    """
+    frame_img = np.array(frame)
+    val = filters.threshold_otsu(frame_img)
+    return frame_img > val
 
-            val = filters.threshold_otsu(frame_img)
-            filtered_img = frame_img > val
-            return frame, (2, idx-len(self.dataset1), filtered_img)
 
+def empty_otsu_mask():
+    # placeholder of a skipped Otsu mask, collates to a [B, 0] tensor
+    return torch.zeros(0, dtype=torch.bool)
 
 
 class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
-    def __init__(self, root_dir, task_mode='multi_label', dataset_mode='frame', transform=None, convert_to_tensor=False, return_patient_id=False, out_frame_idx=False, name_split_char='-', iterate_mode='visit', downsample_width=True, mode='rgb', patient_id_list_dir='multi_cls_expr_10x/', disease='AMD', disease_name_list=None, metadata_fname=None, downsample_normal=False, downsample_normal_factor=10, enable_spl=False, return_mask=False, mask_dir=home_directory + '/all_seg_results_collection/seg_results/', mask_transform=None, **kwargs):
+    def __init__(self, root_dir, task_mode='multi_label', dataset_mode='frame', transform=None, convert_to_tensor=False, return_patient_id=False, out_frame_idx=False, name_split_char='-', iterate_mode='visit', downsample_width=True, mode='rgb', patient_id_list_dir='multi_cls_expr_10x/', disease='AMD', disease_name_list=None, metadata_fname=None, downsample_normal=False, downsample_normal_factor=10, enable_spl=False, return_mask=False, mask_dir=home_directory + '/all_seg_results_collection/seg_results/', mask_transform=None, return_otsu_mask=True, **kwargs):
         """
         Args:
             root_dir (string): Directory with all the images.
@@ -67,6 +85,8 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
             iterate_mode (str): 'visit' or 'patient'
             downsample_width (bool): If True, downsample the width to 512 (1024) / 768 (1536)
             mode (str): 'rgb', 'gray'
+            return_otsu_mask (bool): If False, skip the Otsu thresholding of every frame and return
+                an empty mask, for training loops that do not use it
 
         """
         super().__init__(root_dir, dataset_mode=dataset_mode, task_mode=task_mode, transform=transform, downsample_width=downsample_width, convert_to_tensor=convert_to_tensor, return_patient_id=return_patient_id, out_frame_idx=out_frame_idx, name_split_char=name_split_char, iterate_mode=iterate_mode, mode=mode, patient_id_list_dir=patient_id_list_dir, **kwargs)
@@ -76,7 +96,9 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
         self.mask_dir = mask_dir
         self.update_len_dataset_list()
         self.mask_transform = mask_transform
+        self.return_otsu_mask = return_otsu_mask
 
+        self.enable_spl = enable_spl
         if enable_spl:
             self.init_spl(K=0.1)
 
@@ -93,17 +115,39 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
     def update_spl(self, K=0.1):
         self.K = K
         self.visible_frame_num = int(self.K * self.len_all_dataset)
-        hardness_list = []
-        for idx in range(self.len_all_dataset):
-            hardness_list.append(self.all_image_dict[self.all_image_list[idx]]['hardness'])
+        hardness_list = self.hardness[self.all_image_frame_id]
 
         hardness_list = np.argsort(hardness_list)[::-1] # descending order
         self.idx_to_frame = hardness_list[:self.visible_frame_num]
 
 
 
+    def update_hardness(self, frame_ids, frame_loss):
+        """
+        frame_ids: [N] frame ids from self.frame_id, frame_loss: [N] numpy losses of the frames
+        """
+        self.mse_loss[frame_ids] = frame_loss
+        self.hardness[frame_ids] = frame_loss
+        self.hardness_updated[frame_ids] = True
+
+    def get_all_image_dict(self):
+        # write the hardness store back to all_image_dict, e.g., before pickling it
+        for frame, frame_idx in self.frame_id.items():
+            self.all_image_dict[frame]['mse_loss'] = float(self.mse_loss[frame_idx])
+            self.all_image_dict[frame]['hardness'] = float(self.hardness[frame_idx])
+        return self.all_image_dict
+
+    def set_all_image_dict(self, all_image_dict):
+        # load the hardness store from a pickled all_image_dict
+        self.all_image_dict = all_image_dict
+        for frame, frame_idx in self.frame_id.items():
+            self.mse_loss[frame_idx] = all_image_dict[frame]['mse_loss']
+            self.hardness[frame_idx] = all_image_dict[frame]['hardness']
+
     def update_len_dataset_list(self):
         self.len_all_dataset = len(self.all_image_list)
+        # all_image_list may be a subset of the frames in all_image_dict
+        self.all_image_frame_id = np.array([self.frame_id[frame] for frame in self.all_image_list], dtype=np.int64)
 
     def get_all_image_list_and_dict(self, test_patient_id_list=None):
         image_list = []
@@ -126,6 +170,13 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
             print('excluded_patient_id_list:', len(excluded_patient_id_list), len(test_patient_id_list))
             print(len(set(excluded_patient_id_list)), len(set(test_patient_id_list)))
         print(idx, 'len(image_list):', len(image_list))
+
+        # hardness store: frame path -> frame id, indexing the float32 loss arrays
+        self.frame_id = {frame: i for i, frame in enumerate(image_dict)}
+        self.hardness = np.zeros(len(self.frame_id), dtype=np.float32)
+        self.mse_loss = np.zeros(len(self.frame_id), dtype=np.float32)
+        # frames whose hardness was measured by this process since the last cross-rank sync
+        self.hardness_updated = np.zeros(len(self.frame_id), dtype=bool)
         return image_list, image_dict
 
 
@@ -188,10 +239,7 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
             frame = torch.tensor(np.array(frame), dtype=torch.float32)
             frame = frame.permute(2, 0, 1)
             print(frame.shape)
-        frame_img = np.array(frame)
-
-        val = filters.threshold_otsu(frame_img)
-        filtered_img = frame_img > val
+        filtered_img = get_otsu_mask(frame) if self.return_otsu_mask else empty_otsu_mask()
 
         if self.return_mask:
             return frame, (idx, filtered_img, mask)
@@ -319,7 +367,7 @@ if __name__ == '__main__':
 
     from datasets import load_patient_list
     import torchvision.datasets as datasets
-    from misc import find_and_convert_large_white_region
+    from misc import find_and_convert_large_white_region_batch
     print(len(dataset_train))
     dataset_train.update_len_dataset_list()
     dataset_train.init_spl()
@@ -334,7 +382,8 @@ if __name__ == '__main__':
     img, _ = dataset_train_kermany[3]
     print(img.shape)
 
-    gray_image = find_and_convert_large_white_region(img)
+    gray_image, _ = find_and_convert_large_white_region_batch(img.unsqueeze(0))
+    gray_image = gray_image[0]
     plt.imshow(img[0], cmap='gray')
     # plt.savefig('img.png')
 
@@ -0,0 +1,178 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+from torch.utils.data import default_collate
+
+
+class RawVolumed:
+    def __init__(self, keys=("pixel_values",), dtype='uint8'):
+        """
+        Sample transform (monai dict style) used in place of create_3d_transforms when the
+        augmentation runs on the batch: the DataLoader workers only convert the [C, T, H, W] volume
+        to a compact dtype, BatchAugment3D does the rest after collation.
+
+        Args:
+            keys (tuple): keys of the volumes in the data dict
+            dtype (str): 'uint8' (volumes in [0, 1], quantized to 1/255) or 'float16'
+        """
+        assert dtype in ['uint8', 'float16']
+        self.keys = keys
+        self.dtype = dtype
+
+    def __call__(self, data):
+        data = dict(data)
+        for key in self.keys:
+            volume = torch.as_tensor(data[key])
+            if self.dtype == 'uint8':
+                volume = volume if volume.dtype == torch.uint8 else (volume.float().clamp(0, 1) * 255).round().to(torch.uint8)
+            else:
+                volume = volume.to(torch.float16)
+            data[key] = volume
+        return data
+
+
+def collate_volumes(batch):
+    """
+    Collate (volume, ..., label) samples of different [C, T, H, W] shapes: the volumes are
+    zero-padded at the end of each axis to the largest shape of the batch; the batches of
+    util.bucket_sampler.BucketBatchSampler hold one shape and are stacked without padding
+    return: [(volumes [B, C, T, H, W], sizes [B, 3] valid (T, H, W) of each volume), ...collated rest of the samples]
+    """
+    volumes = [sample[0] for sample in batch]
+    sizes = torch.tensor([list(volume.shape[-3:]) for volume in volumes], dtype=torch.long)
+    if all(volume.shape == volumes[0].shape for volume in volumes):
+        padded = torch.stack(volumes)
+    else:
+        max_shape = [max(volume.shape[i] for volume in volumes) for i in range(volumes[0].dim())]
+        padded = volumes[0].new_zeros([len(volumes)] + max_shape)
+        for i, volume in enumerate(volumes):
+            padded[(i,) + tuple(slice(0, s) for s in volume.shape)] = volume
+    rest = default_collate([tuple(sample[1:]) for sample in batch])
+    return [(padded, sizes)] + list(rest)
+
+
+def normalize_volumes(volumes):
+    """
+    Model-boundary conversion of the compact volume batches: uint8 [0, 255] -> float32 [0, 1], float16 -> float32
+    """
+    if volumes.dtype == torch.uint8:
+        return volumes.float().div_(255)
+    if volumes.dtype == torch.float16:
+        return volumes.float()
+    return volumes
+
+
+def resample_axis(x, coords, upper, axis):
+    """
+    Linear interpolation of x [B, C, T, H, W] along axis at per-sample coordinates
+    coords [B, n] (in voxels, within [0, upper]), upper [B] the last valid voxel of each sample
+    """
+    x = x.movedim(axis, 1)
+    idx0 = coords.floor().long()
+    idx1 = torch.minimum(idx0 + 1, upper[:, None])
+    weights = (coords - idx0).to(x.dtype).reshape(coords.shape + (1,) * (x.dim() - 2))
+    batch_idx = torch.arange(x.shape[0], device=x.device)[:, None]
+    x0 = x[batch_idx, idx0]
+    x1 = x[batch_idx, idx1]
+    return torch.lerp(x0, x1, weights).movedim(1, axis)
+
+
+def get_foreground_box(volumes, sizes):
+    """
+    Bounding box of the voxels > 0 (as monai CropForegroundd), from the projections of the
+    foreground mask on each axis; samples without foreground keep their whole volume
+    return: starts, ends [B, 3]
+    """
+    mask = (volumes > 0).any(dim=1)
+    mask_hw = mask.any(dim=1)
+    projections = [mask.flatten(2).any(dim=2), mask_hw.any(dim=2), mask_hw.any(dim=1)]
+    starts, ends = [], []
+    for projection in projections:
+        length = projection.shape[1]
+        starts.append(projection.int().argmax(dim=1))
+        ends.append(length - projection.flip(1).int().argmax(dim=1))
+    starts = torch.stack(starts, dim=1)
+    ends = torch.stack(ends, dim=1)
+    has_foreground = mask.flatten(1).any(dim=1, keepdim=True)
+    starts = torch.where(has_foreground, starts, torch.zeros_like(starts))
+    ends = torch.where(has_foreground, ends, sizes)
+    return starts, ends
+
+
+class BatchAugment3D(torch.nn.Module):
+    def __init__(self, input_size, num_frames=64, is_train=True, RandFlipd_prob=0.5, normalize_dataset=False, device='cpu'):
+        """
+        Batched counterpart of create_3d_transforms, run after collation on the device of the model:
+        train: CropForegroundd -> Resized (trilinear) -> RandFlipd (T axis) -> RandFlipd (W axis),
+        val: Resized (trilinear), both followed by NormalizeIntensityd if normalize_dataset.
+        The crop, resize and flips are folded into per-sample sampling coordinates, so the
+        trilinear resize is done separably (W, H, then T) on the whole batch and matches
+        F.interpolate(align_corners=False) on each cropped volume.
+
+        Args:
+            input_size (int): output H and W
+            num_frames (int): output T
+            is_train (bool): train (crop, resize, flips) or val (resize) augmentation
+            RandFlipd_prob (float): probability of each flip
+            normalize_dataset (bool): (x - 0.25) / 0.25 on the nonzero voxels
+            device (str or torch.device): device the batch is moved to and augmented on
+        """
+        super().__init__()
+        self.output_size = (num_frames, input_size, input_size)
+        self.is_train = is_train
+        self.flip_prob = RandFlipd_prob
+        self.normalize_dataset = normalize_dataset
+        self.device = torch.device(device)
+
+    def forward(self, samples):
+        """
+        samples: (volumes [B, C, T, H, W], sizes [B, 3]) from collate_volumes, or a volume batch of equal shapes
+        return: [B, C, num_frames, input_size, input_size] float32 volumes
+        """
+        if isinstance(samples, (tuple, list)):
+            volumes, sizes = samples
+        else:
+            volumes = samples
+            sizes = torch.tensor(volumes.shape[-3:]).repeat(volumes.shape[0], 1)
+        volumes = volumes.to(self.device, non_blocking=True)
+        sizes = sizes.to(self.device, non_blocking=True)
+        batch_size = volumes.shape[0]
+        volumes = normalize_volumes(volumes).float()
+
+        if self.is_train:
+            starts, ends = get_foreground_box(volumes, sizes)
+        else:
+            starts, ends = torch.zeros_like(sizes), sizes
+        if self.is_train and self.flip_prob > 0:
+            flips = torch.rand(batch_size, 3, device=self.device) < self.flip_prob
+            flips[:, 1] = False
+        else:
+            flips = torch.zeros(batch_size, 3, dtype=torch.bool, device=self.device)
+
+        # largest reduction first: W, H, then T
+        for axis in [2, 1, 0]:
+            start = starts[:, axis:axis + 1].float()
+            end = ends[:, axis:axis + 1].float()
+            out_idx = torch.arange(self.output_size[axis], device=self.device, dtype=torch.float32)[None]
+            # source voxel of each output voxel, align_corners=False, clamped to the crop as F.interpolate
+            coords = start + (out_idx + 0.5) * (end - start) / self.output_size[axis] - 0.5
+            coords = torch.maximum(torch.minimum(coords, end - 1), start)
+            coords = torch.where(flips[:, axis:axis + 1], coords.flip(1), coords)
+            volumes = resample_axis(volumes, coords, ends[:, axis] - 1, axis + 2)
+
+        if self.normalize_dataset:
+            volumes = torch.where(volumes != 0, (volumes - 0.25) / 0.25, volumes)
+        return volumes
+
+
+def create_3d_batch_transforms(input_size, num_frames=64, RandFlipd_prob=0.5, normalize_dataset=False, device='cpu', **kwargs):
+    """
+    return: train and val BatchAugment3D, the batched counterparts of create_3d_transforms
+    """
+    train_transform = BatchAugment3D(input_size, num_frames=num_frames, is_train=True, RandFlipd_prob=RandFlipd_prob, normalize_dataset=normalize_dataset, device=device)
+    val_transform = BatchAugment3D(input_size, num_frames=num_frames, is_train=False, normalize_dataset=normalize_dataset, device=device)
+    return train_transform, val_transform
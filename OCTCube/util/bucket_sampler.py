@@ -0,0 +1,99 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import math
+from collections import defaultdict
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def get_dataset_shapes(dataset):
+    """
+    return: shape key (e.g., the [T, H, W] volume shape from PatientDataset3D.get_visit_shape) of
+    every sample of dataset, a PatientDataset3D or a (nested) TransformableSubset of it
+    """
+    if hasattr(dataset, 'indices') and hasattr(dataset, 'dataset'):
+        shapes = get_dataset_shapes(dataset.dataset)
+        return [shapes[idx] for idx in dataset.indices]
+    return [dataset.get_visit_shape(idx) for idx in range(len(dataset))]
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, shapes, batch_size, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=False):
+        """
+        Batch sampler grouping the samples by shape, so collate_volumes stacks volumes of one
+        native shape instead of zero-padding every volume of a mixed-resolution cohort (e.g.,
+        AI-READI 49 to 193 B-scans) to the largest of its batch. Each epoch the samples of every
+        bucket are shuffled and cut into full batches; the remainders of the buckets, sorted by
+        shape, form the few mixed batches. The batches are shuffled and split across ranks, each
+        rank gets the same number of batches.
+
+        Args:
+            shapes (list): hashable shape key of each sample, see get_dataset_shapes
+            batch_size (int): batch size
+            num_replicas (int): number of ranks, defaults to the world size
+            rank (int): rank of the current process, defaults to the global rank
+            shuffle (bool): If True, shuffle the samples and the batches every epoch
+            seed (int): seed of the shuffling, same on all ranks
+            drop_last (bool): If True, drop the last mixed batch if it is incomplete
+        """
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        buckets = defaultdict(list)
+        for idx, shape in enumerate(shapes):
+            buckets[shape].append(idx)
+        # sorted by shape, so the mixed batches gather the closest shapes
+        self.bucket_shapes = sorted(buckets, key=lambda shape: (shape is None, shape if shape is not None else ()))
+        self.buckets = [np.array(buckets[shape], dtype=np.int64) for shape in self.bucket_shapes]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches, remainders = [], []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = bucket[rng.permutation(len(bucket))]
+            num_full = len(bucket) // self.batch_size * self.batch_size
+            batches += [bucket[i:i + self.batch_size] for i in range(0, num_full, self.batch_size)]
+            remainders.append(bucket[num_full:])
+        remainders = np.concatenate(remainders)
+        batches += [remainders[i:i + self.batch_size] for i in range(0, len(remainders), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.get_batches()
+        num_batches = len(self)
+        total_size = num_batches * self.num_replicas
+        # pad by repeating the first batches to split evenly across ranks
+        batches = (batches * math.ceil(total_size / max(len(batches), 1)))[:total_size]
+        return iter([batch.tolist() for batch in batches[self.rank:total_size:self.num_replicas]])
+
+    def __len__(self):
+        num_full = sum(len(bucket) // self.batch_size for bucket in self.buckets)
+        num_remainders = sum(len(bucket) % self.batch_size for bucket in self.buckets)
+        num_batches = num_full + (num_remainders // self.batch_size if self.drop_last else math.ceil(num_remainders / self.batch_size))
+        return math.ceil(num_batches / self.num_replicas)
+
+    def get_bucket_stats(self):
+        return {str(shape): len(bucket) for shape, bucket in zip(self.bucket_shapes, self.buckets)}
@@ -0,0 +1,142 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pydicom
+
+try:
+    # pydicom >= 3 decodes single frames of encapsulated pixel data through the offset tables
+    from pydicom.pixels import iter_pixels, pixel_array
+except ImportError:
+    iter_pixels = None
+    pixel_array = None
+
+# (7FE0,0010) little endian
+PIXEL_DATA_TAG_BYTES = b'\xe0\x7f\x10\x00'
+
+# frame decoding pool of the current process, DataLoader workers create their own after the fork
+decode_pool = None
+decode_pool_key = None
+
+
+def get_decode_pool(num_threads):
+    global decode_pool, decode_pool_key
+    if decode_pool_key != (os.getpid(), num_threads):
+        if decode_pool is not None:
+            # a pool of another thread count, or inherited from the parent with no threads behind it
+            decode_pool.shutdown(wait=False)
+        decode_pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='dicom_decode')
+        decode_pool_key = (os.getpid(), num_threads)
+    return decode_pool
+
+
+class DicomFrameReader:
+    def __init__(self, path):
+        """
+        Frame-selective reader of a multi-frame DICOM file. The header is parsed without the pixel
+        data, so only the requested frames are read: uncompressed pixel data as a
+        memory-mapped slice of the file, compressed pixel data by decoding the requested frames
+        only (pydicom >= 3, else the volume is decoded and sliced). Compressed frames can be decoded
+        by a thread pool, the JPEG2000 / JPEG-LS / RLE plugins release the GIL while decoding.
+
+        Args:
+            path (str): path of the dicom file
+        """
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.ds = pydicom.dcmread(fp, stop_before_pixels=True)
+            # dcmread stops with the file positioned at the pixel data element
+            self.pixel_data_tell = fp.tell()
+        self.num_frames = int(self.ds.get('NumberOfFrames', 1) or 1)
+        self.shape = (self.num_frames, int(self.ds.Rows), int(self.ds.Columns))
+
+    def get_pixel_dtype(self):
+        return np.dtype('%s%d' % ('<i' if self.ds.get('PixelRepresentation', 0) == 1 else '<u', max(self.ds.BitsAllocated // 8, 1)))
+
+    def get_memmap(self):
+        """
+        return: [T, H, W] read-only memmap of uncompressed little-endian pixel data, None if the layout is not supported
+        """
+        ds = self.ds
+        transfer_syntax = ds.file_meta.TransferSyntaxUID
+        if transfer_syntax.is_compressed or not transfer_syntax.is_little_endian:
+            return None
+        if ds.get('SamplesPerPixel', 1) != 1 or ds.BitsAllocated not in (8, 16, 32):
+            return None
+        if ds.BitsAllocated != ds.get('BitsStored', ds.BitsAllocated) and ds.get('PixelRepresentation', 0) == 1:
+            # signed values narrower than their container need sign extension, leave it to pydicom
+            return None
+        dtype = self.get_pixel_dtype()
+
+        # element header: tag, (explicit VR: VR, reserved,) value length
+        with open(self.path, 'rb') as fp:
+            fp.seek(self.pixel_data_tell)
+            header = fp.read(8 if transfer_syntax.is_implicit_VR else 12)
+        if len(header) < 8 or header[:4] != PIXEL_DATA_TAG_BYTES:
+            return None
+        if transfer_syntax.is_implicit_VR:
+            value_length = int.from_bytes(header[4:8], 'little')
+        else:
+            if header[4:6] not in (b'OB', b'OW') or len(header) < 12:
+                return None
+            value_length = int.from_bytes(header[8:12], 'little')
+        if value_length == 0xFFFFFFFF or value_length < np.prod(self.shape) * dtype.itemsize:
+            return None
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=self.pixel_data_tell + len(header), shape=self.shape)
+
+    def decode_frames(self, frame_indices, num_threads):
+        """
+        Decode compressed frames in parallel into one preallocated array
+        """
+        ds = pydicom.dcmread(self.path)
+        frames = np.empty((len(frame_indices),) + self.shape[1:], dtype=self.get_pixel_dtype())
+
+        def decode_frame(i):
+            frames[i] = pixel_array(ds, index=int(frame_indices[i]))
+
+        # list() waits for all frames and raises the first decoding error
+        list(get_decode_pool(num_threads).map(decode_frame, range(len(frame_indices))))
+        return frames
+
+    def get_frames(self, frame_indices=None, num_threads=0):
+        """
+        num_threads: decode compressed frames with this many threads, 0 or 1 decodes them serially
+        return: [len(frame_indices), H, W] frames, or the [T, H, W] volume if frame_indices is None
+        """
+        if frame_indices is None:
+            frame_indices = np.arange(self.num_frames)
+        frame_indices = np.asarray(frame_indices, dtype=np.int64).reshape(-1)
+        volume = self.get_memmap()
+        if volume is not None:
+            return np.array(volume[frame_indices])
+        if pixel_array is not None and num_threads > 1 and len(frame_indices) > 1 and self.ds.get('SamplesPerPixel', 1) == 1:
+            return self.decode_frames(frame_indices, num_threads)
+        if iter_pixels is not None and len(frame_indices) < self.num_frames:
+            return np.stack(list(iter_pixels(self.path, indices=frame_indices.tolist())))
+        volume = pydicom.dcmread(self.path).pixel_array
+        if self.num_frames == 1:
+            volume = volume[None]
+        return volume[frame_indices]
+
+
+def read_dicom_frames(path, frame_indices=None, num_threads=0):
+    """
+    return: the frames frame_indices of a dicom file, see DicomFrameReader.get_frames
+    """
+    return DicomFrameReader(path).get_frames(frame_indices, num_threads=num_threads)
+
+
+def read_dicom_pixel_array(path, num_threads=0):
+    """
+    Drop-in replacement of pydicom.dcmread(path).pixel_array, with the memory-mapped and threaded decoding
+    return: pixel array, [H, W] (or [H, W, C]) for single-frame files and [T, H, W] for multi-frame files
+    """
+    dicom_reader = DicomFrameReader(path)
+    volume = dicom_reader.get_frames(num_threads=num_threads)
+    return volume if 'NumberOfFrames' in dicom_reader.ds else volume[0]
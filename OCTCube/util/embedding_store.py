@@ -0,0 +1,118 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+
+import numpy as np
+import torch
+
+from .batch_augment import normalize_volumes
+
+EMBEDDINGS_FNAME = 'embeddings.npy'
+TARGETS_FNAME = 'targets.npy'
+INDEX_FNAME = 'index.json'
+
+
+class EmbeddingStoreWriter:
+    def __init__(self, store_dir, num_samples, embed_dim, dtype=np.float16):
+        """
+        Embeddings of a frozen backbone, one row per dataset sample, written to a memory-mapped
+        [N, D] array (embeddings.npy), the targets to targets.npy ([N] or [N, K]) and the dataset
+        indices, patient ids and extraction settings to index.json
+
+        Args:
+            store_dir (str): output directory
+            num_samples (int): number of rows N
+            embed_dim (int): embedding dim D
+            dtype (np.dtype): storage dtype of the embeddings
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.embeddings = np.lib.format.open_memmap(
+            os.path.join(store_dir, EMBEDDINGS_FNAME), mode='w+', dtype=dtype, shape=(num_samples, embed_dim)
+        )
+        self.targets = [None] * num_samples
+        self.written = np.zeros(num_samples, dtype=bool)
+
+    def write(self, rows, embeddings, targets):
+        """
+        Args:
+            rows (np.ndarray): rows of the batch in the store
+            embeddings (torch.Tensor): [B, D]
+            targets (torch.Tensor): [B] or [B, K]
+        """
+        self.embeddings[rows] = embeddings.float().cpu().numpy().astype(self.embeddings.dtype)
+        targets = targets.cpu().numpy()
+        for row, target in zip(rows, targets):
+            self.targets[row] = target
+        self.written[rows] = True
+
+    def close(self, dataset_indices, patient_ids, **meta):
+        """
+        Flush the embeddings and write the targets and the index
+
+        Args:
+            dataset_indices (list): dataset idx of each row
+            patient_ids (list): patient id of each row
+            meta: extraction settings (model, checkpoint, transforms, ...), stored in index.json
+        """
+        if not self.written.all():
+            raise RuntimeError(f'{(~self.written).sum()} of {len(self.written)} rows of the embedding store were not written')
+        self.embeddings.flush()
+        np.save(os.path.join(self.store_dir, TARGETS_FNAME), np.stack(self.targets))
+        index = {
+            'meta': meta,
+            'num_samples': len(self.written),
+            'embed_dim': self.embeddings.shape[1],
+            'dataset_idx': [int(idx) for idx in dataset_indices],
+            'patient_id': [str(patient_id) for patient_id in patient_ids],
+        }
+        with open(os.path.join(self.store_dir, INDEX_FNAME), 'w') as f:
+            json.dump(index, f)
+
+
+def load_embedding_store(store_dir, mmap=True):
+    """
+    return: (embeddings [N, D] (memory-mapped if mmap), targets [N] or [N, K], index dict of index.json)
+    """
+    embeddings = np.load(os.path.join(store_dir, EMBEDDINGS_FNAME), mmap_mode='r' if mmap else None)
+    targets = np.load(os.path.join(store_dir, TARGETS_FNAME))
+    with open(os.path.join(store_dir, INDEX_FNAME)) as f:
+        index = json.load(f)
+    return embeddings, targets, index
+
+
+@torch.no_grad()
+def extract_embeddings(model, data_loader, writer, device, batch_transform=None, print_freq=20):
+    """
+    Run the frozen model once over data_loader (sequential sampler, deterministic transforms) and
+    write the embeddings of model(x, return_embeddings=True) to the store rows in loader order
+
+    Args:
+        model (nn.Module): model whose forward takes return_embeddings=True, e.g., models_vit_st_flash_attn
+        data_loader (DataLoader): yields (images, target), in the order of the store rows
+        writer (EmbeddingStoreWriter): output store
+        device (torch.device): device of the model
+        batch_transform (callable): batch transform applied on the device, e.g., the val transform of --batch_augment
+        print_freq (int): print the progress every print_freq batches
+    return: number of rows written
+    """
+    model.eval()
+    row = 0
+    for i, batch in enumerate(data_loader):
+        images, target = batch[0], batch[-1]
+        if batch_transform is not None:
+            images = batch_transform(images)
+        images = normalize_volumes(images.to(device, non_blocking=True))
+        with torch.cuda.amp.autocast(enabled=device.type == 'cuda'):
+            _, embeddings = model(images, return_embeddings=True)
+        rows = np.arange(row, row + embeddings.shape[0])
+        writer.write(rows, embeddings, target)
+        row += embeddings.shape[0]
+        if print_freq and (i + 1) % print_freq == 0:
+            print(f'Extracted {row}/{len(writer.written)} embeddings')
+    return row
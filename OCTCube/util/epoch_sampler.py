@@ -0,0 +1,107 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import math
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+class EpochIndexSampler(Sampler):
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=False, epoch_indices_fn=None):
+        """
+        Distributed sampler over an index set that may change every epoch. The indices of an epoch
+        come from get_epoch_indices(epoch) (epoch_indices_fn, or overridden by subclasses), are
+        shuffled with seed + epoch and split across ranks as in DistributedSampler. The sampler is
+        iterated in the main process, so the index set changes without touching the dataset and
+        the DataLoader can keep its workers (persistent_workers=True) and prefetch.
+
+        Args:
+            dataset (Dataset): dataset the indices refer to
+            num_replicas (int): number of ranks, defaults to the world size
+            rank (int): rank of the current process, defaults to the global rank
+            shuffle (bool): If True, shuffle the indices every epoch
+            seed (int): seed of the shuffling and of the per-epoch selection, same on all ranks
+            drop_last (bool): If True, drop the tail instead of padding it to split evenly across ranks
+            epoch_indices_fn (callable): epoch -> indices of the epoch, all indices of the dataset if None
+        """
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch_indices_fn = epoch_indices_fn
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_epoch_indices(self, epoch):
+        """
+        return: indices of the epoch, must be the same on all ranks
+        """
+        if self.epoch_indices_fn is not None:
+            return self.epoch_indices_fn(epoch)
+        return np.arange(len(self.dataset))
+
+    def get_indices(self):
+        indices = np.asarray(self.get_epoch_indices(self.epoch), dtype=np.int64)
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            indices = indices[rng.permutation(len(indices))]
+        return indices
+
+    def get_num_samples(self, num_indices):
+        if self.drop_last:
+            return num_indices // self.num_replicas
+        return math.ceil(num_indices / self.num_replicas)
+
+    def __iter__(self):
+        indices = self.get_indices()
+        num_samples = self.get_num_samples(len(indices))
+        total_size = num_samples * self.num_replicas
+        if total_size > len(indices):
+            # pad by repeating the first indices to split evenly across ranks
+            indices = np.resize(indices, total_size)
+        else:
+            indices = indices[:total_size]
+        return iter(indices[self.rank:total_size:self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.get_num_samples(len(self.get_epoch_indices(self.epoch)))
+
+
+class DownsampleNormalSampler(EpochIndexSampler):
+    def __init__(self, dataset, normal_indices, downsample_normal_factor=10, **kwargs):
+        """
+        EpochIndexSampler keeping every abnormal sample and a new random 1 / downsample_normal_factor
+        of the normal samples each epoch, in place of PatientDataset3D_inhouse.on_epoch_end
+
+        Args:
+            dataset (Dataset): train split, e.g., a TransformableSubset
+            normal_indices (list): indices of the normal samples in dataset
+            downsample_normal_factor (int): downsample the normal samples by this factor
+            **kwargs: EpochIndexSampler arguments
+        """
+        super().__init__(dataset, **kwargs)
+        is_normal = np.zeros(len(dataset), dtype=bool)
+        is_normal[np.asarray(normal_indices, dtype=np.int64)] = True
+        self.normal_indices = np.flatnonzero(is_normal)
+        self.abnormal_indices = np.flatnonzero(~is_normal)
+        self.downsample_normal_factor = downsample_normal_factor
+
+    def get_epoch_indices(self, epoch):
+        # seeded by (seed, epoch), independent of the shuffling stream
+        rng = np.random.default_rng((self.seed, epoch))
+        num_normal = len(self.normal_indices) // self.downsample_normal_factor
+        normal_indices = rng.choice(self.normal_indices, size=num_normal, replace=False)
+        return np.sort(np.concatenate([normal_indices, self.abnormal_indices]))
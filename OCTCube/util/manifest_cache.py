@@ -0,0 +1,120 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import io
+import os
+import stat
+
+import numpy as np
+
+
+def get_manifest_path(root_dir, manifest_cache=True):
+    """
+    Args:
+        root_dir (str): dataset directory
+        manifest_cache (bool or str): False / None for no cache, True to store it next to root_dir
+            (e.g., /data/OCT/ -> /data/OCT.manifest.npz), or a directory to store it in (e.g., the
+            output dir, when the dataset location is read-only or shared)
+    return: path of the manifest cache of root_dir, None if disabled
+    """
+    if not manifest_cache:
+        return None
+    root_dir = os.path.normpath(os.path.abspath(root_dir))
+    if manifest_cache is True:
+        return root_dir + '.manifest.npz'
+    # several datasets may share the cache dir, the name keeps the root apart
+    root_hash = hashlib.md5(root_dir.encode('utf-8', 'surrogateescape')).hexdigest()[:8]
+    return os.path.join(manifest_cache, '%s_%s.manifest.npz' % (os.path.basename(root_dir), root_hash))
+
+
+class DirectoryManifest:
+    def __init__(self, root_dir, cache_path=None):
+        """
+        Listing of root_dir and of its class directories, as _get_patients walks them. With a
+        cache_path, the file names of each class directory are cached with the directory mtime:
+        only the class directories whose mtime changed (files added, removed or renamed) are
+        listed again, the others are read from the cache.
+
+        Args:
+            root_dir (str): dataset directory, one sub-directory per class
+            cache_path (str): npz manifest cache, None to always list the directories
+        """
+        self.root_dir = root_dir
+        self.cache_path = cache_path
+        # the root is always listed, it is a single call and class_to_idx follows its order
+        self.names = os.listdir(root_dir)
+
+        cached = self.load() if cache_path is not None else {}
+        self.dirs = {}
+        self.mtimes = {}
+        self.num_rescanned = 0
+        for name in self.names:
+            try:
+                st = os.stat(os.path.join(root_dir, name))
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            self.mtimes[name] = st.st_mtime_ns
+            if name in cached and cached[name][0] == st.st_mtime_ns:
+                self.dirs[name] = cached[name][1]
+            else:
+                self.dirs[name] = os.listdir(os.path.join(root_dir, name))
+                self.num_rescanned += 1
+
+        if cache_path is not None and (self.num_rescanned > 0 or set(cached.keys()) != set(self.dirs.keys())):
+            self.save()
+
+    def listdir(self, cls_dir):
+        return self.dirs[cls_dir]
+
+    def isdir(self, cls_dir):
+        return cls_dir in self.dirs
+
+    def load(self):
+        """
+        return: {class dir: (mtime_ns, file names)} of the cache, empty if there is no readable cache
+        """
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            manifest = np.load(self.cache_path)
+            if str(manifest['root_dir']) != os.path.normpath(self.root_dir):
+                return {}
+            class_dirs = manifest['class_dirs'].tolist()
+            mtimes = manifest['mtimes'].tolist()
+            name_offsets = np.concatenate([[0], np.cumsum(manifest['name_counts'])]).tolist()
+            # file names cannot contain NUL, so they are stored as one NUL-separated utf-8 buffer
+            names = manifest['names'].tobytes().decode('utf-8', 'surrogateescape').split('\0') if name_offsets[-1] > 0 else []
+        except (OSError, KeyError, ValueError) as e:
+            print('Ignoring unreadable manifest cache %s: %s' % (self.cache_path, e))
+            return {}
+        return {class_dirs[i]: (mtimes[i], names[name_offsets[i]:name_offsets[i + 1]]) for i in range(len(class_dirs))}
+
+    def save(self):
+        class_dirs = list(self.dirs.keys())
+        names = '\0'.join(name for cls_dir in class_dirs for name in self.dirs[cls_dir])
+        buffer = io.BytesIO()
+        np.savez(buffer, root_dir=np.array(os.path.normpath(self.root_dir)), class_dirs=np.array(class_dirs, dtype=str),
+            mtimes=np.array([self.mtimes[cls_dir] for cls_dir in class_dirs], dtype=np.int64),
+            name_counts=np.array([len(self.dirs[cls_dir]) for cls_dir in class_dirs], dtype=np.int64),
+            names=np.frombuffer(names.encode('utf-8', 'surrogateescape'), dtype=np.uint8))
+        # write then rename, so ranks building the same dataset never read a partial file
+        tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            # the cache only saves listings, the dataset is built either way
+            print('Cannot write manifest cache %s: %s' % (self.cache_path, e))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
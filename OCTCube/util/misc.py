@@ -678,13 +678,69 @@ def find_and_convert_large_white_region(image, img_type='tensor'):
         return Image.fromarray(gray_image)
 
 
+def find_and_convert_large_white_region_batch(images):
+    """
+    Batched, loop-free find_and_convert_large_white_region for tensors.
+    images: [B, C, H, W]
+    return: images with the large edge-connected white regions of channel 0 set to 0 (repeated
+    over channels, as the per-image version does) and the white region masks, both [B, C, H, W]
+    """
+    B, C, H, W = images.shape
+    max_val = images.reshape(B, -1).max(dim=1).values
+    min_val = images.reshape(B, -1).min(dim=1).values
+
+    min_max_gap = max_val - min_val
+    thresh = max_val - (255 - 240) / 255 * min_max_gap
+    gray_image = images[:, 0].clone()
+    white_mask = gray_image > thresh.view(B, 1, 1)
+
+    rows = torch.arange(H, device=images.device).view(1, H, 1)
+    cols = torch.arange(W, device=images.device).view(1, 1, W)
+    row_has_white = torch.any(white_mask, dim=2).int()
+    top_row = torch.argmax(row_has_white, dim=1).view(B, 1, 1)
+    bottom_row = H - torch.argmax(row_has_white.flip(1), dim=1).view(B, 1, 1)
+    scan_rows = (rows >= top_row) & (rows < bottom_row)
+
+    # white run starting at the first white pixel of each row, left_end is the first non-white pixel after it (W if none)
+    first_white_pixel = torch.argmax(white_mask.int(), dim=2, keepdim=True)
+    left_end = torch.cumprod((white_mask | (cols < first_white_pixel)).int(), dim=2).sum(dim=2, keepdim=True)
+    left_rows = scan_rows & (first_white_pixel <= 0.01 * W)
+    left_region = (cols >= first_white_pixel) & (cols < left_end)
+    left_region |= (left_end < W) & (left_end > 0.05 * W) & (cols >= left_end) & (cols < left_end + 5)
+
+    # same from the last white pixel towards the left, right_end is the first non-white pixel before it (-1 if none)
+    flipped_white_mask = white_mask.flip(2)
+    last_white_pixel_flipped = torch.argmax(flipped_white_mask.int(), dim=2, keepdim=True)
+    last_white_pixel = W - 1 - last_white_pixel_flipped
+    right_end = W - 1 - torch.cumprod((flipped_white_mask | (cols < last_white_pixel_flipped)).int(), dim=2).sum(dim=2, keepdim=True)
+    right_rows = scan_rows & (last_white_pixel >= W - 0.01 * W)
+    right_region = (cols > right_end) & (cols <= last_white_pixel)
+    # the per-image loop marks [col:col-5], which is only non-empty when col - 5 wraps around
+    right_region |= (right_end >= 0) & (right_end < 5) & (right_end < W - 0.05 * W) & (cols >= right_end) & (cols < right_end - 5 + W)
+
+    connected_region = (left_rows & left_region) | (right_rows & right_region)
+    gray_image[connected_region] = 0
+
+    return gray_image.unsqueeze(1).repeat(1, C, 1, 1), connected_region.unsqueeze(1).repeat(1, C, 1, 1)
+
+
+def white_region_collate(batch):
+    """
+    collate_fn for the 2D pre-training loaders that runs find_and_convert_large_white_region_batch
+    in the DataLoader workers, so the main loop never does it.
+    return: (samples [B, 1, C, H, W] with the white regions set to 0, info, white region masks [B, 1, C, H, W])
+    """
+    samples, info = torch.utils.data.dataloader.default_collate(batch)
+    converted_samples, white_region = find_and_convert_large_white_region_batch(samples.flatten(0, 1))
+    return converted_samples.view_as(samples), info, white_region.view_as(samples)
 
-def get_mask(x, img_type='3D', high_res=False, high_res_input_size = (20, 32, 32), input_size=(20, 16, 16), p_emb_mask_ratio=0.6, patch_size=16, pre_masks=None, return_tensor=True):
-
-    x_norm = F.normalize(x.float(), p=2, dim=2)
-    cosine_similarity = torch.matmul(x_norm, x_norm.transpose(1, 2))
 
-    actual_hwt = cosine_similarity.shape[1]
+def get_mask(x, img_type='3D', high_res=False, high_res_input_size = (20, 32, 32), input_size=(20, 16, 16), p_emb_mask_ratio=0.6, patch_size=16, pre_masks=None, return_tensor=True):
+    """
+    x: [N, T * L, C], patch embeddings of a batch of volumes
+    return: [N, T, h, w] pre-mask tensor (1 is masked), or a list of N [T, h, w] tensors if not return_tensor
+    """
+    N, actual_hwt, C = x.shape
 
     if img_type == '3D':
         if high_res:
@@ -698,57 +754,41 @@ def get_mask(x, img_type='3D', high_res=False, high_res_input_size = (20, 32, 32
             input_size = (temporal, input_size[1], input_size[2])
             h = int(input_size[1])
 
-        diag_cosine_similarity_list = [torch.stack([cosine_similarity[n, i*pos_hw:(i+1)*pos_hw, i*pos_hw:(i+1)*pos_hw] for i in range(temporal)]) for n in range(cosine_similarity.shape[0])]
-
         num_frames = temporal
         hw = pos_hw
 
     fill_gap = 5 if high_res else 2
     up_down_clear = 6 if high_res else 3
     fill_bottom_center = True if not high_res else False
-    batched_filled_mask_list = []
     s_size = int(pos_hw ** 0.5)
     top_k = int(pos_hw * p_emb_mask_ratio)
-    for b in range(cosine_similarity.shape[0]):
-        diag_cosine_similarity = diag_cosine_similarity_list[b]
-        unmask_ratio = np.zeros(num_frames)
-        adjusted_mask_list = np.zeros((num_frames, s_size, s_size))
-        for n in range(num_frames):
-
-            mask_cos = diag_cosine_similarity[n]
-            sum_cosine_similarity = mask_cos.sum(dim=1) / pos_hw
-
-
-            _, indices = torch.topk(sum_cosine_similarity, top_k)
-
-
-            patched_imgs = torch.zeros(s_size, s_size)
-            j_indices = indices % s_size
-            i_indices = indices // s_size
-            patched_imgs[i_indices, j_indices] = 1
 
+    # Only the per-frame [L, L] diagonal blocks of the [T * L, T * L] similarity are used,
+    # so compute them directly with one batched matmul over all N * T frames
+    x_norm = F.normalize(x[:, :num_frames * pos_hw].float(), p=2, dim=2)
+    x_norm = x_norm.reshape(N * num_frames, pos_hw, C)
+    diag_cosine_similarity = torch.bmm(x_norm, x_norm.transpose(1, 2))
+    sum_cosine_similarity = diag_cosine_similarity.sum(dim=2) / pos_hw
+    _, indices = torch.topk(sum_cosine_similarity, top_k, dim=1)
 
-            adjusted_mask, col_median = process_and_adjust_mask(patched_imgs, pos_idx=h, fill_gap=fill_gap, up_down_clear=up_down_clear, fill_bottom_center=fill_bottom_center)
-            ratio_unmasked = 1 - np.sum(adjusted_mask) / (pos_hw)
-            unmask_ratio[n] = ratio_unmasked
-            adjusted_mask_list[n] = adjusted_mask
+    patched_imgs = torch.zeros(N * num_frames, pos_hw)
+    patched_imgs.scatter_(1, indices.cpu(), 1)
+    patched_imgs = patched_imgs.reshape(N, num_frames, s_size, s_size)
 
+    adjusted_masks, _ = process_and_adjust_mask_batch(patched_imgs.numpy(), pos_idx=h, fill_gap=fill_gap, up_down_clear=up_down_clear, fill_bottom_center=fill_bottom_center)
+    unmask_ratio = 1 - adjusted_masks.sum(axis=(2, 3), dtype=np.float32) / pos_hw
+    max_unmask_ratio = unmask_ratio.max(axis=1).astype(np.float64)
+    max_to_unmask_number = (pos_hw * max_unmask_ratio).astype(np.int64)
+    max_to_mask_number = pos_hw - max_to_unmask_number
+    anchor_num_mask = pos_hw // 2
+    actual_to_mask_number = np.minimum(max_to_mask_number, anchor_num_mask)
 
-        max_unmask_ratio = np.max(unmask_ratio)
-        max_to_unmask_number = int(pos_hw * max_unmask_ratio)
-        max_to_mask_number = pos_hw - max_to_unmask_number
-        anchor_num_mask = pos_hw // 2
-        actual_to_mask_number = min(max_to_mask_number, anchor_num_mask)
+    filled_masks = fill_patch_mask_to_ratio_batch(adjusted_masks, to_mask_number=actual_to_mask_number[:, None])
+    filled_masks = torch.from_numpy(filled_masks).float()
 
-        filled_mask_list = torch.zeros(num_frames, s_size, s_size)
-        for n in range(num_frames):
-            adjusted_mask = adjusted_mask_list[n]
-            filled_mask = fill_patch_mask_to_ratio(adjusted_mask, to_mask_number=actual_to_mask_number)
-
-            filled_mask_list[n] = torch.tensor(filled_mask)
-
-        batched_filled_mask_list.append(filled_mask_list)
-    return batched_filled_mask_list
+    if not return_tensor:
+        return list(filled_masks)
+    return filled_masks
 
 
 def process_and_adjust_mask(mask, pos_idx=16, fill_gap=2, up_down_clear=3, fill_bottom_center=False, fill_holes=False):
@@ -922,6 +962,143 @@ def find_longest_zero_sequence(nums):
 
     return (longest_start, longest_start + longest_length - 1)
 
+
+def find_longest_zero_sequence_batch(nums, axis=-1):
+    """
+    Vectorized find_longest_zero_sequence along one axis of an array.
+    return: (start, end) int arrays with that axis removed, (0, 0) where there is no zero
+    """
+    is_zero = np.moveaxis(np.asarray(nums) == 0, axis, -1)
+    zero_cnt = np.cumsum(is_zero, axis=-1)
+    # length of the zero run ending at each position: zeros seen minus zeros seen up to the last non-zero
+    run_length = zero_cnt - np.maximum.accumulate(np.where(is_zero, 0, zero_cnt), axis=-1)
+    longest_length = run_length.max(axis=-1)
+    # the first position reaching the maximum is the end of the first longest run
+    longest_end = run_length.argmax(axis=-1)
+    no_zero = longest_length == 0
+    longest_start = np.where(no_zero, 0, longest_end - longest_length + 1)
+    longest_end = np.where(no_zero, 0, longest_end)
+    return longest_start, longest_end
+
+
+def process_and_adjust_mask_batch(masks, pos_idx=16, fill_gap=2, up_down_clear=3, fill_bottom_center=False):
+    """
+    Vectorized process_and_adjust_mask over a stack of masks.
+    masks: [..., H, W], e.g. [N, T, H, W]
+    return: adjusted masks [..., H, W] and column medians [..., W]
+    """
+    adjusted_mask = np.array(masks, copy=True)
+    H, W = adjusted_mask.shape[-2:]
+    batch_shape = adjusted_mask.shape[:-2]
+    adjusted_mask = adjusted_mask.reshape(-1, H, W)
+    rows = np.arange(H)[None, :, None]
+    cols = np.arange(W)
+
+    boundary_dist = int(pos_idx // 8)
+    center_cols = (cols >= boundary_dist) & (cols <= pos_idx - boundary_dist)
+
+    adjusted_mask[:, (pos_idx-up_down_clear):, center_cols] = 1
+    longest_start, _ = find_longest_zero_sequence_batch(adjusted_mask, axis=1)
+    clear_top = center_cols & (longest_start > up_down_clear)
+    adjusted_mask[(rows < up_down_clear) & clear_top[:, None, :]] = 1
+
+    # median row of the unmasked patches of each column, from the ranks of its zeros
+    is_zero = adjusted_mask == 0
+    zero_num = is_zero.sum(axis=1)
+    zero_cnt = np.cumsum(is_zero, axis=1)
+    lower = np.argmax(zero_cnt > ((zero_num - 1) // 2)[:, None, :], axis=1)
+    upper = np.argmax(zero_cnt > (zero_num // 2)[:, None, :], axis=1)
+    median = np.round((lower + upper) / 2).astype(np.int64)
+    has_zero = zero_num > 0
+    col_median = np.where(has_zero, median, 0).astype(np.float64)
+    adjusted_mask[(np.abs(rows - median[:, None, :]) <= fill_gap) & has_zero[:, None, :]] = 0
+
+    if fill_bottom_center:
+        band_cols = (cols >= boundary_dist) & (cols < pos_idx - boundary_dist)
+        up_width = int(band_cols.sum())
+        bottoms = np.arange(pos_idx - up_down_clear, pos_idx // 2, -1)
+        if len(bottoms) > 0 and up_width > 0:
+            bottom_rows = adjusted_mask[:, bottoms][:, :, band_cols]
+            low_rows = bottom_rows.sum(axis=2) / up_width < 0.2
+            set_bottom_flag = low_rows.any(axis=1)
+            flag_bottom = bottoms[np.argmax(low_rows, axis=1)]
+
+            # lowest scanned row where each column is unmasked, 0 if none
+            bottom_zero = bottom_rows == 0
+            col_bottom = np.where(bottom_zero.any(axis=1), bottoms[np.argmax(bottom_zero, axis=1)], 0)
+            max_col_bottom = col_bottom.max(axis=1)
+            col_bottom_new = col_bottom - (col_bottom == max_col_bottom[:, None])
+            max_col_bottom_new = col_bottom_new.max(axis=1)
+            sum_max = (col_bottom_new == max_col_bottom_new[:, None]).sum(axis=1)
+            set_max_flag = ~set_bottom_flag & (col_bottom.sum(axis=1) > 0) & (sum_max / up_width > 0.8)
+
+            clear_row = np.where(set_bottom_flag, flag_bottom, max_col_bottom)[:, None, None]
+            # same start as the slice [row - fill_gap - 1:row], negative starts wrap around
+            band_start = clear_row - fill_gap - 1
+            band_start = np.where(band_start < 0, np.maximum(band_start + H, 0), band_start)
+            in_band = (rows >= band_start) & (rows < clear_row) & band_cols
+            to_clear = (set_bottom_flag | set_max_flag)[:, None, None]
+            adjusted_mask[to_clear & ((rows == clear_row) | in_band)] = 0
+
+    return adjusted_mask.reshape(batch_shape + (H, W)), col_median.reshape(batch_shape + (W,))
+
+
+def fill_patch_mask_to_ratio_batch(masks, to_mask_number=None):
+    """
+    Vectorized fill_patch_mask_to_ratio over a stack of masks.
+    masks: [..., H, W], to_mask_number: scalar or array broadcastable to masks.shape[:-2]
+    All masks advance one patch per column per sweep like the per-mask loop, which also stops
+    mid-sweep once enough patches are unmasked. A mask whose columns are all exhausted is
+    returned as is, where the per-mask loop would never terminate.
+    """
+    filled_mask = np.array(masks, copy=True)
+    H, W = filled_mask.shape[-2:]
+    batch_shape = filled_mask.shape[:-2]
+    filled_mask = filled_mask.reshape(-1, H, W)
+    if to_mask_number is None:
+        to_mask_number = H * W // 2
+    to_mask_number = np.broadcast_to(np.asarray(to_mask_number), batch_shape).reshape(-1)
+    num_to_unmask = filled_mask.sum(axis=(1, 2)) - to_mask_number
+
+    bg_dist = W // 8
+    cols = np.arange(bg_dist, H - bg_dist)
+    top_idx, bottom_idx = find_longest_zero_sequence_batch(filled_mask, axis=1)
+    top_idx = top_idx[:, cols]
+    fill_idx_start_idx = bottom_idx[:, cols] + 1
+    index_iter_type = np.zeros_like(fill_idx_start_idx) # 0: bottom, 1: top, -1: done
+    number_filled = np.zeros(len(filled_mask))
+    batch_idx = np.arange(len(filled_mask))[:, None]
+
+    active = num_to_unmask > 0
+    while active.any():
+        select_idx = fill_idx_start_idx
+        to_top = select_idx >= H
+        select_idx = np.where(to_top, top_idx - 1, select_idx)
+        index_iter_type = np.where(to_top, np.where(select_idx < 0, -1, 1), index_iter_type)
+        # index -1 reads the last row, as in the per-mask loop
+        select_idx = select_idx % H
+        value = filled_mask[batch_idx, select_idx, cols]
+
+        live = index_iter_type != -1
+        unmask = live & (value == 1) & active[:, None]
+        unmask &= np.cumsum(unmask, axis=1) <= (num_to_unmask - number_filled)[:, None]
+        b, j = np.nonzero(unmask)
+        filled_mask[b, select_idx[b, j], cols[j]] = 0
+        number_filled += unmask.sum(axis=1)
+
+        # both already unmasked and newly unmasked patches move the column to its next candidate
+        step = live & ((value == 0) | (value == 1))
+        fill_idx_start_idx = np.where(step, fill_idx_start_idx + np.where(index_iter_type == 0, 1, -1), fill_idx_start_idx)
+        to_top = step & (fill_idx_start_idx >= H)
+        fill_idx_start_idx = np.where(to_top, top_idx - 1, fill_idx_start_idx)
+        index_iter_type = np.where(to_top, 1, index_iter_type)
+        index_iter_type = np.where(step & (fill_idx_start_idx < 0), -1, index_iter_type)
+
+        active = (number_filled < num_to_unmask) & (index_iter_type != -1).any(axis=1)
+
+    return filled_mask.reshape(batch_shape + (H, W))
+
+
 def str_to_int_list(arg):
     try:
         return [int(x) for x in arg.split(',')]
@@ -0,0 +1,217 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import atexit
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import types
+
+import numpy as np
+import torch
+
+MISSING = -1
+ON_DISK = -2
+
+
+def is_random_transform(transform):
+    """
+    return: True if the transform or one of its sub-transforms draws random parameters (monai Rand*, torchvision Random*)
+    """
+    if transform is None:
+        return False
+    if type(transform).__name__.startswith(('Rand', 'Random')):
+        return True
+    return any(is_random_transform(t) for t in getattr(transform, 'transforms', []))
+
+
+def describe_transform(obj, depth=0):
+    """
+    return: picklable description of obj (class names and attributes), without the random states
+    (monai transforms carry a RandomState that differs between the DataLoader workers)
+    """
+    if depth > 8:
+        return None
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        return obj
+    if isinstance(obj, (np.random.RandomState, np.random.Generator, torch.Generator)):
+        return None
+    if isinstance(obj, (list, tuple)):
+        return [describe_transform(o, depth + 1) for o in obj]
+    if isinstance(obj, dict):
+        return sorted((str(k), describe_transform(v, depth + 1)) for k, v in obj.items())
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach().cpu().numpy()
+    if isinstance(obj, np.ndarray):
+        return (str(obj.dtype), obj.shape, obj.tobytes())
+    if isinstance(obj, types.FunctionType):
+        return (obj.__module__, obj.__qualname__, obj.__code__.co_code, describe_transform(obj.__defaults__, depth + 1))
+    if isinstance(obj, (np.generic, type, types.BuiltinFunctionType)):
+        return repr(obj)
+    if hasattr(obj, '__dict__'):
+        return (type(obj).__module__, type(obj).__qualname__, describe_transform(vars(obj), depth + 1))
+    return repr(obj)
+
+
+class TensorCache:
+    def __init__(self, num_items, shm_cache_gb=8, spill_dir=None, cache_dtype='float16'):
+        """
+        Cache of the outputs of deterministic (val / test) transforms, keyed by (dataset idx,
+        transform fingerprint), shared by the DataLoader workers of every epoch and fold of a run.
+        Items are kept in memory-mapped slots in /dev/shm up to shm_cache_gb; further items spill to
+        a disk memmap in spill_dir (not cached if spill_dir is None). Slots are never evicted:
+        evaluation scans the split in the same order every epoch, where an LRU would always miss
+        once the split outgrows the memory budget, while pinned items keep hitting.
+
+        Args:
+            num_items (int): length of the dataset the indices refer to
+            shm_cache_gb (float): memory budget of the shared-memory tier
+            spill_dir (str): directory of the disk tier, None to only cache in shared memory
+            cache_dtype (str): 'float16', 'float32', or 'uint8' (for tensors in [0, 1], quantized to 1/255)
+        """
+        assert cache_dtype in ['float16', 'float32', 'uint8']
+        self.num_items = num_items
+        self.shm_cache_bytes = int(shm_cache_gb * 1024 ** 3)
+        self.cache_dtype = cache_dtype
+        # run-scoped directories, removed when the creating process exits
+        shm_root = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.shm_dir = tempfile.mkdtemp(prefix='tensor_cache_', dir=shm_root)
+        self.spill_dir = tempfile.mkdtemp(prefix='tensor_cache_', dir=spill_dir) if spill_dir is not None else None
+        self.owner_pid = os.getpid()
+        atexit.register(self.cleanup)
+
+        self.lock = multiprocessing.Lock()
+        self.tables = {}
+
+    def cleanup(self):
+        if os.getpid() != self.owner_pid:
+            return
+        for cache_dir in [self.shm_dir, self.spill_dir]:
+            if cache_dir is not None:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def __getstate__(self):
+        # memory maps are re-opened in the receiving process
+        state = self.__dict__.copy()
+        state['tables'] = {}
+        return state
+
+    def get_table_dir(self, key, tier):
+        return os.path.join(self.shm_dir if tier == 'shm' else self.spill_dir, key)
+
+    def open_table(self, key):
+        if key in self.tables:
+            return self.tables[key]
+        meta_path = os.path.join(self.get_table_dir(key, 'shm'), 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        table = {'meta': meta}
+        shm_table_dir = self.get_table_dir(key, 'shm')
+        # state[idx]: slot in the shared-memory tier, ON_DISK, or MISSING; state[-1]: next free slot
+        table['state'] = np.load(os.path.join(shm_table_dir, 'state.npy'), mmap_mode='r+')
+        table['labels'] = np.load(os.path.join(shm_table_dir, 'labels.npy'), mmap_mode='r+')
+        table['shm'] = np.load(os.path.join(shm_table_dir, 'data.npy'), mmap_mode='r+') if meta['capacity'] > 0 else None
+        table['disk'] = np.load(os.path.join(self.get_table_dir(key, 'disk'), 'data.npy'), mmap_mode='r+') if self.spill_dir is not None else None
+        self.tables[key] = table
+        return table
+
+    def create_table(self, key, x, y):
+        # called with the lock held
+        item_bytes = x.numel() * np.dtype(self.cache_dtype).itemsize
+        capacity = min(self.shm_cache_bytes // max(item_bytes, 1), self.num_items)
+        shape = list(x.shape)
+        label = np.asarray(y.numpy() if isinstance(y, torch.Tensor) else y)
+        shm_table_dir = self.get_table_dir(key, 'shm')
+        os.makedirs(shm_table_dir, exist_ok=True)
+        state = np.lib.format.open_memmap(os.path.join(shm_table_dir, 'state.npy'), mode='w+', dtype=np.int64, shape=(self.num_items + 1,))
+        state[:self.num_items] = MISSING
+        state[self.num_items] = 0
+        state.flush()
+        np.lib.format.open_memmap(os.path.join(shm_table_dir, 'labels.npy'), mode='w+', dtype=label.dtype, shape=(self.num_items,) + label.shape).flush()
+        if capacity > 0:
+            np.lib.format.open_memmap(os.path.join(shm_table_dir, 'data.npy'), mode='w+', dtype=self.cache_dtype, shape=tuple([capacity] + shape)).flush()
+        if self.spill_dir is not None:
+            os.makedirs(self.get_table_dir(key, 'disk'), exist_ok=True)
+            # sparse file, only the spilled items take disk space
+            np.lib.format.open_memmap(os.path.join(self.get_table_dir(key, 'disk'), 'data.npy'), mode='w+', dtype=self.cache_dtype, shape=tuple([self.num_items] + shape)).flush()
+        meta = {'shape': shape, 'capacity': int(capacity), 'x_dtype': str(x.dtype).replace('torch.', ''),
+            'label_type': 'tensor' if isinstance(y, torch.Tensor) else ('scalar' if label.ndim == 0 else 'array')}
+        # meta.json is written last, its presence marks the table as ready
+        with open(os.path.join(shm_table_dir, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(shm_table_dir, 'meta.json.tmp'), os.path.join(shm_table_dir, 'meta.json'))
+
+    def get(self, key, idx):
+        """
+        return: cached (x, y) of the dataset idx under the transform key, None on a miss
+        """
+        table = self.open_table(key)
+        if table is None:
+            return None
+        slot = int(table['state'][idx])
+        if slot == MISSING:
+            return None
+        data = table['disk'][idx] if slot == ON_DISK else table['shm'][slot]
+        x = torch.from_numpy(np.array(data))
+        x = x.float().div_(255) if self.cache_dtype == 'uint8' else x
+        x = x.to(getattr(torch, table['meta']['x_dtype']))
+        y = np.array(table['labels'][idx])
+        label_type = table['meta']['label_type']
+        y = torch.from_numpy(y) if label_type == 'tensor' else (y.item() if label_type == 'scalar' else y)
+        return x, y
+
+    def put(self, key, idx, x, y):
+        """
+        Store the transformed x and its label y; tensors of another shape than the first one cached
+        under the key (or outside [0, 1] for uint8) are not cached
+        """
+        if not isinstance(x, torch.Tensor):
+            return
+        x = x.detach().cpu().as_subclass(torch.Tensor)
+        if self.cache_dtype == 'uint8':
+            if x.numel() > 0 and (x.min() < 0 or x.max() > 1):
+                return
+            data = (x.float() * 255).round_().to(torch.uint8).numpy()
+        else:
+            data = x.to(getattr(torch, self.cache_dtype)).numpy()
+
+        with self.lock:
+            table = self.open_table(key)
+            if table is None:
+                self.create_table(key, x, y)
+                table = self.open_table(key)
+            if list(x.shape) != table['meta']['shape'] or table['state'][idx] != MISSING:
+                return
+            slot = int(table['state'][self.num_items])
+            if slot < table['meta']['capacity']:
+                table['state'][self.num_items] = slot + 1
+            elif table['disk'] is not None:
+                slot = ON_DISK
+            else:
+                return
+
+        if slot == ON_DISK:
+            table['disk'][idx] = data
+        else:
+            table['shm'][slot] = data
+        table['labels'][idx] = y.numpy() if isinstance(y, torch.Tensor) else y
+        # the item becomes visible once its data is written
+        table['state'][idx] = slot
+
+
+def get_transform_fingerprint(*transforms):
+    """
+    return: hash of the transforms, None if one of them is random (its output cannot be cached)
+    """
+    if any(is_random_transform(transform) for transform in transforms):
+        return None
+    return hashlib.sha1(pickle.dumps(describe_transform(transforms))).hexdigest()[:16]
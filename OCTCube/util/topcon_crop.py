@@ -0,0 +1,33 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Crop params of the AI-READI Topcon (Maestro2 / Triton) OCT volumes, computed by
+# PatientDataset.get_topcon_crop_params or read from the sidecar tsv of precompute_aireadi_crop_params.py
+
+topcon_crop_param_keys = ['crop_start_col', 'crop_end_col', 'first_row_not_all_zero', 'last_row_not_all_zero', 'actual_gap', 'min_pixel_val', 'max_pixel_value']
+
+# pixels below min_pixel_val are set to min_pixel_val minus this offset, floored at 0
+topcon_min_pixel_offset = {'Maestro2': 10, 'Triton': 0}
+
+
+def apply_topcon_crop_params(volume, crop_params, manufacturers_model_name):
+    """
+    Clip the pixel range and crop the rows of a Topcon OCT volume, the same way whether the crop
+    params were just computed by get_topcon_crop_params or read from the oct_metadata / sidecar tsv.
+
+    Args:
+        volume (np.ndarray): [D, H, W] pixel array of the dicom file
+        crop_params (dict): with the topcon_crop_param_keys
+        manufacturers_model_name (str): 'Maestro2' or 'Triton'
+    return: [D, crop_end_col - crop_start_col, W] volume
+    """
+    min_pixel_val = crop_params['min_pixel_val']
+    max_pixel_value = crop_params['max_pixel_value']
+    volume = volume[:, crop_params['crop_start_col']:crop_params['crop_end_col'], :]
+    # min_pixel_val can be below the offset, and a negative value does not fit the uint8 dicom pixels
+    volume[volume < min_pixel_val] = max(min_pixel_val - topcon_min_pixel_offset.get(manufacturers_model_name, 0), 0)
+    volume[volume > max_pixel_value] = max_pixel_value
+    return volume
@@ -17,8 +17,13 @@ except ModuleNotFoundError:
         sys.path.append('../')  # Add OCTCubeM/ to path
         from util import loggings as logging
 
+import importlib.util
+import re
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from timm.models.layers import to_2tuple
 from timm.models.vision_transformer import DropPath, Mlp
 
@@ -26,6 +31,113 @@ from timm.models.vision_transformer import DropPath, Mlp
 logger = logging.get_logger(__name__)
 
 
+# attention kernels, (q, k, v [B, num_heads, N, head_dim], scale) -> [B, num_heads, N, head_dim]
+ATTENTION_BACKENDS = {}
+
+
+def register_attention_backend(name):
+    def register(attn_fn):
+        ATTENTION_BACKENDS[name] = attn_fn
+        return attn_fn
+
+    return register
+
+
+@register_attention_backend("naive")
+def naive_attention(q, k, v, scale):
+    # materializes the [B, num_heads, N, N] attention matrix
+    attn = (q @ k.transpose(-2, -1)) * scale
+    attn = attn.softmax(dim=-1)
+    return attn @ v
+
+
+@register_attention_backend("sdpa")
+def sdpa_attention(q, k, v, scale):
+    # flash / memory-efficient / math kernel picked by PyTorch for the device and dtype
+    return F.scaled_dot_product_attention(q, k, v, scale=scale)
+
+
+@register_attention_backend("flash")
+def flash_attention(q, k, v, scale):
+    from flash_attn import flash_attn_func
+
+    # flash_attn_func takes [B, N, num_heads, head_dim] fp16 / bf16 tensors
+    input_dtype = q.dtype
+    dtype = input_dtype if input_dtype in (torch.float16, torch.bfloat16) else torch.float16
+    q, k, v = [t.transpose(1, 2).to(dtype) for t in (q, k, v)]
+    x = flash_attn_func(q, k, v, softmax_scale=scale)
+    return x.transpose(1, 2).to(input_dtype)
+
+
+def get_attention_backend(name):
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(
+            f"Unknown attention backend {name}, choose from {list(ATTENTION_BACKENDS)}"
+        )
+    return ATTENTION_BACKENDS[name]
+
+
+def resolve_attention_backend(attn_backend=None, use_flash_attn=False):
+    """
+    return: attn_backend, by default flash for the use_flash_attn models when flash-attn is
+    installed and sdpa otherwise
+    """
+    if attn_backend is None:
+        flash_available = importlib.util.find_spec("flash_attn") is not None
+        attn_backend = "flash" if use_flash_attn and flash_available else "sdpa"
+    get_attention_backend(attn_backend)
+    return attn_backend
+
+
+def convert_flash_to_qkv_state_dict(state_dict):
+    """
+    Reverse of key_mapping_attn in the flash-attn models: the fused mixer.Wqkv and the
+    mixer.out_proj weights of the flash-attn blocks are mapped back to the attn.q, attn.k,
+    attn.v and attn.proj weights of Attention, other keys are kept
+    """
+    converted = OrderedDict()
+    for key, value in state_dict.items():
+        match = re.match(r"(.*blocks\.\d+)\.mixer\.Wqkv\.(weight|bias)$", key)
+        if match:
+            for name, chunk in zip(["q", "k", "v"], value.chunk(3, dim=0)):
+                converted[f"{match.group(1)}.attn.{name}.{match.group(2)}"] = chunk
+        else:
+            key = re.sub(r"blocks\.(\d+)\.mixer\.out_proj\.", r"blocks.\1.attn.proj.", key)
+            converted[key] = value
+    return converted
+
+
+def flash_to_qkv_load_state_dict_pre_hook(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    # loads the mixer.Wqkv / mixer.out_proj weights of a flash-attn block into the attn of Block / PrenormBlock,
+    # so any load_state_dict of the sdpa / naive models takes flash-attn checkpoints (see convert_flash_to_qkv_state_dict)
+    for param in ["weight", "bias"]:
+        key = f"{prefix}mixer.Wqkv.{param}"
+        if key in state_dict:
+            for name, chunk in zip(["q", "k", "v"], state_dict.pop(key).chunk(3, dim=0)):
+                state_dict[f"{prefix}attn.{name}.{param}"] = chunk
+        key = f"{prefix}mixer.out_proj.{param}"
+        if key in state_dict:
+            state_dict[f"{prefix}attn.proj.{param}"] = state_dict.pop(key)
+
+
+def get_missing_attention_keys(missing_keys, block_prefix="blocks"):
+    """
+    return: the attention weights of the block_prefix blocks among the missing_keys of load_state_dict
+    """
+    return [key for key in missing_keys if re.match(rf"{block_prefix}\.\d+\.(attn|mixer)\.", key)]
+
+
+def check_attention_keys_loaded(msg, block_prefix="blocks"):
+    """
+    Fail if load_state_dict(..., strict=False) left attention weights of the blocks at their random
+    initialization, e.g., a checkpoint of another attention layout
+    return: msg
+    """
+    missing_attention_keys = get_missing_attention_keys(msg.missing_keys, block_prefix=block_prefix)
+    assert not missing_attention_keys, f"{len(missing_attention_keys)} attention weights not in the checkpoint: {missing_attention_keys[:4]} ..."
+    return msg
+
+
 class PatchEmbed(nn.Module):
     """Image to Patch Embedding"""
 
@@ -86,6 +198,24 @@ class PatchEmbed(nn.Module):
         return x
 
 
+def split_qkv_state_dict_hook(module, state_dict, prefix, local_metadata):
+    # saves the fused qkv of Attention as q, k and v, the layout of the checkpoints
+    for param in ["weight", "bias"]:
+        key = f"{prefix}qkv.{param}"
+        if key in state_dict:
+            for name, chunk in zip(["q", "k", "v"], state_dict.pop(key).chunk(3, dim=0)):
+                state_dict[f"{prefix}{name}.{param}"] = chunk
+    return state_dict
+
+
+def fuse_qkv_load_state_dict_pre_hook(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    # loads q, k and v weights (checkpoints, read_in_q_k_v) into the fused qkv of Attention
+    for param in ["weight", "bias"]:
+        keys = [f"{prefix}{name}.{param}" for name in ["q", "k", "v"]]
+        if all(key in state_dict for key in keys):
+            state_dict[f"{prefix}qkv.{param}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+
 class Attention(nn.Module):
     def __init__(
         self,
@@ -96,6 +226,8 @@ class Attention(nn.Module):
         attn_drop=0.0,
         proj_drop=0.0,
         input_size=(4, 14, 14),
+        attn_backend="sdpa",
+        fused_qkv=False,
     ):
         super().__init__()
         assert dim % num_heads == 0, "dim should be divisible by num_heads"
@@ -103,17 +235,30 @@ class Attention(nn.Module):
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim**-0.5
 
-        self.q = nn.Linear(dim, dim, bias=qkv_bias)
-        self.k = nn.Linear(dim, dim, bias=qkv_bias)
-        self.v = nn.Linear(dim, dim, bias=qkv_bias)
+        self.fused_qkv = fused_qkv
+        if fused_qkv:
+            # one GEMM for q, k and v; the state dicts keep the q / k / v layout, see the hooks below
+            self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
+            self._register_state_dict_hook(split_qkv_state_dict_hook)
+            self._register_load_state_dict_pre_hook(fuse_qkv_load_state_dict_pre_hook)
+        else:
+            self.q = nn.Linear(dim, dim, bias=qkv_bias)
+            self.k = nn.Linear(dim, dim, bias=qkv_bias)
+            self.v = nn.Linear(dim, dim, bias=qkv_bias)
         assert attn_drop == 0.0  # do not use
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
         self.input_size = input_size
         assert input_size[1] == input_size[2]
+        self.attn_backend = attn_backend
+        self.attn_fn = get_attention_backend(attn_backend)
 
     def forward(self, x):
         B, N, C = x.shape
+        if self.fused_qkv:
+            qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads)
+            q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+            return self.forward_attn(q, k, v)
         q = (
             self.q(x)
             .reshape(B, N, self.num_heads, C // self.num_heads)
@@ -129,12 +274,14 @@ class Attention(nn.Module):
             .reshape(B, N, self.num_heads, C // self.num_heads)
             .permute(0, 2, 1, 3)
         )
+        return self.forward_attn(q, k, v)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
+    def forward_attn(self, q, k, v):
+        B, _, N, _ = q.shape
+        C = self.proj.in_features
+        x = self.attn_fn(q, k, v, self.scale)
 
-        attn = attn.softmax(dim=-1)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         x = x.view(B, -1, C)
@@ -170,6 +317,7 @@ class Block(nn.Module):
             attn_drop=attn_drop,
             proj_drop=drop,
         )
+        self._register_load_state_dict_pre_hook(flash_to_qkv_load_state_dict_pre_hook)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -185,3 +333,121 @@ class Block(nn.Module):
         x = x + self.drop_path(self.attn(self.norm1(x)))
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
+
+
+class PrenormBlock(nn.Module):
+    """
+    Transformer Block with the pre-norm residual interface of the flash-attn blocks
+    (flash_attn.models.vit.create_block): forward(x, residual) -> (mlp output, residual stream),
+    so the use_flash_attn models run with any attention backend with the same outputs, and load
+    the flash-attn checkpoints through flash_to_qkv_load_state_dict_pre_hook
+    """
+
+    def __init__(
+        self,
+        dim,
+        num_heads,
+        mlp_ratio=4.0,
+        qkv_bias=False,
+        qk_scale=None,
+        drop=0.0,
+        attn_drop=0.0,
+        drop_path1=0.0,
+        drop_path2=0.0,
+        act_layer=nn.GELU,
+        norm_layer=nn.LayerNorm,
+        attn_func=Attention,
+    ):
+        super().__init__()
+        self.dropout1 = nn.Dropout(drop)
+        self.drop_path1 = DropPath(drop_path1) if drop_path1 > 0.0 else nn.Identity()
+        self.norm1 = norm_layer(dim)
+        self.attn = attn_func(
+            dim,
+            num_heads=num_heads,
+            qkv_bias=qkv_bias,
+            qk_scale=qk_scale,
+            attn_drop=attn_drop,
+        )
+        self._register_load_state_dict_pre_hook(flash_to_qkv_load_state_dict_pre_hook)
+        self.dropout2 = nn.Dropout(drop)
+        self.drop_path2 = DropPath(drop_path2) if drop_path2 > 0.0 else nn.Identity()
+        self.norm2 = norm_layer(dim)
+        mlp_hidden_dim = int(dim * mlp_ratio)
+        self.mlp = Mlp(
+            in_features=dim,
+            hidden_features=mlp_hidden_dim,
+            act_layer=act_layer,
+        )
+
+    def forward(self, x, residual=None):
+        dropped = self.drop_path1(self.dropout1(x))
+        residual = (dropped + residual) if residual is not None else dropped
+        x = self.norm1(residual.to(dtype=self.norm1.weight.dtype))
+        # residual stream in fp32, as residual_in_fp32 of create_block
+        residual = residual.to(torch.float32)
+        x = self.attn(x)
+        dropped = self.drop_path2(self.dropout2(x))
+        residual = dropped + residual
+        x = self.norm2(residual.to(dtype=self.norm2.weight.dtype))
+        x = self.mlp(x)
+        return x, residual
+
+
+def make_layer_tap(pool=None, num_prefix_tokens=1, to_cpu=False, dtype=None):
+    """
+    Args:
+        pool (str): None keeps all the tokens, 'mean' averages the tokens after the num_prefix_tokens
+            prefix (cls) tokens, 'cls' keeps the first token
+        num_prefix_tokens (int): number of prefix tokens excluded from the 'mean' pooling
+        to_cpu (bool): detach and copy the tapped output to CPU
+        dtype (torch.dtype): cast the tapped output, e.g., torch.float16, None keeps the dtype
+    return: tap_fn for LayerTaps, applied to each tapped block output as soon as it is produced
+    """
+    if pool not in [None, 'mean', 'cls']:
+        raise ValueError(f"Unknown pool {pool}, expected None, 'mean' or 'cls'")
+
+    def tap_fn(x):
+        if pool is not None:
+            # [N, T, L, C] -> [N, T * L, C]
+            x = x.reshape(x.shape[0], -1, x.shape[-1])
+            x = x[:, num_prefix_tokens:, :].mean(dim=1) if pool == 'mean' else x[:, 0]
+        if to_cpu:
+            x = x.detach().to('cpu')
+        if dtype is not None:
+            x = x.to(dtype)
+        return x
+
+    return tap_fn
+
+
+class LayerTaps:
+    def __init__(self, return_layers, depth, tap_fn=None):
+        """
+        Outputs of selected Transformer blocks, the outputs of the other blocks are not referenced
+
+        Args:
+            return_layers (Sequence[int]): block indices, negative indices count from the last block
+            depth (int): number of blocks
+            tap_fn (callable): applied to each tapped output as it is produced (see make_layer_tap),
+                None keeps the block output
+        """
+        self.positions = {}
+        for position, layer in enumerate(return_layers):
+            layer = layer + depth if layer < 0 else layer
+            if not 0 <= layer < depth:
+                raise ValueError(f"return_layers {list(return_layers)} out of range for {depth} blocks")
+            self.positions.setdefault(layer, []).append(position)
+        self.last_layer = max(self.positions, default=-1)
+        self.tap_fn = tap_fn
+        self.outputs = [None] * len(return_layers)
+
+    def __call__(self, layer, x):
+        """
+        return: True once the last requested block is reached, the following blocks can be skipped
+        """
+        if layer in self.positions:
+            output = self.tap_fn(x) if self.tap_fn is not None else x
+            for position in self.positions[layer]:
+                self.outputs[position] = output
+        return layer >= self.last_layer
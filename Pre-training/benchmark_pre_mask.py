@@ -0,0 +1,86 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# Micro-benchmark of the retina-band pre-mask post-processing used by misc.get_mask in every
+# pre-training step: the per-frame loops (process_and_adjust_mask / fill_patch_mask_to_ratio)
+# against the batched engine (process_and_adjust_mask_batch / fill_patch_mask_to_ratio_batch).
+# Both paths run on the same [N, T, h, w] top-k masks and their outputs are checked to be equal.
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import custom_util.misc as misc
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Pre-mask post-processing benchmark', add_help=False)
+    parser.add_argument('--batch_size', default=4, type=int)
+    parser.add_argument('--num_frames', default=20, type=int, help='number of temporal patches')
+    parser.add_argument('--grid_size', default=16, type=int, help='spatial patches per side')
+    parser.add_argument('--p_emb_mask_ratio', default=0.6, type=float)
+    parser.add_argument('--repeats', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser
+
+
+def make_topk_masks(args):
+    # retina-like embeddings: patches far from a per-frame band share one direction
+    N, T, s = args.batch_size, args.num_frames, args.grid_size
+    band = torch.randint(s // 4, 3 * s // 4, (N, T, 1, 1)).float()
+    rows = torch.arange(s).float().view(1, 1, s, 1).expand(N, T, s, s)
+    weight = torch.exp(-((rows - band) ** 2) / 8).reshape(N * T, s * s, 1)
+    x = torch.randn(N * T, s * s, 64) * 0.5 + (1 - weight) * 2
+    x = torch.nn.functional.normalize(x, p=2, dim=2)
+    score = torch.bmm(x, x.transpose(1, 2)).sum(dim=2)
+    _, indices = torch.topk(score, int(s * s * args.p_emb_mask_ratio), dim=1)
+    masks = torch.zeros(N * T, s * s)
+    masks.scatter_(1, indices, 1)
+    return masks.reshape(N, T, s, s).numpy()
+
+
+def run_loop(masks, to_mask_number, **kwargs):
+    N, T = masks.shape[:2]
+    filled_masks = np.zeros(masks.shape)
+    for b in range(N):
+        for n in range(T):
+            adjusted_mask, _ = misc.process_and_adjust_mask(masks[b, n], **kwargs)
+            filled_masks[b, n] = misc.fill_patch_mask_to_ratio(adjusted_mask, to_mask_number=to_mask_number)
+    return filled_masks
+
+
+def run_batch(masks, to_mask_number, **kwargs):
+    adjusted_masks, _ = misc.process_and_adjust_mask_batch(masks, **kwargs)
+    return misc.fill_patch_mask_to_ratio_batch(adjusted_masks, to_mask_number=to_mask_number)
+
+
+def main(args):
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    high_res = args.grid_size > 16
+    kwargs = dict(pos_idx=args.grid_size, fill_gap=5 if high_res else 2, up_down_clear=6 if high_res else 3, fill_bottom_center=not high_res)
+    to_mask_number = args.grid_size * args.grid_size // 2
+
+    times = {'loop': [], 'batch': []}
+    for _ in range(args.repeats):
+        masks = make_topk_masks(args)
+        start_time = time.perf_counter()
+        loop_out = run_loop(masks, to_mask_number, **kwargs)
+        times['loop'].append(time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        batch_out = run_batch(masks, to_mask_number, **kwargs)
+        times['batch'].append(time.perf_counter() - start_time)
+        assert np.array_equal(loop_out, batch_out), 'batched pre-mask differs from the per-frame loop'
+
+    loop_time, batch_time = np.median(times['loop']), np.median(times['batch'])
+    print(f'[N, T, h, w] = [{args.batch_size}, {args.num_frames}, {args.grid_size}, {args.grid_size}], outputs identical')
+    print(f'per-frame loop: {loop_time * 1000:.2f} ms/step')
+    print(f'batched:        {batch_time * 1000:.2f} ms/step ({loop_time / batch_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -14,6 +14,8 @@ from PIL import Image
 from torchvision import transforms
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
+from .visit_index import get_patient_sample, set_visit_index
+from .manifest_cache import DirectoryManifest, get_manifest_path
 
 home_directory = os.getenv('HOME')
 
@@ -51,7 +53,7 @@ class TransformableSubset(Dataset):
 class PatientDataset3D(Dataset):
     def __init__(self, root_dir, patient_idx_loc, dataset_mode='frame', transform=None, return_patient_id=False,
         convert_to_tensor=False, name_split_char='_', cls_unique=True, iterate_mode='patient', volume_resize=(224, 224),
-        downsample_width=True, max_frames=None, visit_idx_loc=None, visit_list=None):
+        downsample_width=True, max_frames=None, visit_idx_loc=None, visit_list=None, manifest_cache=False):
         """
         Args:
             root_dir (string): Directory with all the images.
@@ -76,6 +78,8 @@ class PatientDataset3D(Dataset):
         # options for visit mode, only used for frame dataset, default is None
         self.visit_idx_loc = visit_idx_loc
         self.visit_list = visit_list
+        # cache the directory listings of _get_patients next to root_dir
+        self.manifest_cache = manifest_cache
 
         if self.dataset_mode == 'frame':
             if self.iterate_mode == 'patient':
@@ -91,17 +95,24 @@ class PatientDataset3D(Dataset):
             self.patients, self.class_to_idx, self.visits_dict, self.mapping_patient2visit = self._get_patients(patient_idx_loc)
             self.mapping_visit2patient = {visit_idx: patient_id for patient_id, visit_idx_list in self.mapping_patient2visit.items() for visit_idx in visit_idx_list}
 
+        if self.dataset_mode in ['frame', 'volume']:
+            # columnar index of the samples, the dicts above become views of it
+            set_visit_index(self)
+
     def _get_patients(self, patient_idx_loc):
         patients = {}
-        class_names = os.listdir(self.root_dir)
+        # with manifest_cache, directory listings come from the manifest cache, only changed class directories are listed again
+        manifest = DirectoryManifest(self.root_dir, cache_path=get_manifest_path(self.root_dir, self.manifest_cache))
+        class_names = manifest.names
         class_to_idx = {cls_name: idx for idx, cls_name in enumerate(class_names)}
         if self.dataset_mode == 'frame':
             if self.iterate_mode == 'patient':
-                for cls_dir in os.listdir(self.root_dir):
+                for cls_dir in class_names:
                     cls_path = os.path.join(self.root_dir, cls_dir)
-                    if os.path.isdir(cls_path):
-                        for img_name in os.listdir(cls_path):
-                            patient_id, frame_index = img_name.split(self.name_split_char)[patient_idx_loc], img_name.split(self.name_split_char)[patient_idx_loc + 1]
+                    if manifest.isdir(cls_dir):
+                        for img_name in manifest.listdir(cls_dir):
+                            name_parts = img_name.split(self.name_split_char)
+                            patient_id, frame_index = name_parts[patient_idx_loc], name_parts[patient_idx_loc + 1]
                             if self.cls_unique:
                                 unique_patient_id = f"{cls_dir}_{patient_id}"
                             else:
@@ -121,13 +132,14 @@ class PatientDataset3D(Dataset):
                 visit_idx = 0
                 visit_id_map2visit_idx = {}
                 assert self.visit_idx_loc is not None or self.visit_list is not None
-                for cls_dir in os.listdir(self.root_dir):
+                for cls_dir in class_names:
                     cls_path = os.path.join(self.root_dir, cls_dir)
-                    if os.path.isdir(cls_path):
-                        for img_name in os.listdir(cls_path):
-                            patient_id = img_name.split(self.name_split_char)[patient_idx_loc]
+                    if manifest.isdir(cls_dir):
+                        for img_name in manifest.listdir(cls_dir):
+                            name_parts = img_name.split(self.name_split_char)
+                            patient_id = name_parts[patient_idx_loc]
                             if self.visit_idx_loc is not None:
-                                visit_id = img_name.split(self.name_split_char)[self.visit_idx_loc]
+                                visit_id = name_parts[self.visit_idx_loc]
                             else:
                                 raise ValueError('visit_list must be provided [temporarily]')
 
@@ -178,10 +190,10 @@ class PatientDataset3D(Dataset):
             mapping_patient2visit = {}
             visit_idx = 0
 
-            for cls_dir in os.listdir(self.root_dir):
+            for cls_dir in class_names:
                 cls_path = os.path.join(self.root_dir, cls_dir)
-                if os.path.isdir(cls_path):
-                    for img_name in os.listdir(cls_path):
+                if manifest.isdir(cls_dir):
+                    for img_name in manifest.listdir(cls_dir):
                         patient_id = img_name.split(self.name_split_char)[patient_idx_loc]
                         if self.cls_unique:
                             unique_patient_id = f"{cls_dir}_{patient_id}"
@@ -219,8 +231,7 @@ class PatientDataset3D(Dataset):
     def __getitem__(self, idx):
 
         if self.iterate_mode == 'patient':
-            patient_id = list(self.patients.keys())[idx]
-            data_dict = self.patients[patient_id]
+            patient_id, data_dict = get_patient_sample(self, idx)
         elif self.iterate_mode == 'visit':
             data_dict = self.visits_dict[idx]
             patient_id = self.mapping_visit2patient[idx]
@@ -308,7 +319,7 @@ class PatientDataset3D(Dataset):
 class PatientDatasetCenter2D(Dataset):
     def __init__(self, root_dir, patient_idx_loc, dataset_mode='frame', transform=None, convert_to_tensor=False,
         return_patient_id=False, out_frame_idx=False, name_split_char='_', cls_unique=True, iterate_mode='patient',
-        volume_resize=(224, 224), downsample_width=True, visit_idx_loc=None, visit_list=None, **kwargs):
+        volume_resize=(224, 224), downsample_width=True, visit_idx_loc=None, visit_list=None, manifest_cache=False, **kwargs):
         """
         Args:
             root_dir (string): Directory with all the images.
@@ -334,6 +345,8 @@ class PatientDatasetCenter2D(Dataset):
         # options for visit mode, only used for frame dataset, default is None
         self.visit_idx_loc = visit_idx_loc
         self.visit_list = visit_list
+        # cache the directory listings of _get_patients next to root_dir
+        self.manifest_cache = manifest_cache
 
         if self.dataset_mode == 'frame':
             if self.iterate_mode == 'patient':
@@ -350,21 +363,28 @@ class PatientDatasetCenter2D(Dataset):
             self.patients, self.class_to_idx, self.visits_dict, self.mapping_patient2visit = self._get_patients(patient_idx_loc)
             self.mapping_visit2patient = {visit_idx: patient_id for patient_id, visit_idx_list in self.mapping_patient2visit.items() for visit_idx in visit_idx_list}
 
+        if self.dataset_mode in ['frame', 'volume']:
+            # columnar index of the samples, the dicts above become views of it
+            set_visit_index(self)
+
 
         for key, value in kwargs.items():
             setattr(self, key, value)
 
     def _get_patients(self, patient_idx_loc):
         patients = {}
-        class_names = os.listdir(self.root_dir)
+        # with manifest_cache, directory listings come from the manifest cache, only changed class directories are listed again
+        manifest = DirectoryManifest(self.root_dir, cache_path=get_manifest_path(self.root_dir, self.manifest_cache))
+        class_names = manifest.names
         class_to_idx = {cls_name: idx for idx, cls_name in enumerate(class_names)}
         if self.dataset_mode == 'frame':
             if self.iterate_mode == 'patient':
-                for cls_dir in os.listdir(self.root_dir):
+                for cls_dir in class_names:
                     cls_path = os.path.join(self.root_dir, cls_dir)
-                    if os.path.isdir(cls_path):
-                        for img_name in os.listdir(cls_path):
-                            patient_id, frame_index = img_name.split(self.name_split_char)[patient_idx_loc], img_name.split(self.name_split_char)[patient_idx_loc + 1]
+                    if manifest.isdir(cls_dir):
+                        for img_name in manifest.listdir(cls_dir):
+                            name_parts = img_name.split(self.name_split_char)
+                            patient_id, frame_index = name_parts[patient_idx_loc], name_parts[patient_idx_loc + 1]
                             if self.cls_unique:
                                 unique_patient_id = f"{cls_dir}_{patient_id}"
                             else:
@@ -385,13 +405,14 @@ class PatientDatasetCenter2D(Dataset):
                 visit_idx = 0
                 visit_id_map2visit_idx = {}
                 assert self.visit_idx_loc is not None or self.visit_list is not None
-                for cls_dir in os.listdir(self.root_dir):
+                for cls_dir in class_names:
                     cls_path = os.path.join(self.root_dir, cls_dir)
-                    if os.path.isdir(cls_path):
-                        for img_name in os.listdir(cls_path):
-                            patient_id = img_name.split(self.name_split_char)[patient_idx_loc]
+                    if manifest.isdir(cls_dir):
+                        for img_name in manifest.listdir(cls_dir):
+                            name_parts = img_name.split(self.name_split_char)
+                            patient_id = name_parts[patient_idx_loc]
                             if self.visit_idx_loc is not None:
-                                visit_id = img_name.split(self.name_split_char)[self.visit_idx_loc]
+                                visit_id = name_parts[self.visit_idx_loc]
                             else:
                                 raise ValueError('visit_list must be provided [temporarily]')
 
@@ -443,10 +464,10 @@ class PatientDatasetCenter2D(Dataset):
             mapping_patient2visit = {}
             visit_idx = 0
 
-            for cls_dir in os.listdir(self.root_dir):
+            for cls_dir in class_names:
                 cls_path = os.path.join(self.root_dir, cls_dir)
-                if os.path.isdir(cls_path):
-                    for img_name in os.listdir(cls_path):
+                if manifest.isdir(cls_dir):
+                    for img_name in manifest.listdir(cls_dir):
                         patient_id = img_name.split(self.name_split_char)[patient_idx_loc]
                         if self.cls_unique:
                             unique_patient_id = f"{cls_dir}_{patient_id}"
@@ -485,8 +506,7 @@ class PatientDatasetCenter2D(Dataset):
     def __getitem__(self, idx):
 
         if self.iterate_mode == 'patient':
-            patient_id = list(self.patients.keys())[idx]
-            data_dict = self.patients[patient_id]
+            patient_id, data_dict = get_patient_sample(self, idx)
         elif self.iterate_mode == 'visit':
             data_dict = self.visits_dict[idx]
             patient_id = self.mapping_visit2patient[idx]
@@ -17,6 +17,8 @@ import matplotlib.pyplot as plt
 import json
 from monai import transforms as monai_transforms
 from .PatientDataset import PatientDatasetCenter2D, PatientDataset3D
+from .visit_index import set_visit_index
+from .volume_store import VolumeStore
 
 home_directory = os.getenv('HOME')
 
@@ -59,9 +61,9 @@ def create_3d_transforms(input_size, num_frames=64, RandFlipd_prob=0.5, RandRota
                 keys=["pixel_values"], spatial_size=(num_frames, input_size[0], input_size[1]), mode=("trilinear")
             ),
 
-            monai_transforms.RandFlipd(keys=["pixel_values"], prob=RandFlipd_prob, spatial_axis=0),
+            RecordedRandFlipd(keys=["pixel_values"], prob=RandFlipd_prob, spatial_axis=0),
 
-            monai_transforms.RandFlipd(keys=["pixel_values"], prob=RandFlipd_prob, spatial_axis=2),
+            RecordedRandFlipd(keys=["pixel_values"], prob=RandFlipd_prob, spatial_axis=2),
 
         ]
     val_compose = [
@@ -84,6 +86,31 @@ def create_3d_transforms(input_size, num_frames=64, RandFlipd_prob=0.5, RandRota
     return train_transform, val_transform
 
 
+class RecordedRandFlipd(monai_transforms.RandFlipd):
+    """
+    RandFlipd recording whether the last call flipped the sample in flipped
+    """
+    flipped = False
+
+    def randomize(self, data=None):
+        super().randomize(data)
+        self.flipped = self._do_transform
+
+
+def get_flip_state(transform):
+    """
+    Bit i is set if the i-th RecordedRandFlipd of a monai Compose flipped the last sample
+    """
+    flip_state = 0
+    if transform is None or not hasattr(transform, 'transforms'):
+        return flip_state
+    flip_transforms = [t for t in transform.transforms if isinstance(t, RecordedRandFlipd)]
+    for i, flip_transform in enumerate(flip_transforms):
+        if flip_transform.flipped:
+            flip_state |= 1 << i
+    return flip_state
+
+
 class PatientDataset_and_3DOCT_aggregatedDataset(Dataset):
     def __init__(self, dataset1, dataset2, return_img_name=False):
         self.dataset1 = dataset1
@@ -160,6 +187,7 @@ class PatientDatasetCenter2D_inhouse(PatientDatasetCenter2D):
 
         self.load_patient_id_list()
         self.patients, self.visits_dict, self.mapping_patient2visit, self.mapping_visit2patient = self._get_patients()
+        set_visit_index(self)
 
 
     def set_disease_availability(self):
@@ -358,7 +386,7 @@ class PatientDatasetCenter2D_inhouse(PatientDatasetCenter2D):
 
 class PatientDataset3D_inhouse(PatientDatasetCenter2D_inhouse):
 
-    def __init__(self, root_dir, task_mode='binary_cls', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='frame', transform=None, convert_to_tensor=False, return_patient_id=False, name_split_char='-', iterate_mode='visit', downsample_width=True, mode='gray', patient_id_list_dir='multi_cls_expr_10x_0315/', pad_to_num_frames=False, padding_num_frames=None, transform_type='monai_3D', return_img_w_patient_and_visit_name=False, return_data_dict=False, high_res_transform=None, return_both_res_image=False, high_res_num_frames=None, metadata_dir='Oph_cls_task/', **kwargs):
+    def __init__(self, root_dir, task_mode='binary_cls', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='frame', transform=None, convert_to_tensor=False, return_patient_id=False, name_split_char='-', iterate_mode='visit', downsample_width=True, mode='gray', patient_id_list_dir='multi_cls_expr_10x_0315/', pad_to_num_frames=False, padding_num_frames=None, transform_type='monai_3D', return_img_w_patient_and_visit_name=False, return_data_dict=False, high_res_transform=None, return_both_res_image=False, high_res_num_frames=None, metadata_dir='Oph_cls_task/', pre_mask_store=None, volume_store_dir=None, **kwargs):
         """
         Args:
             root_dir (string): Directory with all the images.
@@ -375,6 +403,8 @@ class PatientDataset3D_inhouse(PatientDatasetCenter2D_inhouse):
             iterate_mode (str): 'visit' or 'patient'
             downsample_width (bool): If True, downsample the width to 512 (1024) / 768 (1536)
             mode (str): 'rgb', 'gray'
+            pre_mask_store (PreMaskStore): If set with return_data_dict, also return the stored pre-mask of the visit and flip state
+            volume_store_dir (str): directory of the volumes packed by pack_volume_store.py, read with dataset_mode='packed'
 
         """
         super().__init__(root_dir, task_mode=task_mode, disease=disease, disease_name_list=disease_name_list, metadata_fname=metadata_fname, dataset_mode=dataset_mode, transform=transform, convert_to_tensor=convert_to_tensor, return_patient_id=return_patient_id, out_frame_idx=False, name_split_char=name_split_char, iterate_mode=iterate_mode, downsample_width=downsample_width, mode=mode, patient_id_list_dir=patient_id_list_dir, metadata_dir=metadata_dir, **kwargs)
@@ -387,7 +417,47 @@ class PatientDataset3D_inhouse(PatientDatasetCenter2D_inhouse):
         self.high_res_transform = high_res_transform
         self.return_both_res_image = return_both_res_image
         self.high_res_num_frames = high_res_num_frames
+        self.pre_mask_store = pre_mask_store
+
+        if self.dataset_mode == 'packed':
+            assert volume_store_dir is not None, 'dataset_mode packed needs volume_store_dir'
+            self.volume_store = VolumeStore(volume_store_dir)
+            visit_keys = [self.mapping_visit2patient[i] + '_' + self.visits_dict[i]['visit_hash'] for i in range(len(self.visits_dict))]
+            self.volume_store_idx = self.volume_store.get_store_idx(visit_keys)
+            assert (self.volume_store_idx >= 0).all(), 'visits missing from the volume store, re-run pack_volume_store.py'
 
+    def set_pre_mask_store(self, pre_mask_store):
+        """
+        Serve the pre-masks of pre_mask_store with the samples (return_data_dict), None to stop
+        """
+        assert pre_mask_store is None or pre_mask_store.num_visits == len(self), 'the pre-mask store needs one slot per visit'
+        self.pre_mask_store = pre_mask_store
+
+    def load_packed_frames(self, idx):
+        """
+        Frames of a visit from the volume store, as the frame loading of __getitem__ returns them
+        return: frames tensor (num_frames, C, H, W) and the high res frames tensor (or None)
+        """
+        volume = self.volume_store.get(self.volume_store_idx[idx]) # uint8 (num_frames, H, W) memmap view
+        frames_tensor_high_res = None
+        if self.transform and self.transform_type == 'frame_2D':
+            frames = [Image.fromarray(frame).convert('RGB' if self.mode == 'rgb' else 'L') for frame in volume]
+            frames_tensor = torch.stack([self.transform(frame) for frame in frames])
+            if self.return_both_res_image and self.high_res_transform:
+                frames_tensor_high_res = torch.stack([self.high_res_transform(frame) for frame in frames])
+            return frames_tensor, frames_tensor_high_res
+
+        frames_tensor = torch.from_numpy(volume).unsqueeze(1) # zero-copy
+        if self.transform:
+            frames_tensor = frames_tensor.float().div_(255) # as transforms.ToTensor
+        elif self.convert_to_tensor:
+            frames_tensor = frames_tensor.float()
+        if self.mode == 'rgb':
+            # grayscale is stored once, channels are a view
+            frames_tensor = frames_tensor.expand(-1, 3, -1, -1)
+        if self.return_both_res_image and self.high_res_transform:
+            frames_tensor_high_res = frames_tensor
+        return frames_tensor, frames_tensor_high_res
 
     def __getitem__(self, idx):
         if self.iterate_mode == 'patient':
@@ -398,38 +468,41 @@ class PatientDataset3D_inhouse(PatientDatasetCenter2D_inhouse):
             patient_id = self.mapping_visit2patient[idx]
             visit_hash = data_dict['visit_hash']
 
-        if self.dataset_mode == 'frame':
-            frames = [Image.open(self.root_dir + frame_path, mode='r') for frame_path in data_dict['frames']]
-            if self.mode == 'rgb':
-                frames = [frame.convert("RGB") for frame in frames]
+        if self.dataset_mode in ['frame', 'packed']:
+            if self.dataset_mode == 'packed':
+                frames_tensor, frames_tensor_high_res = self.load_packed_frames(idx)
             else:
-                pass
+                frames = [Image.open(self.root_dir + frame_path, mode='r') for frame_path in data_dict['frames']]
+                if self.mode == 'rgb':
+                    frames = [frame.convert("RGB") for frame in frames]
+                else:
+                    pass
 
-            if self.downsample_width:
-                for i, frame in enumerate(frames):
-                    if frame.size[0] == 1024:
-                        frames[i] = frame.resize((512, frame.size[1]))
-                    if frame.size[1] == 1024 or frame.size[1] == 1536:
-                        frames[i] = frame.resize((frame.size[0], frame.size[1] // 2))
-
-            if self.transform and self.transform_type == 'frame_2D':
-                frames = [self.transform(frame) for frame in frames]
-                if self.return_both_res_image and self.high_res_transform:
-                    frames_high_res = [self.high_res_transform(frame) for frame in frames]
-            elif self.transform and self.transform_type == 'monai_3D':
-                frames = [transforms.ToTensor()(frame) for frame in frames]
+                if self.downsample_width:
+                    for i, frame in enumerate(frames):
+                        if frame.size[0] == 1024:
+                            frames[i] = frame.resize((512, frame.size[1]))
+                        if frame.size[1] == 1024 or frame.size[1] == 1536:
+                            frames[i] = frame.resize((frame.size[0], frame.size[1] // 2))
+
+                if self.transform and self.transform_type == 'frame_2D':
+                    frames = [self.transform(frame) for frame in frames]
+                    if self.return_both_res_image and self.high_res_transform:
+                        frames_high_res = [self.high_res_transform(frame) for frame in frames]
+                elif self.transform and self.transform_type == 'monai_3D':
+                    frames = [transforms.ToTensor()(frame) for frame in frames]
+                    if self.return_both_res_image and self.high_res_transform:
+                        frames_high_res = frames
+
+                # Convert frame to tensor (if not already done by transform)
+                if self.convert_to_tensor and not isinstance(frames[0], torch.Tensor):
+                    frames = [torch.tensor(np.array(frame), dtype=torch.float32) for frame in frames]
+                    print(frames[0].shape)
+                    frames = [frame.permute(2, 0, 1) for frame in frames]
+
+                frames_tensor = torch.stack(frames) # (num_frames, C, H, W)
                 if self.return_both_res_image and self.high_res_transform:
-                    frames_high_res = frames
-
-            # Convert frame to tensor (if not already done by transform)
-            if self.convert_to_tensor and not isinstance(frames[0], torch.Tensor):
-                frames = [torch.tensor(np.array(frame), dtype=torch.float32) for frame in frames]
-                print(frames[0].shape)
-                frames = [frame.permute(2, 0, 1) for frame in frames]
-
-            frames_tensor = torch.stack(frames) # (num_frames, C, H, W)
-            if self.return_both_res_image and self.high_res_transform:
-                frames_tensor_high_res = torch.stack(frames_high_res)
+                    frames_tensor_high_res = torch.stack(frames_high_res)
 
 
             if self.pad_to_num_frames:
@@ -481,7 +554,11 @@ class PatientDataset3D_inhouse(PatientDatasetCenter2D_inhouse):
                     frames_tensor_high_res = frames_tensor_high_res.unsqueeze(0)
                     frames_tensor_high_res = self.high_res_transform({"pixel_values": frames_tensor_high_res})["pixel_values"]
             if self.return_img_w_patient_and_visit_name:
-                if self.return_data_dict:
+                if self.return_data_dict and self.pre_mask_store is not None:
+                    pre_mask_key = self.pre_mask_store.get_key(idx, get_flip_state(self.transform))
+                    pre_mask, pre_mask_valid = self.pre_mask_store.get(pre_mask_key)
+                    return (frames_tensor, frames_tensor_high_res) if self.return_both_res_image and self.high_res_transform else frames_tensor, (patient_id + '_' + visit_hash, data_dict, (pre_mask, pre_mask_valid, pre_mask_key))
+                elif self.return_data_dict:
                     return (frames_tensor, frames_tensor_high_res) if self.return_both_res_image and self.high_res_transform else frames_tensor, (patient_id + '_' + visit_hash, data_dict)
                 else:
                     return (frames_tensor, frames_tensor_high_res) if self.return_both_res_image and self.high_res_transform else frames_tensor, patient_id + '_' + visit_hash
@@ -21,6 +21,7 @@ from skimage import filters
 from skimage import exposure
 from .PatientDataset import PatientDatasetCenter2D, PatientDataset3D
 from .PatientDataset_inhouse import PatientDatasetCenter2D_inhouse, PatientDataset3D_inhouse, get_file_list_given_patient_and_visit_hash
+from .otsu_mask_store import get_otsu_patch_mask
 
 
 home_directory = os.getenv('HOME')
@@ -57,12 +58,41 @@ oct_class_level = {'NO':0,
 }
 
 
+def load_inhouse_frame(root_dir, image_path, mode='rgb', downsample_width=True):
+    """
+    Load an in-house frame as PatientDatasetCenter2D_inhouse_pretrain does, before its transform
+    """
+    frame = Image.open(root_dir + image_path, mode='r')
+    if mode == 'gray':
+        frame = frame.convert("L")
+    elif mode == 'rgb':
+        frame = frame.convert("RGB")
+    if downsample_width:
+        if frame.size[0] == 1024:
+            frame = frame.resize((512, frame.size[1]))
+        if frame.size[1] == 1024 or frame.size[1] == 1536:
+            frame = frame.resize((frame.size[0], frame.size[1] // 2))
+    return frame
+
+
 class Inhouse_and_Kermany_Dataset(Dataset):
-    def __init__(self, dataset1, dataset2, return_img_name=False):
+    def __init__(self, dataset1, dataset2, return_img_name=False, otsu_mask_store=None, otsu_patch_size=16):
+        """
+        Args:
+            dataset1 (PatientDatasetCenter2D_inhouse_pretrain): in-house frames
+            dataset2 (ImageFolder): Kermany frames
+            otsu_mask_store (OtsuMaskStore): precomputed patch masks of the Kermany frames, keyed by
+                their path relative to dataset2.root; frames missing from it are thresholded on the fly
+            otsu_patch_size (int): patch size of the masks computed on the fly
+        """
         self.dataset1 = dataset1
         self.dataset2 = dataset2
         # Optionally maintain indices to manage sampling from both datasets
         self.return_img_name = return_img_name
+        self.otsu_mask_store = otsu_mask_store
+        self.otsu_patch_size = otsu_mask_store.patch_size if otsu_mask_store is not None else otsu_patch_size
+        if otsu_mask_store is not None:
+            self.otsu_mask_row = otsu_mask_store.get_rows([os.path.relpath(path, dataset2.root) for path, _ in dataset2.samples])
 
     def __len__(self):
         # This could be a simple sum or a more complex ratio based on sampling needs
@@ -73,24 +103,24 @@ class Inhouse_and_Kermany_Dataset(Dataset):
             data = self.dataset1[idx]
             path = self.dataset1.all_image_list[data[1][0]]
 
-            return data[0], (1, data[1][0], torch.tensor(data[1][1]).unsqueeze(0), path)
+            return data[0], (1, data[1][0], torch.as_tensor(data[1][1]).unsqueeze(0), path)
         else:
             frame, img_names = self.dataset2[idx - len(self.dataset1)]
             dataset_idx = idx - len(self.dataset1)
             path, _ = self.dataset2.samples[dataset_idx]
             path_no_home = path.replace(home_directory, '')
 
-            frame_img = np.array(frame)
-
-            val = filters.threshold_otsu(frame_img)
-            filtered_img = frame_img > val
-            return frame.unsqueeze(0), (2, idx-len(self.dataset1), torch.tensor(filtered_img).unsqueeze(0), path_no_home)
+            if self.otsu_mask_store is not None and self.otsu_mask_row[dataset_idx] >= 0:
+                _, patch_mask = self.otsu_mask_store.get(self.otsu_mask_row[dataset_idx])
+            else:
+                _, patch_mask = get_otsu_patch_mask(frame, patch_size=self.otsu_patch_size)
+            return frame.unsqueeze(0), (2, idx-len(self.dataset1), torch.as_tensor(patch_mask).unsqueeze(0), path_no_home)
 
 
 
 
 class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
-    def __init__(self, root_dir, task_mode='multi_label', dataset_mode='frame', transform=None, convert_to_tensor=False, return_patient_id=False, out_frame_idx=False, name_split_char='-', iterate_mode='visit', downsample_width=True, mode='rgb', patient_id_list_dir='multi_cls_expr_10x_0315/', disease='AMD', disease_name_list=None, metadata_fname=None, downsample_normal=False, downsample_normal_factor=10, enable_spl=False, return_mask=False, mask_dir=home_directory + '/all_seg_results_collection/seg_results/', mask_transform=None, metadata_dir='Oph_cls_task/', **kwargs):
+    def __init__(self, root_dir, task_mode='multi_label', dataset_mode='frame', transform=None, convert_to_tensor=False, return_patient_id=False, out_frame_idx=False, name_split_char='-', iterate_mode='visit', downsample_width=True, mode='rgb', patient_id_list_dir='multi_cls_expr_10x_0315/', disease='AMD', disease_name_list=None, metadata_fname=None, downsample_normal=False, downsample_normal_factor=10, enable_spl=False, return_mask=False, mask_dir=home_directory + '/all_seg_results_collection/seg_results/', mask_transform=None, metadata_dir='Oph_cls_task/', otsu_mask_store=None, otsu_patch_size=16, **kwargs):
         """
         Args:
             root_dir (string): Directory with all the images.
@@ -107,6 +137,9 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
             iterate_mode (str): 'visit' or 'patient'
             downsample_width (bool): If True, downsample the width to 512 (1024) / 768 (1536)
             mode (str): 'rgb', 'gray'
+            otsu_mask_store (OtsuMaskStore): precomputed Otsu patch masks of the frames (see
+                precompute_otsu_masks.py); frames missing from it are thresholded on the fly
+            otsu_patch_size (int): patch size of the masks computed on the fly
 
         """
 
@@ -119,9 +152,17 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
         self.update_len_dataset_list()
         self.mask_transform = mask_transform
 
+        self.enable_spl = enable_spl
         if enable_spl:
             self.init_spl(K=0.1)
 
+        self.otsu_mask_store = otsu_mask_store
+        self.otsu_patch_size = otsu_mask_store.patch_size if otsu_mask_store is not None else otsu_patch_size
+        if otsu_mask_store is not None:
+            # store row of each frame id (frame_id follows the insertion order of all_image_dict)
+            self.otsu_mask_row = otsu_mask_store.get_rows(list(self.frame_id))
+            print('Otsu mask store: %d/%d frames' % ((self.otsu_mask_row >= 0).sum(), len(self.otsu_mask_row)))
+
 
     def init_spl(self, K=0.1, seed=0):
         self.K = K
@@ -134,15 +175,37 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
     def update_spl(self, K=0.1):
         self.K = K
         self.visible_frame_num = int(self.K * self.len_all_dataset)
-        hardness_list = []
-        for idx in range(self.len_all_dataset):
-            hardness_list.append(self.all_image_dict[self.all_image_list[idx]]['hardness'])
+        hardness_list = self.hardness[self.all_image_frame_id]
 
         hardness_list = np.argsort(hardness_list)[::-1] # descending order
         self.idx_to_frame = hardness_list[:self.visible_frame_num]
 
+    def update_hardness(self, frame_ids, frame_loss):
+        """
+        frame_ids: [N] frame ids from self.frame_id, frame_loss: [N] numpy losses of the frames
+        """
+        self.mse_loss[frame_ids] = frame_loss
+        self.hardness[frame_ids] = frame_loss
+        self.hardness_updated[frame_ids] = True
+
+    def get_all_image_dict(self):
+        # write the hardness store back to all_image_dict, e.g., before pickling it
+        for frame, frame_idx in self.frame_id.items():
+            self.all_image_dict[frame]['mse_loss'] = float(self.mse_loss[frame_idx])
+            self.all_image_dict[frame]['hardness'] = float(self.hardness[frame_idx])
+        return self.all_image_dict
+
+    def set_all_image_dict(self, all_image_dict):
+        # load the hardness store from a pickled all_image_dict
+        self.all_image_dict = all_image_dict
+        for frame, frame_idx in self.frame_id.items():
+            self.mse_loss[frame_idx] = all_image_dict[frame]['mse_loss']
+            self.hardness[frame_idx] = all_image_dict[frame]['hardness']
+
     def update_len_dataset_list(self):
         self.len_all_dataset = len(self.all_image_list)
+        # all_image_list may be a subset of the frames in all_image_dict
+        self.all_image_frame_id = np.array([self.frame_id[frame] for frame in self.all_image_list], dtype=np.int64)
 
     def get_all_image_list_and_dict(self, test_patient_id_list=None):
         image_list = []
@@ -165,7 +228,12 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
             print(len(set(excluded_patient_id_list)), len(set(test_patient_id_list)))
         print(idx, 'len(image_list):', len(image_list))
 
-
+        # hardness store: frame path -> frame id, indexing the float32 loss arrays
+        self.frame_id = {frame: i for i, frame in enumerate(image_dict)}
+        self.hardness = np.zeros(len(self.frame_id), dtype=np.float32)
+        self.mse_loss = np.zeros(len(self.frame_id), dtype=np.float32)
+        # frames whose hardness was measured by this process since the last cross-rank sync
+        self.hardness_updated = np.zeros(len(self.frame_id), dtype=bool)
         return image_list, image_dict
 
     def get_all_image_list(self, test_patient_id_list=None):
@@ -199,7 +267,7 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
         if self.enable_spl:
             idx = self.idx_to_frame[idx]
         image_path = self.all_image_list[idx]
-        frame = Image.open(self.root_dir + image_path, mode='r')
+        frame = load_inhouse_frame(self.root_dir, image_path, mode=self.mode, downsample_width=self.downsample_width)
         if self.return_mask:
             try:
                 mask_path = self.mask_dir + image_path
@@ -207,15 +275,6 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
             except:
                 mask = Image.new('L', frame.size)
 
-        if self.mode == 'gray':
-            frame = frame.convert("L")
-        elif self.mode == 'rgb':
-            frame = frame.convert("RGB")
-        if self.downsample_width:
-            if frame.size[0] == 1024:
-                frame = frame.resize((512, frame.size[1]))
-            if frame.size[1] == 1024 or frame.size[1] == 1536:
-                frame = frame.resize((frame.size[0], frame.size[1] // 2))
         if self.transform:
             frame = self.transform(frame)
         if self.return_mask and self.mask_transform:
@@ -227,13 +286,16 @@ class PatientDatasetCenter2D_inhouse_pretrain(PatientDatasetCenter2D_inhouse):
             frame = frame.permute(2, 0, 1)
             print(frame.shape)
 
-        frame_img = np.array(frame)
-        val = filters.threshold_otsu(frame_img)
-        filtered_img = frame_img > val
+        # [h, w] patch-level Otsu foreground, precomputed or thresholded on the fly
+        otsu_mask_row = self.otsu_mask_row[self.all_image_frame_id[idx]] if self.otsu_mask_store is not None else -1
+        if otsu_mask_row >= 0:
+            _, patch_mask = self.otsu_mask_store.get(otsu_mask_row)
+        else:
+            _, patch_mask = get_otsu_patch_mask(frame, patch_size=self.otsu_patch_size)
         if self.return_mask:
-            return frame.unsqueeze(0), (idx, filtered_img, mask)
+            return frame.unsqueeze(0), (idx, patch_mask, mask)
         else:
-            return frame.unsqueeze(0), (idx, filtered_img)
+            return frame.unsqueeze(0), (idx, patch_mask)
 
 
 
@@ -0,0 +1,111 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+
+import numpy as np
+import torch
+from skimage import filters
+
+
+def get_otsu_patch_mask(frame, patch_size=16, min_foreground=0.5):
+    """
+    Otsu foreground of a transformed [C, H, W] (or [H, W]) frame, pooled to the patch grid
+
+    Args:
+        frame (torch.Tensor or np.ndarray): frame after the dataset transform
+        patch_size (int): patch size of the model
+        min_foreground (float): a patch is foreground if at least this fraction of its pixels are
+    return: Otsu threshold of the frame, [H // patch_size, W // patch_size] bool patch mask
+    """
+    frame_img = np.asarray(frame, dtype=np.float32)
+    threshold = filters.threshold_otsu(frame_img)
+    foreground = frame_img > threshold
+    if foreground.ndim == 3:
+        foreground = foreground.any(axis=0)
+    h, w = foreground.shape[0] // patch_size, foreground.shape[1] // patch_size
+    foreground = foreground[:h * patch_size, :w * patch_size].reshape(h, patch_size, w, patch_size)
+    return float(threshold), foreground.mean(axis=(1, 3)) >= min_foreground
+
+
+class OtsuMaskStoreWriter:
+    def __init__(self, store_dir, frames, grid_size, patch_size=16, min_foreground=0.5, input_size=None):
+        """
+        Write the Otsu thresholds and bit-packed patch masks of a list of frames, one row per
+        frame in the order of frames, call close() to write the frame index.
+
+        Args:
+            store_dir (str): output directory
+            frames (list): frame keys (paths) of the rows
+            grid_size (tuple): (h, w) patch grid of a mask
+            patch_size (int): patch size the masks are pooled to
+            min_foreground (float): foreground fraction of a foreground patch
+            input_size (int): frame size after the transform, recorded in the metadata
+        """
+        self.store_dir = store_dir
+        self.frames = list(frames)
+        self.meta = {'num_frames': len(self.frames), 'grid_size': list(grid_size), 'patch_size': patch_size,
+            'min_foreground': min_foreground, 'input_size': input_size}
+        mask_numel = int(np.prod(grid_size))
+        os.makedirs(store_dir, exist_ok=True)
+        self.thresholds = np.lib.format.open_memmap(os.path.join(store_dir, 'thresholds.npy'), mode='w+', dtype=np.float32, shape=(len(self.frames),))
+        self.packed_masks = np.lib.format.open_memmap(os.path.join(store_dir, 'patch_masks.npy'), mode='w+', dtype=np.uint8, shape=(len(self.frames), (mask_numel + 7) // 8))
+
+    def add(self, row, threshold, patch_mask):
+        assert list(patch_mask.shape) == self.meta['grid_size'], 'patch mask shape mismatch'
+        self.thresholds[row] = threshold
+        self.packed_masks[row] = np.packbits(np.asarray(patch_mask, dtype=bool).reshape(-1))
+
+    def close(self):
+        self.thresholds.flush()
+        self.packed_masks.flush()
+        with open(os.path.join(self.store_dir, 'frames.txt'), 'w') as f:
+            f.write('\n'.join(self.frames) + '\n')
+        # meta.json is written last, its presence marks the store as complete
+        with open(os.path.join(self.store_dir, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+
+class OtsuMaskStore:
+    def __init__(self, store_dir):
+        """
+        Read-only memory-mapped store of precomputed Otsu thresholds and patch-level foreground
+        masks (see precompute_otsu_masks.py). Rows are looked up by frame key with get_rows, the
+        datasets keep the row of each of their frame ids.
+
+        Args:
+            store_dir (str): directory written by OtsuMaskStoreWriter
+        """
+        self.store_dir = store_dir
+        meta_path = os.path.join(store_dir, 'meta.json')
+        assert os.path.exists(meta_path), 'incomplete Otsu mask store: %s' % store_dir
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        self.grid_size = tuple(self.meta['grid_size'])
+        self.patch_size = self.meta['patch_size']
+        self.mask_numel = int(np.prod(self.grid_size))
+        with open(os.path.join(store_dir, 'frames.txt')) as f:
+            self.frame_row = {frame: i for i, frame in enumerate(f.read().splitlines())}
+        self.thresholds = np.load(os.path.join(store_dir, 'thresholds.npy'), mmap_mode='r')
+        self.packed_masks = np.load(os.path.join(store_dir, 'patch_masks.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.frame_row)
+
+    def get_rows(self, frames):
+        """
+        return: [N] int64 rows of the frames, -1 for frames missing from the store
+        """
+        return np.array([self.frame_row.get(frame, -1) for frame in frames], dtype=np.int64)
+
+    def get(self, row):
+        """
+        return: Otsu threshold of the frame, [h, w] bool patch mask
+        """
+        patch_mask = np.unpackbits(self.packed_masks[row], count=self.mask_numel).astype(bool)
+        return float(self.thresholds[row]), torch.from_numpy(patch_mask.reshape(self.grid_size))
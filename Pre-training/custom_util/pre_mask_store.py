@@ -0,0 +1,93 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+from iopath.common.file_io import g_pathmgr as pathmgr
+
+
+class PreMaskStore:
+    def __init__(self, num_visits, mask_shape, num_flip_states=4, refresh_epochs=10):
+        """
+        Bit-packed cache of the anatomy pre-masks computed by misc.get_mask, one slot per
+        (visit idx, flip state). The buffers live in shared memory, so masks written by the
+        training process are visible to DataLoader workers, persistent ones included.
+
+        Args:
+            num_visits (int): number of visits of the dataset, keys are dataset indices
+            mask_shape (tuple): (T, h, w) patch grid of a pre-mask
+            num_flip_states (int): number of random flip combinations of the train transform
+            refresh_epochs (int): a mask is recomputed once it is this many epochs old
+        """
+        self.num_visits = num_visits
+        self.mask_shape = tuple(mask_shape)
+        self.num_flip_states = num_flip_states
+        self.refresh_epochs = refresh_epochs
+        self.mask_numel = int(np.prod(self.mask_shape))
+
+        num_slots = num_visits * num_flip_states
+        self.packed_masks = torch.zeros(num_slots, (self.mask_numel + 7) // 8, dtype=torch.uint8).share_memory_()
+        # epoch each mask was computed at, -1 if never
+        self.mask_epoch = torch.full((num_slots,), -1, dtype=torch.int32).share_memory_()
+        self.epoch = torch.zeros(1, dtype=torch.int32).share_memory_()
+
+    def get_key(self, visit_idx, flip_state=0):
+        return visit_idx * self.num_flip_states + flip_state
+
+    def set_epoch(self, epoch):
+        self.epoch[0] = epoch
+
+    def is_valid(self, keys):
+        mask_epoch = self.mask_epoch[torch.as_tensor(keys, dtype=torch.long)]
+        return (mask_epoch >= 0) & (self.epoch[0] - mask_epoch < self.refresh_epochs)
+
+    def get(self, key):
+        """
+        return: pre-mask [T, h, w] uint8 (1 is masked, zeros if missing) and whether it is valid
+        """
+        if not self.is_valid(key):
+            return torch.zeros(self.mask_shape, dtype=torch.uint8), False
+        pre_mask = np.unpackbits(self.packed_masks[key].numpy(), count=self.mask_numel)
+        return torch.from_numpy(pre_mask.reshape(self.mask_shape)), True
+
+    def update(self, keys, pre_masks):
+        """
+        keys: [B] store keys, pre_masks: [B, T, h, w] pre-masks from misc.get_mask
+        """
+        keys = torch.as_tensor(keys, dtype=torch.long).cpu()
+        pre_masks = pre_masks.detach().cpu().reshape(len(keys), self.mask_numel) > 0
+        self.packed_masks[keys] = torch.from_numpy(np.packbits(pre_masks.numpy(), axis=1))
+        self.mask_epoch[keys] = self.epoch[0]
+
+    def num_valid(self):
+        return int(self.is_valid(torch.arange(len(self.mask_epoch))).sum())
+
+    def state_dict(self):
+        return {
+            'mask_shape': self.mask_shape,
+            'num_flip_states': self.num_flip_states,
+            'packed_masks': self.packed_masks.clone(),
+            'mask_epoch': self.mask_epoch.clone(),
+        }
+
+    def load_state_dict(self, state_dict):
+        assert tuple(state_dict['mask_shape']) == self.mask_shape, 'pre-mask shape mismatch'
+        assert state_dict['num_flip_states'] == self.num_flip_states
+        assert state_dict['packed_masks'].shape == self.packed_masks.shape, 'number of visits mismatch'
+        self.packed_masks.copy_(state_dict['packed_masks'])
+        # loaded masks count as computed now, so they are served for a full refresh period
+        loaded = state_dict['mask_epoch'] >= 0
+        self.mask_epoch.fill_(-1)
+        self.mask_epoch[loaded] = self.epoch[0]
+
+    def save(self, path):
+        with pathmgr.open(path, 'wb') as f:
+            torch.save(self.state_dict(), f)
+
+    def load(self, path):
+        with pathmgr.open(path, 'rb') as f:
+            self.load_state_dict(torch.load(f, map_location='cpu'))
@@ -0,0 +1,150 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from .epoch_sampler import EpochIndexSampler
+
+
+class SPLDistributedSampler(EpochIndexSampler):
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0, K=0.2, drop_last=False):
+        """
+        Self-paced learning sampler of an Inhouse_and_Kermany_Dataset. Each epoch it draws the
+        K hardest in-house frames and every Kermany image, shuffled and split across ranks as in
+        DistributedSampler. The selection lives in the sampler, which is iterated in the main
+        process, so a persistent-worker DataLoader picks up a new K without restarting workers.
+        dataset.dataset1 must not remap indices itself (enable_spl=False).
+
+        Args:
+            dataset (Inhouse_and_Kermany_Dataset): dataset1 holds the hardness store of the in-house frames
+            num_replicas (int): number of ranks, defaults to the world size
+            rank (int): rank of the current process, defaults to the global rank
+            shuffle (bool): If True, shuffle the indices every epoch
+            seed (int): seed of the shuffling and of the initial random selection, same on all ranks
+            K (float): fraction of the in-house frames visible in the first epoch, picked at random
+            drop_last (bool): If True, drop the tail instead of padding it to split evenly across ranks
+        """
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed, drop_last=drop_last)
+        self.dataset_spl = dataset.dataset1
+
+        # no hardness has been measured yet: start from a random subset, as init_spl does
+        self.K = K
+        rng = np.random.default_rng(seed)
+        self.visible_frame_idx = rng.choice(self.dataset_spl.len_all_dataset, int(K * self.dataset_spl.len_all_dataset), replace=False)
+
+    def sync_hardness(self):
+        """
+        All-reduce the hardness measured on each rank since the last sync: frames seen by several
+        ranks get the mean of their losses, other frames keep the value all ranks already share.
+        """
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            self.dataset_spl.hardness_updated[:] = False
+            return
+        device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+        updated = torch.from_numpy(self.dataset_spl.hardness_updated).to(device=device, dtype=torch.float32)
+        losses = torch.from_numpy(np.stack([self.dataset_spl.hardness, self.dataset_spl.mse_loss])).to(device)
+        losses = losses * updated
+        dist.all_reduce(updated)
+        dist.all_reduce(losses)
+
+        updated = updated.cpu().numpy()
+        is_updated = updated > 0
+        losses = losses.cpu().numpy()[:, is_updated] / updated[is_updated]
+        self.dataset_spl.hardness[is_updated] = losses[0]
+        self.dataset_spl.mse_loss[is_updated] = losses[1]
+        self.dataset_spl.hardness_updated[:] = False
+
+    def update_spl(self, K=0.1, sync=True):
+        """
+        Keep the K hardest in-house frames visible, after syncing the hardness across ranks
+        unless sync_hardness was already called since the last update.
+        """
+        if sync:
+            self.sync_hardness()
+        self.K = K
+        hardness = self.dataset_spl.hardness[self.dataset_spl.all_image_frame_id]
+        visible_frame_num = int(K * len(hardness))
+        if visible_frame_num == 0:
+            self.visible_frame_idx = np.zeros(0, dtype=np.int64)
+        elif visible_frame_num >= len(hardness):
+            self.visible_frame_idx = np.arange(len(hardness))
+        else:
+            self.visible_frame_idx = np.argpartition(-hardness, visible_frame_num - 1)[:visible_frame_num]
+        # argpartition leaves the top-K unordered, sort them so all ranks build the same index list
+        self.visible_frame_idx = np.sort(self.visible_frame_idx)
+
+    def get_epoch_indices(self, epoch):
+        offset = len(self.dataset_spl)
+        return np.concatenate([self.visible_frame_idx, offset + np.arange(len(self.dataset.dataset2))])
+
+
+class SPLMixtureSampler(SPLDistributedSampler):
+    def __init__(self, dataset, num_samples, weights=(0.5, 0.5), num_replicas=None, rank=None, seed=0, K=0.2):
+        """
+        SPLDistributedSampler drawing a fixed number of samples per epoch from the in-house and
+        Kermany sources with explicit weights, instead of one pass over their concatenation, whose
+        length and in-house / Kermany ratio drift with K. Each source is read through its own
+        persistent stream of shuffled passes over its pool (the K visible in-house frames, every
+        Kermany image) that continues across epochs, so no frame repeats before its pool is
+        exhausted; a new K restarts the in-house stream on the new pool. The streams advance in
+        __iter__, once per epoch on every rank.
+
+        Args:
+            dataset (Inhouse_and_Kermany_Dataset): dataset1 holds the hardness store of the in-house frames
+            num_samples (int): samples per rank and epoch, e.g., the 3D steps of an epoch x the 2D batch
+                size, so the 2D stream of the joint step lasts exactly one 3D epoch
+            weights (tuple): sampling weights of the in-house and Kermany sources
+            num_replicas (int): number of ranks, defaults to the world size
+            rank (int): rank of the current process, defaults to the global rank
+            seed (int): seed of the streams and of the shuffling, same on all ranks
+            K (float): fraction of the in-house frames visible in the first epoch, picked at random
+        """
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed, K=K)
+        self.num_samples = num_samples
+        weights = np.asarray(weights, dtype=np.float64)
+        assert len(weights) == 2 and weights.min() >= 0 and weights.sum() > 0
+        self.weights = weights / weights.sum()
+        # per source: pool order of the current pass, position in it, generator of the passes
+        self.streams = [None, None]
+
+    def update_spl(self, K=0.1, sync=True):
+        super().update_spl(K=K, sync=sync)
+        self.streams[0] = None
+
+    def get_pools(self):
+        offset = len(self.dataset_spl)
+        return [self.visible_frame_idx, offset + np.arange(len(self.dataset.dataset2))]
+
+    def draw(self, source, pool, num):
+        """
+        return: the next num indices of the stream of source, a new shuffled pass over pool each time it is exhausted
+        """
+        if self.streams[source] is None:
+            self.streams[source] = {'order': np.zeros(0, dtype=np.int64), 'position': 0, 'rng': np.random.default_rng((self.seed, source, self.epoch))}
+        stream = self.streams[source]
+        drawn = []
+        while num > 0:
+            if stream['position'] == len(stream['order']):
+                stream['order'] = pool[stream['rng'].permutation(len(pool))]
+                stream['position'] = 0
+            take = min(num, len(stream['order']) - stream['position'])
+            drawn.append(stream['order'][stream['position']:stream['position'] + take])
+            stream['position'] += take
+            num -= take
+        return np.concatenate(drawn) if drawn else np.zeros(0, dtype=np.int64)
+
+    def get_epoch_indices(self, epoch):
+        pools = self.get_pools()
+        total_size = self.num_samples * self.num_replicas
+        weights = self.weights * np.array([len(pool) > 0 for pool in pools])
+        num_inhouse = int(round(total_size * weights[0] / weights.sum()))
+        return np.concatenate([self.draw(0, pools[0], num_inhouse), self.draw(1, pools[1], total_size - num_inhouse)])
+
+    def __len__(self):
+        return self.num_samples
@@ -0,0 +1,205 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class VisitIndex:
+    def __init__(self, visits, visit_patient_ids):
+        """
+        Columnar index of the samples (visits, or patients in patient iterate mode) of a PatientDataset.
+        Frame paths are kept in one utf-8 buffer with integer offsets, patient ids and string fields
+        in fixed-width numpy arrays, so indexing is O(1) and the index pickles into DataLoader workers
+        as a few numpy buffers instead of millions of Python objects touched by refcounting.
+
+        Args:
+            visits (list): sample dicts with at least 'frames' (list of paths) and 'class_idx'
+            visit_patient_ids (list): patient id of each sample
+        """
+        num_visits = len(visits)
+        keys = list(visits[0].keys()) if num_visits > 0 else ['frames', 'class_idx']
+
+        # frames: visit -> [frame_offsets[v], frame_offsets[v + 1]) -> path bytes [path_offsets[f], path_offsets[f + 1])
+        frame_counts = np.array([len(visit['frames']) for visit in visits], dtype=np.int64)
+        self.frame_offsets = np.zeros(num_visits + 1, dtype=np.int64)
+        np.cumsum(frame_counts, out=self.frame_offsets[1:])
+        encoded_paths = [path.encode('utf-8') for visit in visits for path in visit['frames']]
+        self.path_offsets = np.zeros(len(encoded_paths) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in encoded_paths], out=self.path_offsets[1:])
+        self.path_buffer = np.frombuffer(b''.join(encoded_paths), dtype=np.uint8)
+
+        # patients, in order of first appearance, with their visits grouped as CSR
+        patient_ids, self.visit_patient_idx = np.unique(np.array(visit_patient_ids), return_inverse=True)
+        first_visit = np.full(len(patient_ids), num_visits, dtype=np.int64)
+        np.minimum.at(first_visit, self.visit_patient_idx, np.arange(num_visits))
+        order = np.argsort(first_visit, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.patient_ids = patient_ids[order]
+        self.visit_patient_idx = rank[self.visit_patient_idx].astype(np.int32)
+        self.patient_visit_idx = np.argsort(self.visit_patient_idx, kind='stable')
+        self.patient_visit_offsets = np.zeros(len(self.patient_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.visit_patient_idx, minlength=len(self.patient_ids)), out=self.patient_visit_offsets[1:])
+        self.patient_to_idx = {patient_id: i for i, patient_id in enumerate(self.patient_ids.tolist())}
+
+        # other fields: strings as fixed-width arrays, class_idx as [V] (single label) or [V, K] (multi-label)
+        # integer array, anything else (metadata dicts, lists) as is
+        self.str_fields = {}
+        self.class_idx = None
+        self.obj_fields = {}
+        for key in keys:
+            if key == 'frames':
+                continue
+            values = [visit[key] for visit in visits]
+            if all(isinstance(value, str) for value in values):
+                self.str_fields[key] = np.array(values, dtype=str)
+            elif key == 'class_idx' and len(set(np.shape(value) for value in values)) == 1 and np.issubdtype(np.array(values).dtype, np.integer):
+                self.class_idx = np.array(values)
+            else:
+                self.obj_fields[key] = values
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.frame_offsets) - 1
+
+    def get_frames(self, idx):
+        start, end = self.frame_offsets[idx], self.frame_offsets[idx + 1]
+        offsets = self.path_offsets[start:end + 1]
+        data = self.path_buffer[offsets[0]:offsets[-1]].tobytes()
+        offsets = offsets - offsets[0]
+        return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(end - start)]
+
+    def get_class_idx(self, idx):
+        if self.class_idx is None:
+            return self.obj_fields['class_idx'][idx]
+        class_idx = self.class_idx[idx]
+        return class_idx.item() if class_idx.ndim == 0 else class_idx.copy()
+
+    def get_patient_id(self, idx):
+        # .item() keeps the type of the ids, str or int (e.g., AI-READI participant ids)
+        return self.patient_ids[self.visit_patient_idx[idx]].item()
+
+    def get_visit(self, idx):
+        """
+        return: the sample dict the dataset was built with
+        """
+        visit = {}
+        for key in self.keys:
+            if key == 'frames':
+                visit[key] = self.get_frames(idx)
+            elif key == 'class_idx' and self.class_idx is not None:
+                visit[key] = self.get_class_idx(idx)
+            elif key in self.str_fields:
+                visit[key] = str(self.str_fields[key][idx])
+            else:
+                visit[key] = self.obj_fields[key][idx]
+        return visit
+
+    def get_patient_visits(self, patient_id):
+        patient_idx = self.patient_to_idx[patient_id]
+        return self.patient_visit_idx[self.patient_visit_offsets[patient_idx]:self.patient_visit_offsets[patient_idx + 1]].tolist()
+
+    def get_visit_idx(self, patient_id_list):
+        return [visit_idx for patient_id in patient_id_list for visit_idx in self.get_patient_visits(patient_id)]
+
+
+class VisitDictView(Mapping):
+    # visits_dict: visit idx -> visit dict
+    def __init__(self, visit_index):
+        self.visit_index = visit_index
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self.visit_index):
+            raise KeyError(idx)
+        return self.visit_index.get_visit(idx)
+
+    def __iter__(self):
+        return iter(range(len(self.visit_index)))
+
+    def __len__(self):
+        return len(self.visit_index)
+
+
+class VisitPatientView(VisitDictView):
+    # mapping_visit2patient: visit idx -> patient id
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self.visit_index):
+            raise KeyError(idx)
+        return self.visit_index.get_patient_id(idx)
+
+
+class PatientVisitView(Mapping):
+    # mapping_patient2visit: patient id -> list of visit idx
+    def __init__(self, visit_index):
+        self.visit_index = visit_index
+
+    def __getitem__(self, patient_id):
+        return self.visit_index.get_patient_visits(patient_id)
+
+    def __iter__(self):
+        return iter(self.visit_index.patient_ids.tolist())
+
+    def __len__(self):
+        return len(self.visit_index.patient_ids)
+
+    def __contains__(self, patient_id):
+        return patient_id in self.visit_index.patient_to_idx
+
+
+class PatientDictView(PatientVisitView):
+    # patients in visit iterate mode: patient id -> {key: [value of each visit]}
+    def __getitem__(self, patient_id):
+        visits = [self.visit_index.get_visit(visit_idx) for visit_idx in self.visit_index.get_patient_visits(patient_id)]
+        return {key: [visit[key] for visit in visits] for key in self.visit_index.keys}
+
+
+class PatientRowView(PatientVisitView):
+    # patients in patient iterate mode: each patient is one row of the index
+    def __getitem__(self, patient_id):
+        return self.visit_index.get_visit(self.visit_index.patient_to_idx[patient_id])
+
+
+def set_visit_index(dataset):
+    """
+    Build the VisitIndex of a PatientDataset from the dicts returned by its _get_patients and
+    replace those dicts by read-only views of the index. In patient iterate mode the patients are
+    the rows, in visit mode the visits are; patients keep their own dict when its layout is not
+    one list per visit (e.g., volume and dicom datasets).
+    """
+    if dataset.iterate_mode == 'patient':
+        patients = list(dataset.patients.values())
+        # patients with one frame list per visit cannot be iterated as rows, keep them as they are
+        if all(isinstance(frame, str) for patient in patients for frame in patient['frames']):
+            dataset.visit_index = VisitIndex(patients, list(dataset.patients.keys()))
+            dataset.patients = PatientRowView(dataset.visit_index)
+        else:
+            dataset.visit_index = None
+        return
+
+    num_visits = len(dataset.visits_dict)
+    visits = [dataset.visits_dict[visit_idx] for visit_idx in range(num_visits)]
+    dataset.visit_index = VisitIndex(visits, [dataset.mapping_visit2patient[visit_idx] for visit_idx in range(num_visits)])
+    patient = next(iter(dataset.patients.values()), None)
+    if patient is not None and set(patient.keys()) <= set(dataset.visit_index.keys) and all(isinstance(frames, list) for frames in patient['frames']):
+        dataset.patients = PatientDictView(dataset.visit_index)
+    dataset.visits_dict = VisitDictView(dataset.visit_index)
+    dataset.mapping_visit2patient = VisitPatientView(dataset.visit_index)
+    dataset.mapping_patient2visit = PatientVisitView(dataset.visit_index)
+
+
+def get_patient_sample(dataset, idx):
+    """
+    Patient id and dict of the idx-th patient of a dataset in patient iterate mode, from its
+    VisitIndex rows, or from its patients dict when set_visit_index did not build them
+    """
+    visit_index = getattr(dataset, 'visit_index', None)
+    if visit_index is None:
+        patient_id = list(dataset.patients.keys())[idx]
+        return patient_id, dataset.patients[patient_id]
+    return visit_index.get_patient_id(idx), visit_index.get_visit(idx)
@@ -0,0 +1,113 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+
+import numpy as np
+from PIL import Image
+
+
+def load_visit_frames(root_dir, frame_paths, downsample_width=True):
+    """
+    Load the frames of a visit as one uint8 [T, H, W] grayscale block, downsampled as
+    PatientDataset3D_inhouse does with downsample_width
+    """
+    frames = [Image.open(root_dir + frame_path, mode='r').convert('L') for frame_path in frame_paths]
+    if downsample_width:
+        for i, frame in enumerate(frames):
+            if frame.size[0] == 1024:
+                frames[i] = frame.resize((512, frame.size[1]))
+            if frame.size[1] == 1024 or frame.size[1] == 1536:
+                frames[i] = frame.resize((frame.size[0], frame.size[1] // 2))
+    return np.stack([np.asarray(frame, dtype=np.uint8) for frame in frames])
+
+
+class VolumeStoreWriter:
+    def __init__(self, store_dir, shard_size_gb=4):
+        """
+        Append visits as contiguous uint8 [T, H, W] blocks to raw shard files, call close() to
+        write the visit index.
+
+        Args:
+            store_dir (str): output directory of the shards and index.npz
+            shard_size_gb (float): a new shard is started once the current one exceeds this size
+        """
+        self.store_dir = store_dir
+        self.shard_size = int(shard_size_gb * 1024 ** 3)
+        os.makedirs(store_dir, exist_ok=True)
+        self.visit_keys, self.shard, self.offset, self.shape = [], [], [], []
+        self.shard_idx = 0
+        self.shard_offset = 0
+        self.f = open(self.get_shard_path(self.shard_idx), 'wb')
+
+    def get_shard_path(self, shard_idx):
+        return os.path.join(self.store_dir, 'volumes-%03d.u8' % shard_idx)
+
+    def add(self, visit_key, volume):
+        volume = np.ascontiguousarray(volume, dtype=np.uint8)
+        assert volume.ndim == 3, 'expected a [T, H, W] volume'
+        if self.shard_offset > 0 and self.shard_offset + volume.nbytes > self.shard_size:
+            self.f.close()
+            self.shard_idx += 1
+            self.shard_offset = 0
+            self.f = open(self.get_shard_path(self.shard_idx), 'wb')
+        self.f.write(volume.tobytes())
+        self.visit_keys.append(visit_key)
+        self.shard.append(self.shard_idx)
+        self.offset.append(self.shard_offset)
+        self.shape.append(volume.shape)
+        self.shard_offset += volume.nbytes
+
+    def close(self):
+        self.f.close()
+        np.savez(os.path.join(self.store_dir, 'index.npz'), visit_keys=np.array(self.visit_keys), shard=np.array(self.shard, dtype=np.int32), offset=np.array(self.offset, dtype=np.int64), shape=np.array(self.shape, dtype=np.int32).reshape(-1, 3))
+
+
+class VolumeStore:
+    def __init__(self, store_dir):
+        """
+        Read-only view of the volumes packed by VolumeStoreWriter. Shards are memory-mapped lazily
+        in each process, so the store can be created before DataLoader workers are forked.
+
+        Args:
+            store_dir (str): directory of the shards and index.npz
+        """
+        self.store_dir = store_dir
+        index = np.load(os.path.join(store_dir, 'index.npz'))
+        self.visit_keys = index['visit_keys']
+        self.shard = index['shard']
+        self.offset = index['offset']
+        self.shape = index['shape']
+        self.key_to_idx = {key: i for i, key in enumerate(self.visit_keys.tolist())}
+        self.shards = None
+
+    def __len__(self):
+        return len(self.visit_keys)
+
+    def get_store_idx(self, visit_keys):
+        """
+        return: store index of each visit key, -1 if the visit is not packed
+        """
+        return np.array([self.key_to_idx.get(key, -1) for key in visit_keys], dtype=np.int64)
+
+    def get(self, store_idx):
+        """
+        return: uint8 [T, H, W] volume, a view of the memory-mapped shard
+        """
+        if self.shards is None:
+            num_shards = int(self.shard.max()) + 1 if len(self.shard) > 0 else 0
+            # copy-on-write mapping: reads are zero-copy and the arrays are writable for torch.from_numpy
+            self.shards = [np.memmap(os.path.join(self.store_dir, 'volumes-%03d.u8' % i), dtype=np.uint8, mode='c') for i in range(num_shards)]
+        shape = tuple(self.shape[store_idx])
+        offset = self.offset[store_idx]
+        return self.shards[self.shard[store_idx]][offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def __getstate__(self):
+        # memory maps are re-opened in the receiving process
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
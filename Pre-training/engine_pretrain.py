@@ -17,6 +17,8 @@ import math
 from typing import Iterable
 import pickle as pkl
 
+import numpy as np
+
 import custom_util.lr_sched as lr_sched
 import custom_util.misc as misc
 import torch
@@ -25,6 +27,59 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def get_pre_mask(model, samples, data_info, pre_mask_store=None):
+    """
+    Anatomy pre-masks of a 3D batch. When the dataset serves them from pre_mask_store, only the
+    missing or expired ones are computed from the patch embeddings and written back to the store.
+    """
+    if pre_mask_store is None or len(data_info) < 3 or len(samples) != len(data_info[2][0]):
+        feat = model.module.forward_patch_embed(samples).detach()
+        return misc.get_mask(feat)
+
+    pre_mask, pre_mask_valid, pre_mask_key = data_info[2]
+    missing = ~pre_mask_valid
+    if missing.any():
+        feat = model.module.forward_patch_embed(samples[missing.to(samples.device)]).detach()
+        new_pre_mask = misc.get_mask(feat)
+        pre_mask[missing] = new_pre_mask.to(pre_mask.dtype)
+        pre_mask_store.update(pre_mask_key[missing], new_pre_mask)
+    return pre_mask
+
+
+@torch.no_grad()
+def fill_pre_mask_store(
+    model: torch.nn.Module,
+    data_loader: Iterable,
+    pre_mask_store,
+    device: torch.device,
+    fp32=False,
+    fp16=False,
+):
+    """
+    Offline pass filling pre_mask_store for the visits (and flip states) drawn by data_loader.
+    """
+    metric_logger = misc.MetricLogger(delimiter="  ")
+    header = "Fill pre-mask store:"
+    for samples, data_info in metric_logger.log_every(data_loader, 20, header):
+        samples = samples.to(device, non_blocking=True)
+        with torch.cuda.amp.autocast(enabled=not fp32, dtype=torch.float16 if fp16 else None):
+            get_pre_mask(model, samples, data_info, pre_mask_store)
+    print("Pre-mask store: {} valid masks".format(pre_mask_store.num_valid()))
+
+
+def get_frame_cube_idx(num_frames, num_cubes, cube_size=3):
+    """
+    Map the frames of a volume to the temporal cubes of its frame loss: each cube covers
+    cube_size frames and the trailing frame is assigned to the last cube.
+    return: frame positions [F] and their cube index [F]
+    """
+    frame_pos = np.arange(min(num_cubes * cube_size, num_frames))
+    cube_idx = frame_pos // cube_size
+    if num_frames - 1 > frame_pos[-1]:
+        frame_pos = np.append(frame_pos, num_frames - 1)
+        cube_idx = np.append(cube_idx, num_cubes - 1)
+    return frame_pos, cube_idx
+
 
 def train_one_epoch_joint(
     model: torch.nn.Module,
@@ -34,12 +89,13 @@ def train_one_epoch_joint(
     epoch: int,
     loss_scaler,
     data_loader_2d,
-    dataset_2d_all_image_dict,
+    dataset_2d,
     mask_ratio_2d,
     log_writer=None,
     args=None,
     fp32=False,
     fp16=False,
+    pre_mask_store=None,
 ):
     model.train(True)
     metric_logger = misc.MetricLogger(delimiter="  ")
@@ -109,10 +165,7 @@ def train_one_epoch_joint(
 
         with torch.cuda.amp.autocast(enabled=not fp32, dtype=torch.float16 if fp16 else None):
 
-            feat = model.module.forward_patch_embed(samples).detach()
-
-            filled_mask_list = misc.get_mask(feat)
-            filled_mask_tensor = torch.stack(filled_mask_list, dim=0).long()
+            filled_mask_tensor = get_pre_mask(model, samples, data_info, pre_mask_store).long()
 
             loss, _, _ = model(
                 samples,
@@ -130,20 +183,11 @@ def train_one_epoch_joint(
         loss_value = loss.item()
         loss_2d_value = loss_2d.item()
 
-        for j, vol in enumerate(frame_loss):
-            cube_size = 3
-            frame_name_list = [data_dict['frames'][nf][j] for nf in range(len(data_dict['frames']))]
-
-            for k, frame_loss in enumerate(vol):
-                # k ranges from 0 to 20
-                # each frame_loss goes for 3 frames
-                for fr in range(cube_size):
-                    frame_name = frame_name_list[k * cube_size + fr]
-                    dataset_2d_all_image_dict[frame_name]['mse_loss'] = frame_loss.item()
-                    dataset_2d_all_image_dict[frame_name]['hardness'] = frame_loss.item()
-
-            dataset_2d_all_image_dict[frame_name_list[-1]]['mse_loss'] = frame_loss.item()
-            dataset_2d_all_image_dict[frame_name_list[-1]]['hardness'] = frame_loss.item()
+        # one device-to-host copy of the [B, T] frame loss, then a single scatter to the hardness store
+        frame_loss = frame_loss.detach().float().cpu().numpy()
+        frame_pos, cube_idx = get_frame_cube_idx(len(data_dict['frames']), frame_loss.shape[1])
+        frame_ids = np.array([[dataset_2d.frame_id[data_dict['frames'][nf][j]] for nf in frame_pos] for j in range(len(frame_loss))])
+        dataset_2d.update_hardness(frame_ids.reshape(-1), frame_loss[:, cube_idx].reshape(-1))
 
 
         loss = loss + loss_2d
@@ -301,11 +345,12 @@ def eval_one_epoch(
                     sample_2d_info = secondary_data[1]
                     img_names_2d = sample_2d_info[-1]
 
-                    pre_mask = torch.zeros_like(sample_2d)
-                    for i in range(len(sample_2d)):
-                        sample = sample_2d[i, 0]
-
-                        sample_2d[i, 0], pre_mask[i, 0] = misc.find_and_convert_large_white_region(sample)
+                    if len(secondary_data) > 2:
+                        # white regions already converted by misc.white_region_collate in the workers
+                        pre_mask = secondary_data[2].to(sample_2d.dtype)
+                    else:
+                        sample_2d[:, 0], pre_mask = misc.find_and_convert_large_white_region_batch(sample_2d[:, 0])
+                        pre_mask = pre_mask.unsqueeze(1).to(sample_2d.dtype)
 
                     with torch.cuda.amp.autocast(enabled=not fp32, dtype=torch.float16 if fp16 else None):
                         loss_2d, pred_2d, mask_2d = model(
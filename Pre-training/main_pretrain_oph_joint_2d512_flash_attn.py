@@ -33,13 +33,16 @@ import torch.backends.cudnn as cudnn
 from iopath.common.file_io import g_pathmgr as pathmgr
 
 import models_mae_joint_res_flash_attn as models_mae
-from engine_pretrain import train_one_epoch_joint, eval_one_epoch
+from engine_pretrain import train_one_epoch_joint, eval_one_epoch, fill_pre_mask_store
 
 from custom_util.misc import NativeScalerWithGradNormCount as NativeScaler
 from custom_util.misc import convert_spatial_pos_embed
 from custom_util.PatientDataset import TransformableSubset
 from custom_util.PatientDataset_inhouse import PatientDatasetCenter2D_inhouse, PatientDataset3D_inhouse, create_3d_transforms, load_patient_list
 from custom_util.PatientDataset_pretrain import PatientDatasetCenter2D_inhouse_pretrain, Inhouse_and_Kermany_Dataset
+from custom_util.pre_mask_store import PreMaskStore
+from custom_util.otsu_mask_store import OtsuMaskStore
+from custom_util.spl_sampler import SPLDistributedSampler, SPLMixtureSampler
 from tensorboard.compat.tensorflow_stub.io.gfile import register_filesystem
 from torch.utils.tensorboard import SummaryWriter
 
@@ -90,9 +93,12 @@ def get_args_parser():
     parser.add_argument('--data_path', default=home_directory + '/Ophthal/', type=str, help='dataset path')
     parser.add_argument('--patient_id_list_dir', default='multi_label_expr_all_0319/', type=str, help='patient id list dir')
     parser.add_argument('--metadata_dir', default='Oph_cls_task/', type=str, help='metadata dir')
+    parser.add_argument('--otsu_mask_dir', default=None, type=str, help='serve the 2D Otsu patch masks from the stores in this directory (see precompute_otsu_masks.py) instead of thresholding every frame')
+    parser.add_argument('--volume_store_dir', default=None, type=str, help='read the 3D volumes from this packed volume store (see pack_volume_store.py) instead of the png frames')
     parser.add_argument('--eval_only', action='store_true', help='perform evaluation only')
     parser.add_argument('--eval_only_epoch', default=0, type=int, help='perform evaluation only epoch')
     parser.add_argument('--resume_type', default='retfound', type=str, choices=['training_latest', 'training_new', 'retfound', 'training_continue_reset_optim', 'retfound_2_flash_attn', 'imagenet_2_flash_attn', 'imagenet_ft_2_flash_attn'] , help='resume type')
+    parser.add_argument("--mixture_weights_2d", default=None, type=float, nargs=2, help="sampling weights of the in-house and Kermany 2D frames, with a 2D epoch of one 3D epoch of steps; None for one pass over both")
     parser.add_argument("--batch_size_2d",default=16, type=int, help="2d Batch size per GPU (effective batch size is batch_size * accum_iter * # gpus",)
     parser.add_argument("--mask_ratio_2d_min", default=0.75, type=float, help="Masking ratio (percentage of removed patches).",)
     parser.add_argument("--mask_ratio_2d_max", default=0.85, type=float, help="Masking ratio (percentage of removed patches).",)
@@ -103,6 +109,10 @@ def get_args_parser():
     parser.add_argument("--epoch_load_spl", default=-1, type=int, help="epoch offset",)
     parser.add_argument("--load_spl_dir", default='', type=str, help="load spl dir",)
     parser.add_argument("--init_ckpt", default="", help="Initialize from non-flash-attn checkpoint")
+    parser.add_argument("--use_pre_mask_store", action="store_true", help="serve the 3D pre-masks from a per-visit store instead of recomputing them every step")
+    parser.add_argument("--pre_mask_store_path", default="", type=str, help="pre-mask store file to load (if it exists) and save every epoch")
+    parser.add_argument("--pre_mask_refresh_epochs", default=10, type=int, help="recompute a stored pre-mask once it is this many epochs old")
+    parser.add_argument("--fill_pre_mask_store", action="store_true", help="fill the pre-mask store with one pass over the train set before training")
 
     parser.add_argument(
         "--batch_size",
@@ -207,6 +217,7 @@ def get_args_parser():
         "--start_epoch", default=0, type=int, metavar="N", help="start epoch"
     )
     parser.add_argument("--num_workers", default=10, type=int)
+    parser.add_argument("--prefetch_factor", default=2, type=int, help="number of batches prefetched by each DataLoader worker")
     parser.add_argument(
         "--pin_mem",
         action="store_true",
@@ -316,7 +327,14 @@ def main(args):
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
             ])
 
-    dataset_train_2d = PatientDatasetCenter2D_inhouse_pretrain(root_dir=args.data_path, task_mode='multi_label', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='frame', transform=transform_2d_train, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, enable_spl=True, mask_transform=transform_2d_train, return_mask=False, metadata_dir=args.metadata_dir)
+    otsu_mask_store, otsu_mask_store_kermany = None, None
+    if args.otsu_mask_dir:
+        otsu_mask_store = OtsuMaskStore(os.path.join(args.otsu_mask_dir, 'inhouse'))
+        if os.path.exists(os.path.join(args.otsu_mask_dir, 'kermany', 'meta.json')):
+            otsu_mask_store_kermany = OtsuMaskStore(os.path.join(args.otsu_mask_dir, 'kermany'))
+        assert otsu_mask_store.meta['input_size'] == args.high_res_input_size, 'Otsu masks computed at another input size'
+
+    dataset_train_2d = PatientDatasetCenter2D_inhouse_pretrain(root_dir=args.data_path, task_mode='multi_label', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='frame', transform=transform_2d_train, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, enable_spl=False, mask_transform=transform_2d_train, return_mask=False, metadata_dir=args.metadata_dir, otsu_mask_store=otsu_mask_store)
 
     test_pat_id = load_patient_list(args.split_path, split='test', name_suffix='_pat_list.txt')
     included_patient = list(dataset_train_2d.patients.keys())
@@ -325,15 +343,14 @@ def main(args):
     dataset_train_2d.all_image_list = dataset_train_2d.get_all_image_list(filtered_test_pat_id)
 
     dataset_train_2d.update_len_dataset_list()
-    dataset_train_2d.init_spl(K=0.2)
     dataset_train_2d_kermany = datasets.ImageFolder(os.path.join(args.kermany_data_dir, 'train'), transform=transform_2d_train)
-    dataset_train_2d_all = Inhouse_and_Kermany_Dataset(dataset_train_2d, dataset_train_2d_kermany)
+    dataset_train_2d_all = Inhouse_and_Kermany_Dataset(dataset_train_2d, dataset_train_2d_kermany, otsu_mask_store=otsu_mask_store_kermany)
 
 
     # 3d dataset
     transform_train, transform_eval = create_3d_transforms(**vars(args))
 
-    dataset = PatientDataset3D_inhouse(root_dir=args.data_path, task_mode='multi_label', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='frame', mode='gray', transform=None, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, pad_to_num_frames=True, padding_num_frames=args.num_frames, transform_type='monai_3D', return_img_w_patient_and_visit_name=True, return_data_dict=True, metadata_dir=args.metadata_dir)
+    dataset = PatientDataset3D_inhouse(root_dir=args.data_path, task_mode='multi_label', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='packed' if args.volume_store_dir else 'frame', volume_store_dir=args.volume_store_dir, mode='gray', transform=None, iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, pad_to_num_frames=True, padding_num_frames=args.num_frames, transform_type='monai_3D', return_img_w_patient_and_visit_name=True, return_data_dict=True, metadata_dir=args.metadata_dir)
 
     train_pat_id = load_patient_list(args.split_path, split='train', name_suffix='_pat_list.txt')
     val_pat_id = load_patient_list(args.split_path, split='val', name_suffix='_pat_list.txt')
@@ -364,25 +381,46 @@ def main(args):
         sampler_train = torch.utils.data.DistributedSampler(
             dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
         )
-        # newly added: for 2d dataset
         print("Sampler_train = %s" % str(sampler_train))
-        sampler_train_2d = torch.utils.data.DistributedSampler(
-            dataset_train_2d_all, num_replicas=num_tasks, rank=global_rank, shuffle=True
-        )
-        data_loader_train_2d = torch.utils.data.DataLoader(
-            dataset_train_2d_all, sampler=sampler_train_2d,
-            batch_size=args.batch_size_2d,
-            num_workers=args.num_workers,
-            pin_memory=args.pin_mem,
-            drop_last=True,
-        )
-        print("Data_loader_train_2d = %s" % len(data_loader_train_2d), len(data_loader_train_2d) * args.batch_size_2d)
 
     else:
         num_tasks = 1
         global_rank = 0
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
 
+    # 2d dataset: the SPL sampler selects the hardest frames, workers persist across K updates
+    if args.mixture_weights_2d is not None:
+        # as many 2D batches as 3D steps, so the joint step never restarts the 2D loader
+        num_samples_2d = len(sampler_train) // args.batch_size * args.batch_size_2d
+        sampler_train_2d = SPLMixtureSampler(
+            dataset_train_2d_all, num_samples_2d, weights=args.mixture_weights_2d, num_replicas=num_tasks, rank=global_rank, seed=args.seed, K=0.2
+        )
+    else:
+        sampler_train_2d = SPLDistributedSampler(
+            dataset_train_2d_all, num_replicas=num_tasks, rank=global_rank, shuffle=True, seed=args.seed, K=0.2
+        )
+    data_loader_train_2d = torch.utils.data.DataLoader(
+        dataset_train_2d_all, sampler=sampler_train_2d,
+        batch_size=args.batch_size_2d,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_mem,
+        drop_last=True,
+        persistent_workers=args.num_workers > 0,
+        prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
+    )
+    print("Data_loader_train_2d = %s" % len(data_loader_train_2d), len(data_loader_train_2d) * args.batch_size_2d)
+
+    # only feeds the 2D reconstructions logged during evaluation, white regions are converted in its workers
+    data_loader_vis_2d = torch.utils.data.DataLoader(
+        dataset_train_2d_all,
+        batch_size=args.batch_size_2d,
+        shuffle=True,
+        num_workers=min(args.num_workers, 2),
+        pin_memory=args.pin_mem,
+        drop_last=True,
+        collate_fn=misc.white_region_collate,
+    )
+
     if global_rank == 0 and args.log_dir is not None:
         try:
             pathmgr.mkdirs(args.log_dir)
@@ -399,6 +437,8 @@ def main(args):
         num_workers=args.num_workers,
         pin_memory=args.pin_mem,
         drop_last=True,
+        persistent_workers=args.num_workers > 0,
+        prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
     )
     # newly added for validation
     data_loader_val = torch.utils.data.DataLoader(
@@ -454,6 +494,16 @@ def main(args):
         betas=beta,
     )
     loss_scaler = NativeScaler(fp32=args.fp32)
+
+    pre_mask_store = None
+    if args.use_pre_mask_store:
+        pre_mask_store = PreMaskStore(len(dataset), model_without_ddp.patch_embed.input_size, refresh_epochs=args.pre_mask_refresh_epochs)
+        pre_mask_store.set_epoch(args.start_epoch)
+        if args.pre_mask_store_path and os.path.exists(args.pre_mask_store_path):
+            pre_mask_store.load(args.pre_mask_store_path)
+            print("Load pre-mask store from %s: %d valid masks" % (args.pre_mask_store_path, pre_mask_store.num_valid()))
+        dataset.set_pre_mask_store(pre_mask_store)
+
     if args.resume or args.init_ckpt or args.resume_type == 'imagenet_2_flash_attn' or args.resume_type == 'imagenet_ft_2_flash_attn':
         print("Resuming from checkpoint")
         if args.resume_type == 'training_latest':
@@ -469,24 +519,11 @@ def main(args):
             if os.path.exists(args.output_dir + f'/all_image_dict-{args.start_epoch:02d}.pkl'):
                 with pathmgr.open(args.output_dir + f'/all_image_dict-{args.start_epoch:02d}.pkl', "rb") as f:
                     all_image_dict = pkl.load(f)
-                dataset_train_2d.all_image_dict = all_image_dict
+                dataset_train_2d.set_all_image_dict(all_image_dict)
                 K_for_spl = K_scheduler(args.start_epoch, K_max=args.K_max, K_min=args.K_min, all_epoch=args.epochs, warmup_epochs=args.warmup_epochs, epoch_offset=args.epoch_offset)
                 # update spl for dataset_train_2d
-                dataset_train_2d.update_spl(K=K_for_spl)
-
-                # newly added: for 2d dataset
-                print("Update: Sampler_train = %s" % str(sampler_train))
-                sampler_train_2d = torch.utils.data.DistributedSampler(
-                    dataset_train_2d_all, num_replicas=num_tasks, rank=global_rank, shuffle=True
-                )
-                data_loader_train_2d = torch.utils.data.DataLoader(
-                    dataset_train_2d_all, sampler=sampler_train_2d,
-                    batch_size=args.batch_size_2d,
-                    num_workers=args.num_workers,
-                    pin_memory=args.pin_mem,
-                    drop_last=True,
-                )
-            print('len of dataset_train_2d:', len(dataset_train_2d), len(dataset_train_2d_all))
+                sampler_train_2d.update_spl(K=K_for_spl)
+            print('len of dataset_train_2d:', len(sampler_train_2d.visible_frame_idx), len(dataset_train_2d_all))
             print('len of data_loader_train_2d:', len(data_loader_train_2d))
 
         elif args.resume_type == 'training_new':
@@ -547,24 +584,11 @@ def main(args):
             if args.epoch_load_spl >= 0 and os.path.exists(args.load_spl_dir + f'/all_image_dict-{args.epoch_load_spl:02d}.pkl'):
                 with pathmgr.open(args.load_spl_dir + f'/all_image_dict-{args.epoch_load_spl:02d}.pkl', "rb") as f:
                     all_image_dict = pkl.load(f)
-                dataset_train_2d.all_image_dict = all_image_dict
+                dataset_train_2d.set_all_image_dict(all_image_dict)
                 K_for_spl = K_scheduler(args.start_epoch, K_max=args.K_max, K_min=args.K_min, all_epoch=args.epochs, warmup_epochs=args.warmup_epochs, epoch_offset=args.epoch_offset)
                 # update spl for dataset_train_2d
-                dataset_train_2d.update_spl(K=K_for_spl)
-
-                # Set up the dataloader for 2d dataset
-                print("Update: Sampler_train = %s" % str(sampler_train))
-                sampler_train_2d = torch.utils.data.DistributedSampler(
-                    dataset_train_2d_all, num_replicas=num_tasks, rank=global_rank, shuffle=True
-                )
-                data_loader_train_2d = torch.utils.data.DataLoader(
-                    dataset_train_2d_all, sampler=sampler_train_2d,
-                    batch_size=args.batch_size_2d,
-                    num_workers=args.num_workers,
-                    pin_memory=args.pin_mem,
-                    drop_last=True,
-                )
-                print('continue training update spl: len of dataset_train_2d:', len(dataset_train_2d), len(dataset_train_2d_all))
+                sampler_train_2d.update_spl(K=K_for_spl)
+                print('continue training update spl: len of dataset_train_2d:', len(sampler_train_2d.visible_frame_idx), len(dataset_train_2d_all))
                 print('continue training update spl: len of data_loader_train_2d:', len(data_loader_train_2d))
 
         else:
@@ -583,7 +607,7 @@ def main(args):
                     fp16=args.fp16,
                     joint=True,
                     visible_frame_freq=5,
-                    data_loader_2d=data_loader_train_2d,
+                    data_loader_2d=data_loader_vis_2d,
                     mask_ratio_2d=0.75,
                 )
 
@@ -591,6 +615,10 @@ def main(args):
             print('End of evaluation, exiting...')
             exit()
 
+    if pre_mask_store is not None and args.fill_pre_mask_store:
+        pre_mask_store.set_epoch(args.start_epoch)
+        fill_pre_mask_store(model, data_loader_train, pre_mask_store, device, fp32=args.fp32, fp16=args.fp16)
+
     checkpoint_path = ""
     print(f"Start training for {args.epochs} epochs, currently at epoch {args.start_epoch}")
     start_time = time.time()
@@ -601,6 +629,9 @@ def main(args):
         mask_ratio_2d = mask_ratio_2d_scheduler(epoch, mask_ratio_max=args.mask_ratio_2d_max, mask_ratio_min=args.mask_ratio_2d_min, all_epoch=args.epochs, warmup_epochs=args.warmup_epochs, epoch_offset=args.epoch_offset)
         if args.distributed:
             data_loader_train.sampler.set_epoch(epoch)
+        sampler_train_2d.set_epoch(epoch)
+        if pre_mask_store is not None:
+            pre_mask_store.set_epoch(epoch)
         train_stats = train_one_epoch_joint(
             model,
             data_loader_train,
@@ -613,9 +644,12 @@ def main(args):
             fp32=args.fp32,
             fp16=args.fp16,
             data_loader_2d=data_loader_train_2d,
-            dataset_2d_all_image_dict=all_image_dict,
+            dataset_2d=dataset_train_2d,
             mask_ratio_2d=mask_ratio_2d,
+            pre_mask_store=pre_mask_store,
         )
+        # gather the hardness measured on every rank before it is saved and used by update_spl
+        sampler_train_2d.sync_hardness()
 
         dataset_train.remove_dataset_transform()
         dataset_val.update_dataset_transform(transform_eval)
@@ -632,7 +666,7 @@ def main(args):
             fp16=args.fp16,
             joint=True,
             visible_frame_freq=20,
-            data_loader_2d=data_loader_train_2d,
+            data_loader_2d=data_loader_vis_2d,
             mask_ratio_2d=0.75,
         )
 
@@ -667,23 +701,12 @@ def main(args):
                 f.write(json.dumps(log_stats) + "\n")
             filename = f"{args.output_dir}/all_image_dict-{epoch+1:02d}.pkl"
             with pathmgr.open(filename, "wb") as f:
-                pkl.dump(all_image_dict, f)
+                pkl.dump(dataset_train_2d.get_all_image_dict(), f)
+            if pre_mask_store is not None and args.pre_mask_store_path:
+                pre_mask_store.save(args.pre_mask_store_path)
 
-        # update spl for dataset_train_2d
-        dataset_train_2d.update_spl(K=K_for_spl)
-
-        # reset dataloader for 2d dataset
-        print("Update: Sampler_train = %s" % str(sampler_train))
-        sampler_train_2d = torch.utils.data.DistributedSampler(
-            dataset_train_2d_all, num_replicas=num_tasks, rank=global_rank, shuffle=True
-        )
-        data_loader_train_2d = torch.utils.data.DataLoader(
-            dataset_train_2d_all, sampler=sampler_train_2d,
-            batch_size=args.batch_size_2d,
-            num_workers=args.num_workers,
-            pin_memory=args.pin_mem,
-            drop_last=True,
-        )
+        # update spl for dataset_train_2d, the data loader keeps its workers
+        sampler_train_2d.update_spl(K=K_for_spl, sync=False)
         print("Update: Data_loader_train_2d = %s" % len(data_loader_train_2d))
 
     total_time = time.time() - start_time
@@ -21,6 +21,7 @@ import torch.nn as nn
 from einops import rearrange
 from collections import OrderedDict
 from custom_util import video_vit
+from custom_util.pos_embed import PosEmbedCache, get_pos_embed_params
 from custom_util.loggings import master_print as print
 import torch.nn.functional as F
 import numpy as np
@@ -63,6 +64,8 @@ class MaskedAutoencoderViT(nn.Module):
         super().__init__()
         self.trunc_init = trunc_init
         self.sep_pos_embed = sep_pos_embed
+        self.pos_embed_cache = PosEmbedCache()
+        self.decoder_pos_embed_cache = PosEmbedCache()
         self.cls_embed = cls_embed
         self.pred_t_dim = pred_t_dim
         self.in_chans = in_chans
@@ -371,6 +374,78 @@ class MaskedAutoencoderViT(nn.Module):
 
         return x_masked, mask, ids_restore, ids_keep
 
+    def build_sep_pos_embed(self, T, high_res, temp_pos_emb_type):
+        """
+        return: [1, T * H * W (or H * W if temp_pos_emb_type is 'none'), C] encoder pos embed of the
+        separable spatial / temporal pos embeds, before masking and without the class pos embed
+        """
+        if not high_res:
+            # pool pos_embed to match the input size
+
+            pos_embed = F.interpolate(
+                self.pos_embed_spatial.view(1, self.high_res_input_size[1], self.high_res_input_size[2], -1).permute(0, 3, 1, 2), [self.input_size[1], self.input_size[2]],mode='bicubic', align_corners=False
+            ).permute(0, 2, 3, 1).view(1, self.input_size[1] * self.input_size[2], -1)
+
+            pos_h, pos_w = self.input_size[1], self.input_size[2]
+
+        else:
+            pos_embed = self.pos_embed_spatial
+            pos_h, pos_w = self.high_res_input_size[1], self.high_res_input_size[2]
+
+        if temp_pos_emb_type == 'all':
+            pos_embed = pos_embed.repeat(
+                1, T, 1
+            ) + torch.repeat_interleave(
+                self.pos_embed_temporal,
+                pos_h * pos_w,
+                dim=1,
+            )
+        elif temp_pos_emb_type == 'none':
+            pos_embed = pos_embed.repeat(
+                1, 1, 1
+            )
+        return pos_embed
+
+    def build_decoder_sep_pos_embed(self, high_res, temp_pos_emb_type):
+        """
+        return: [1, (1 +) T * H * W, C] decoder pos embed of the separable spatial / temporal (/ class) pos embeds
+        """
+        if not high_res:
+            # pool pos_embed to match the input size
+
+            decoder_pos_embed = F.interpolate(
+                self.decoder_pos_embed_spatial.view(1, self.high_res_input_size[1], self.high_res_input_size[2], -1).permute(0, 3, 1, 2), [self.input_size[1], self.input_size[2]],mode='bicubic', align_corners=False
+            ).permute(0, 2, 3, 1).view(1, self.input_size[1] * self.input_size[2], -1)
+            pos_h, pos_w = self.input_size[1], self.input_size[2]
+        else:
+
+            decoder_pos_embed = self.decoder_pos_embed_spatial
+            pos_h, pos_w = self.high_res_input_size[1], self.high_res_input_size[2]
+        if temp_pos_emb_type == 'all':
+
+            decoder_pos_embed = decoder_pos_embed.repeat(
+                1, self.input_size[0], 1
+            ) + torch.repeat_interleave(
+                self.decoder_pos_embed_temporal,
+                pos_h * pos_w,
+                dim=1,
+            )
+        elif temp_pos_emb_type == 'none':
+            decoder_pos_embed = self.decoder_pos_embed_spatial.repeat(
+                1, 1, 1
+            )
+        if self.cls_embed:
+            decoder_pos_embed = torch.cat(
+                [
+                    self.decoder_pos_embed_class.expand(
+                        decoder_pos_embed.shape[0], -1, -1
+                    ),
+                    decoder_pos_embed,
+                ],
+                1,
+            )
+        return decoder_pos_embed
+
     def forward_encoder(self, x, mask_ratio, pre_mask=None):
         # embed patches
 
@@ -413,31 +488,12 @@ class MaskedAutoencoderViT(nn.Module):
 
         # add pos embed w/o cls token
         if self.sep_pos_embed:
-            if not high_res:
-                # pool pos_embed to match the input size
-
-                pos_embed = F.interpolate(
-                    self.pos_embed_spatial.view(1, self.high_res_input_size[1], self.high_res_input_size[2], -1).permute(0, 3, 1, 2), [self.input_size[1], self.input_size[2]],mode='bicubic', align_corners=False
-                ).permute(0, 2, 3, 1).view(1, self.input_size[1] * self.input_size[2], -1)
-
-                pos_h, pos_w = self.input_size[1], self.input_size[2]
-
-            else:
-                pos_embed = self.pos_embed_spatial
-                pos_h, pos_w = self.high_res_input_size[1], self.high_res_input_size[2]
-
-            if temp_pos_emb_type == 'all':
-                pos_embed = pos_embed.repeat(
-                    1, T, 1
-                ) + torch.repeat_interleave(
-                    self.pos_embed_temporal,
-                    pos_h * pos_w,
-                    dim=1,
-                )
-            elif temp_pos_emb_type == 'none':
-                pos_embed = pos_embed.repeat(
-                    1, 1, 1
-                )
+            # rebuilt only when the pos embed parameters change, see PosEmbedCache
+            pos_size = self.high_res_input_size[1:] if high_res else self.input_size[1:]
+            pos_embed = self.pos_embed_cache.get(
+                (T, *pos_size, high_res, temp_pos_emb_type), get_pos_embed_params(self),
+                partial(self.build_sep_pos_embed, T, high_res, temp_pos_emb_type)
+            )
 
             pos_embed = pos_embed.expand(x.shape[0], -1, -1)
 
@@ -530,41 +586,12 @@ class MaskedAutoencoderViT(nn.Module):
             x = torch.cat((decoder_cls_tokens, x), dim=1)
 
         if self.sep_pos_embed:
-
-            if not high_res:
-                # pool pos_embed to match the input size
-
-                decoder_pos_embed = F.interpolate(
-                    self.decoder_pos_embed_spatial.view(1, self.high_res_input_size[1], self.high_res_input_size[2], -1).permute(0, 3, 1, 2), [self.input_size[1], self.input_size[2]],mode='bicubic', align_corners=False
-                ).permute(0, 2, 3, 1).view(1, self.input_size[1] * self.input_size[2], -1)
-                pos_h, pos_w = self.input_size[1], self.input_size[2]
-            else:
-
-                decoder_pos_embed = self.decoder_pos_embed_spatial
-                pos_h, pos_w = self.high_res_input_size[1], self.high_res_input_size[2]
-            if temp_pos_emb_type == 'all':
-
-                decoder_pos_embed = decoder_pos_embed.repeat(
-                    1, self.input_size[0], 1
-                ) + torch.repeat_interleave(
-                    self.decoder_pos_embed_temporal,
-                    pos_h * pos_w,
-                    dim=1,
-                )
-            elif temp_pos_emb_type == 'none':
-                decoder_pos_embed = self.decoder_pos_embed_spatial.repeat(
-                    1, 1, 1
-                )
-            if self.cls_embed:
-                decoder_pos_embed = torch.cat(
-                    [
-                        self.decoder_pos_embed_class.expand(
-                            decoder_pos_embed.shape[0], -1, -1
-                        ),
-                        decoder_pos_embed,
-                    ],
-                    1,
-                )
+            # rebuilt only when the decoder pos embed parameters change, see PosEmbedCache
+            pos_size = self.high_res_input_size[1:] if high_res else self.input_size[1:]
+            decoder_pos_embed = self.decoder_pos_embed_cache.get(
+                (*pos_size, high_res, temp_pos_emb_type), get_pos_embed_params(self, prefix="decoder_pos_embed"),
+                partial(self.build_decoder_sep_pos_embed, high_res, temp_pos_emb_type)
+            )
         else:
             decoder_pos_embed = self.decoder_pos_embed[:, :, :]
 
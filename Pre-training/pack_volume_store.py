@@ -0,0 +1,57 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# Offline packer of the in-house OCT frame directories: every visit is decoded once, downsampled
+# as PatientDataset3D_inhouse does with downsample_width and appended as one contiguous uint8
+# [T, H, W] grayscale block to sharded raw files with a visit index. Pre-training then reads the
+# blocks zero-copy with --volume_store_dir (dataset_mode='packed').
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+from custom_util.PatientDataset_inhouse import PatientDataset3D_inhouse
+from custom_util.volume_store import VolumeStoreWriter, load_visit_frames
+
+home_directory = os.getenv('HOME')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Pack OCT volumes into a memory-mapped volume store', add_help=False)
+    parser.add_argument('--data_path', default=home_directory + '/Ophthal/', type=str, help='dataset path')
+    parser.add_argument('--patient_id_list_dir', default='multi_label_expr_all_0319/', type=str, help='patient id list dir')
+    parser.add_argument('--metadata_dir', default='Oph_cls_task/', type=str, help='metadata dir')
+    parser.add_argument('--output_dir', required=True, type=str, help='output directory of the volume store')
+    parser.add_argument('--shard_size_gb', default=4, type=float, help='size of a shard file in GB')
+    parser.add_argument('--num_workers', default=8, type=int, help='number of decoding processes')
+    parser.add_argument('--no_downsample_width', action='store_false', dest='downsample_width', help='keep the original frame size')
+    return parser
+
+
+def load_visit(visit):
+    root_dir, visit_key, frame_paths, downsample_width = visit
+    return visit_key, load_visit_frames(root_dir, frame_paths, downsample_width=downsample_width)
+
+
+def main(args):
+    dataset = PatientDataset3D_inhouse(root_dir=args.data_path, task_mode='multi_label', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='frame', mode='gray', iterate_mode='visit', downsample_width=args.downsample_width, patient_id_list_dir=args.patient_id_list_dir, metadata_dir=args.metadata_dir)
+    visits = [(args.data_path, dataset.mapping_visit2patient[idx] + '_' + data_dict['visit_hash'], data_dict['frames'], args.downsample_width) for idx, data_dict in dataset.visits_dict.items()]
+    print('Packing %d visits to %s' % (len(visits), args.output_dir))
+
+    writer = VolumeStoreWriter(args.output_dir, shard_size_gb=args.shard_size_gb)
+    start_time = time.time()
+    with Pool(args.num_workers) as pool:
+        # imap keeps the visit order, so the store follows dataset.visits_dict
+        for i, (visit_key, volume) in enumerate(pool.imap(load_visit, visits, chunksize=4)):
+            writer.add(visit_key, volume)
+            if (i + 1) % 100 == 0:
+                print('%d/%d visits, %.1f visits/s' % (i + 1, len(visits), (i + 1) / (time.time() - start_time)))
+    writer.close()
+    print('Packed %d visits into %d shards' % (len(writer.visit_keys), writer.shard_idx + 1))
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
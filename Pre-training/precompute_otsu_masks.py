@@ -0,0 +1,93 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# Offline Otsu thresholding of the 2D pre-training frames: every in-house (and Kermany) frame is
+# loaded and transformed once as in main_pretrain_oph_joint_2d512_flash_attn.py, and its Otsu
+# threshold and bit-packed patch-level foreground mask are written to a memory-mapped store.
+# Pre-training then serves the masks from the store with --otsu_mask_dir.
+
+import argparse
+import os
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import torchvision.datasets as datasets
+import torchvision.transforms as transforms
+from PIL import Image
+
+from custom_util.otsu_mask_store import OtsuMaskStoreWriter, get_otsu_patch_mask
+from custom_util.PatientDataset_inhouse import PatientDatasetCenter2D_inhouse
+from custom_util.PatientDataset_pretrain import load_inhouse_frame
+
+home_directory = os.getenv('HOME')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Precompute the Otsu patch masks of the 2D pre-training frames', add_help=False)
+    parser.add_argument('--data_path', default=home_directory + '/Ophthal/', type=str, help='dataset path')
+    parser.add_argument('--patient_id_list_dir', default='multi_label_expr_all_0319/', type=str, help='patient id list dir')
+    parser.add_argument('--metadata_dir', default='Oph_cls_task/', type=str, help='metadata dir')
+    parser.add_argument('--kermany_data_dir', default=home_directory + '/ext_oph_datasets/Kermany/CellData/OCT/', type=str, help='Kermany dataset path, empty to skip it')
+    parser.add_argument('--output_dir', required=True, type=str, help='output directory, the stores are written to its inhouse/ and kermany/ subdirectories')
+    parser.add_argument('--high_res_input_size', default=512, type=int, help='2D input size of the pre-training')
+    parser.add_argument('--patch_size', default=16, type=int, help='patch size of the model')
+    parser.add_argument('--min_foreground', default=0.5, type=float, help='a patch is foreground if at least this fraction of its pixels are')
+    parser.add_argument('--num_workers', default=8, type=int, help='number of processes')
+    return parser
+
+
+def get_transform(input_size):
+    # transform_2d_train of the pre-training script, the thresholds are taken after it
+    return transforms.Compose([
+            transforms.Resize((input_size, input_size), interpolation=3),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            ])
+
+
+def compute_inhouse_mask(frame_path, root_dir, transform, patch_size, min_foreground):
+    frame = transform(load_inhouse_frame(root_dir, frame_path, mode='rgb', downsample_width=True))
+    return get_otsu_patch_mask(frame, patch_size=patch_size, min_foreground=min_foreground)
+
+
+def compute_kermany_mask(frame_path, root_dir, transform, patch_size, min_foreground):
+    # ImageFolder loads RGB frames
+    frame = transform(Image.open(os.path.join(root_dir, frame_path)).convert('RGB'))
+    return get_otsu_patch_mask(frame, patch_size=patch_size, min_foreground=min_foreground)
+
+
+def write_store(store_dir, frames, compute_mask, args):
+    grid_size = (args.high_res_input_size // args.patch_size,) * 2
+    writer = OtsuMaskStoreWriter(store_dir, frames, grid_size, patch_size=args.patch_size, min_foreground=args.min_foreground, input_size=args.high_res_input_size)
+    print('Thresholding %d frames to %s' % (len(frames), store_dir))
+    start_time = time.time()
+    with Pool(args.num_workers) as pool:
+        # imap keeps the frame order, so row i is frames[i]
+        for i, (threshold, patch_mask) in enumerate(pool.imap(compute_mask, frames, chunksize=64)):
+            writer.add(i, threshold, patch_mask)
+            if (i + 1) % 10000 == 0:
+                print('%d/%d frames, %.1f frames/s' % (i + 1, len(frames), (i + 1) / (time.time() - start_time)))
+    writer.close()
+
+
+def main(args):
+    transform = get_transform(args.high_res_input_size)
+
+    # all the frames of the in-house dataset, the pre-training keeps a subset of them
+    dataset = PatientDatasetCenter2D_inhouse(root_dir=args.data_path, task_mode='multi_label', disease='AMD', disease_name_list=None, metadata_fname=None, dataset_mode='frame', iterate_mode='visit', downsample_width=True, patient_id_list_dir=args.patient_id_list_dir, metadata_dir=args.metadata_dir)
+    frames = list(dict.fromkeys(frame for data_dict in dataset.visits_dict.values() for frame in data_dict['frames']))
+    compute_mask = partial(compute_inhouse_mask, root_dir=args.data_path, transform=transform, patch_size=args.patch_size, min_foreground=args.min_foreground)
+    write_store(os.path.join(args.output_dir, 'inhouse'), frames, compute_mask, args)
+
+    if args.kermany_data_dir:
+        kermany_root = os.path.join(args.kermany_data_dir, 'train')
+        frames = [os.path.relpath(path, kermany_root) for path, _ in datasets.ImageFolder(kermany_root).samples]
+        compute_mask = partial(compute_kermany_mask, root_dir=kermany_root, transform=transform, patch_size=args.patch_size, min_foreground=args.min_foreground)
+        write_store(os.path.join(args.output_dir, 'kermany'), frames, compute_mask, args)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
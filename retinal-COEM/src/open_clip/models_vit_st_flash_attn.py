@@ -27,7 +27,8 @@ import torch.nn as nn
 from .misc import master_print as print
 from einops import rearrange
 from collections import OrderedDict
-from .video_vit import Attention, Block, PatchEmbed
+from .video_vit import Attention, Block, PatchEmbed, LayerTaps
+from .pos_embed import PosEmbedCache, get_pos_embed_params
 from flash_attn.models.vit import create_block
 
 
@@ -66,6 +67,7 @@ class VisionTransformer(nn.Module):
         self.image_size = image_size
         self.global_pool = global_pool
         self.sep_pos_embed = sep_pos_embed
+        self.pos_embed_cache = PosEmbedCache()
         # --------------------------------------------------------------------------
         # MAE encoder specifics
         self.patch_embed = PatchEmbed(
@@ -164,7 +166,28 @@ class VisionTransformer(nn.Module):
             "pos_embed_class",
         }
 
-    def forward(self, x, hidden_states=False):
+    def build_sep_pos_embed(self):
+        """
+        return: [1, (1 +) T * H * W, C] pos embed of the separable spatial / temporal (/ class) pos embeds
+        """
+        pos_embed = self.pos_embed_spatial.repeat(
+            1, self.input_size[0], 1
+        ) + torch.repeat_interleave(
+            self.pos_embed_temporal,
+            self.input_size[1] * self.input_size[2],
+            dim=1,
+        )
+        if self.cls_embed:
+            pos_embed = torch.cat(
+                [
+                    self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
+                    pos_embed,
+                ],
+                1,
+            )
+        return pos_embed
+
+    def forward(self, x, hidden_states=False, return_layers=None, tap_fn=None):
         # embed patches
         print(x.shape)
         # exit()
@@ -180,21 +203,10 @@ class VisionTransformer(nn.Module):
             x = torch.cat((cls_tokens, x), dim=1)
 
         if self.sep_pos_embed:
-            pos_embed = self.pos_embed_spatial.repeat(
-                1, self.input_size[0], 1
-            ) + torch.repeat_interleave(
-                self.pos_embed_temporal,
-                self.input_size[1] * self.input_size[2],
-                dim=1,
+            # rebuilt only when the pos embed parameters change, see PosEmbedCache
+            pos_embed = self.pos_embed_cache.get(
+                tuple(self.input_size), get_pos_embed_params(self), self.build_sep_pos_embed
             )
-            if self.cls_embed:
-                pos_embed = torch.cat(
-                    [
-                        self.pos_embed_class.expand(pos_embed.shape[0], -1, -1),
-                        pos_embed,
-                    ],
-                    1,
-                )
         else:
             pos_embed = self.pos_embed[:, :, :]
         x = x + pos_embed
@@ -212,24 +224,28 @@ class VisionTransformer(nn.Module):
         if requires_t_shape:
             x = x.view([N, T, L, C])
 
-        # apply Transformer blocks
-        hidden_states_list = []
+        # apply Transformer blocks, only the outputs of the requested blocks are kept
+        if hidden_states:
+            return_layers = range(len(self.blocks))
+        taps = LayerTaps(return_layers, len(self.blocks), tap_fn) if return_layers is not None else None
         if self.use_flash_attn:
             residual = None
-            for blk in self.blocks:
+            for i, blk in enumerate(self.blocks):
                 x, residual = blk(x, residual)
-                hidden_states_list.append(x)
+                if taps is not None and taps(i, x):
+                    break
         else:
-            for blk in self.blocks:
+            for i, blk in enumerate(self.blocks):
                 x = blk(x)
-                hidden_states_list.append(x)
+                if taps is not None and taps(i, x):
+                    break
 
 
         if requires_t_shape:
             x = x.view([N, T * L, C])
 
-        if hidden_states:
-            return hidden_states_list
+        if taps is not None:
+            return taps.outputs
 
         if self.global_pool:
             x = x[:, 1:, :].mean(dim=1)  # global pool without cls token
@@ -82,4 +82,47 @@ def interpolate_temporal_pos_embed(model, checkpoint_model, smaller_interpolate_
             pos_tokens = pos_tokens.permute(0, 2, 1)
             new_pos_embed = pos_tokens
 
-            checkpoint_model["pos_embed_temporal"] = new_pos_embed
\ No newline at end of file
+            checkpoint_model["pos_embed_temporal"] = new_pos_embed
+
+
+# --------------------------------------------------------
+# Cache of the pos embeds built from separable spatial / temporal pos embeds
+# --------------------------------------------------------
+def get_pos_embed_params(module, prefix="pos_embed"):
+    """
+    return: the parameters of module (not of its children) whose name starts with prefix,
+    e.g., pos_embed_spatial, pos_embed_temporal and pos_embed_class
+    """
+    return [p for name, p in module.named_parameters(recurse=False) if name.startswith(prefix)]
+
+
+class PosEmbedCache:
+    def __init__(self):
+        """
+        Pos embeds built from parameters (repeat + repeat_interleave + cat, bicubic resize of the
+        spatial pos embed), kept between forwards. An entry is keyed on the layout of the pos
+        embed (e.g., (T, H, W, high_res)) and holds the storage and version counter of each
+        parameter: in-place updates (optimizer, EMA, load_state_dict) and .to() rebuild it.
+        """
+        self.entries = {}
+
+    def get(self, key, params, build_fn):
+        """
+        Args:
+            key (tuple): layout of the pos embed, e.g., (T, H, W, high_res)
+            params (list): parameters the pos embed is built from
+            build_fn (callable): () -> pos embed
+        return: pos embed, from the cache if the parameters did not change
+        """
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            # a cached graph would be backpropagated more than once, build it for every forward
+            return build_fn()
+        version = tuple((p.data_ptr(), p._version, p.dtype, p.device) for p in params)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            entry = (version, build_fn())
+            self.entries[key] = entry
+        return entry[1]
+
+    def clear(self):
+        self.entries = {}
@@ -173,3 +173,62 @@ class Block(nn.Module):
         x = x + self.drop_path(self.attn(self.norm1(x)))
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
+
+
+def make_layer_tap(pool=None, num_prefix_tokens=1, to_cpu=False, dtype=None):
+    """
+    Args:
+        pool (str): None keeps all the tokens, 'mean' averages the tokens after the num_prefix_tokens
+            prefix (cls) tokens, 'cls' keeps the first token
+        num_prefix_tokens (int): number of prefix tokens excluded from the 'mean' pooling
+        to_cpu (bool): detach and copy the tapped output to CPU
+        dtype (torch.dtype): cast the tapped output, e.g., torch.float16, None keeps the dtype
+    return: tap_fn for LayerTaps, applied to each tapped block output as soon as it is produced
+    """
+    if pool not in [None, 'mean', 'cls']:
+        raise ValueError(f"Unknown pool {pool}, expected None, 'mean' or 'cls'")
+
+    def tap_fn(x):
+        if pool is not None:
+            # [N, T, L, C] -> [N, T * L, C]
+            x = x.reshape(x.shape[0], -1, x.shape[-1])
+            x = x[:, num_prefix_tokens:, :].mean(dim=1) if pool == 'mean' else x[:, 0]
+        if to_cpu:
+            x = x.detach().to('cpu')
+        if dtype is not None:
+            x = x.to(dtype)
+        return x
+
+    return tap_fn
+
+
+class LayerTaps:
+    def __init__(self, return_layers, depth, tap_fn=None):
+        """
+        Outputs of selected Transformer blocks, the outputs of the other blocks are not referenced
+
+        Args:
+            return_layers (Sequence[int]): block indices, negative indices count from the last block
+            depth (int): number of blocks
+            tap_fn (callable): applied to each tapped output as it is produced (see make_layer_tap),
+                None keeps the block output
+        """
+        self.positions = {}
+        for position, layer in enumerate(return_layers):
+            layer = layer + depth if layer < 0 else layer
+            if not 0 <= layer < depth:
+                raise ValueError(f"return_layers {list(return_layers)} out of range for {depth} blocks")
+            self.positions.setdefault(layer, []).append(position)
+        self.last_layer = max(self.positions, default=-1)
+        self.tap_fn = tap_fn
+        self.outputs = [None] * len(return_layers)
+
+    def __call__(self, layer, x):
+        """
+        return: True once the last requested block is reached, the following blocks can be skipped
+        """
+        if layer in self.positions:
+            output = self.tap_fn(x) if self.tap_fn is not None else x
+            for position in self.positions[layer]:
+                self.outputs[position] = output
+        return layer >= self.last_layer
@@ -0,0 +1,161 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import SimpleITK as sitk
+from PIL import Image
+
+try:
+    # Try to import as if the script is part of a package
+    from training.dicom_reader import DicomFrameReader, read_dicom_pixel_array
+except ImportError:
+    # Fallback to a direct import if run as a standalone script
+    from dicom_reader import DicomFrameReader, read_dicom_pixel_array
+
+
+def resolve_file_path(parent_dir, path):
+    """
+    return: path of a dataset file as OphthalDataset opens it, parent_dir joined with the path without its leading slash
+    """
+    path = str(path)
+    if path.startswith('/'):
+        path = path[1:]
+    return os.path.join(parent_dir, path) if parent_dir else path
+
+
+def probe_dicom_file(path, decode=False):
+    reader = DicomFrameReader(path)
+    if decode:
+        return list(read_dicom_pixel_array(path).shape)
+    transfer_syntax = reader.ds.file_meta.TransferSyntaxUID
+    if not transfer_syntax.is_compressed:
+        # uncompressed pixel data must fit in the file: element header + T * H * W * samples * bytes
+        num_bytes = int(np.prod(reader.shape)) * reader.ds.get('SamplesPerPixel', 1) * max(reader.ds.BitsAllocated // 8, 1)
+        if reader.pixel_data_tell + num_bytes > os.path.getsize(path):
+            raise ValueError('truncated pixel data: %d bytes expected after offset %d' % (num_bytes, reader.pixel_data_tell))
+    return list(reader.shape) if reader.num_frames > 1 else list(reader.shape[1:])
+
+
+def probe_mhd_file(path, decode=False):
+    if decode:
+        return list(sitk.GetArrayFromImage(sitk.ReadImage(path)).shape)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    if reader.HasMetaDataKey('ElementDataFile'):
+        data_file = reader.GetMetaData('ElementDataFile')
+        if data_file not in ['LOCAL', 'LIST'] and '%' not in data_file:
+            data_path = os.path.join(os.path.dirname(path), data_file)
+            if not os.path.exists(data_path):
+                raise FileNotFoundError('missing mhd data file: %s' % data_path)
+    # SimpleITK sizes are (W, H, T), the arrays (T, H, W)
+    return list(reader.GetSize())[::-1]
+
+
+def probe_png_file(path, decode=False):
+    with Image.open(path) as image:
+        size = image.size
+        if decode:
+            image.load()
+        else:
+            # checks the chunk structure and CRCs without decoding the pixels
+            image.verify()
+    return [size[1], size[0]]
+
+
+def probe_image_file(path, decode=False):
+    """
+    Check that an OCT / IR / FAF file of OphthalDataset can be read, from its header where possible:
+    the header of dicom files (and the size of uncompressed pixel data), the header of mhd files
+    (and the presence of their data file), the chunks of png files.
+
+    Args:
+        path (str): path of the file
+        decode (bool): If True, decode the whole file as the dataset does instead
+    return: manifest record {'path', 'ok', 'shape', 'error'}
+    """
+    try:
+        if path.endswith('.dcm'):
+            shape = probe_dicom_file(path, decode=decode)
+        elif path.endswith('.mhd'):
+            shape = probe_mhd_file(path, decode=decode)
+        else:
+            shape = probe_png_file(path, decode=decode)
+        return {'path': path, 'ok': True, 'shape': shape, 'error': None}
+    except Exception as e:
+        return {'path': path, 'ok': False, 'shape': None, 'error': '%s: %s' % (type(e).__name__, e)}
+
+
+def scan_files(paths, num_workers=8, decode=False, chunksize=16, verbose_every=1000):
+    """
+    Probe the files in a process pool
+
+    Args:
+        paths (list): paths of the files
+        num_workers (int): number of processes, probe in the current process if <= 1
+        decode (bool): decode the files, see probe_image_file
+        chunksize (int): files per task of the pool
+        verbose_every (int): print the progress every verbose_every files, 0 to disable
+    return: manifest records in the order of paths
+    """
+    probe = partial(probe_image_file, decode=decode)
+    records = []
+    pool = Pool(num_workers) if num_workers > 1 else None
+    try:
+        iterator = pool.imap(probe, paths, chunksize=chunksize) if pool is not None else map(probe, paths)
+        for i, record in enumerate(iterator):
+            records.append(record)
+            if not record['ok']:
+                print('Failed:', record['path'], record['error'])
+            if verbose_every and (i + 1) % verbose_every == 0:
+                print('%d/%d files, %d failed' % (i + 1, len(paths), sum(not r['ok'] for r in records)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return records
+
+
+def write_file_manifest(manifest_fp, records, **meta):
+    manifest = {'meta': meta, 'num_files': len(records), 'num_failed': sum(not r['ok'] for r in records), 'records': records}
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_fp)), exist_ok=True)
+    with open(manifest_fp, 'w') as f:
+        json.dump(manifest, f)
+
+
+def load_file_manifest(manifest_fp):
+    """
+    return: {path: manifest record}
+    """
+    with open(manifest_fp) as f:
+        manifest = json.load(f)
+    return {record['path']: record for record in manifest['records']}
+
+
+def load_blocklist(manifest_fp):
+    """
+    return: set of the paths of a manifest (see validate_multimodal_files.py) that failed to read
+    """
+    return {path for path, record in load_file_manifest(manifest_fp).items() if not record['ok']}
+
+
+def validate_dataset_files(dataset, manifest_fp, num_workers=8, decode=False):
+    """
+    Scan all the files of an OphthalDataset and write their manifest, to be passed back as
+    OphthalDataset(..., blocklist_fp=manifest_fp)
+
+    return: manifest records
+    """
+    paths = dataset.get_all_file_paths()
+    records = scan_files(paths, num_workers=num_workers, decode=decode)
+    write_file_manifest(manifest_fp, records, parent_dir=dataset.parent_dir, mode=dataset.mode, decode=decode)
+    return records
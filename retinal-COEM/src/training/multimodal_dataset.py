@@ -30,9 +30,13 @@ from torch.utils.data._utils.collate import default_collate
 try:
     # Try to import as if the script is part of a package
     from training import dataset_management as dm
+    from training.dicom_reader import read_dicom_pixel_array
+    from training.file_manifest import load_blocklist, resolve_file_path
 except ImportError:
     # Fallback to a direct import if run as a standalone script
     import dataset_management as dm
+    from dicom_reader import read_dicom_pixel_array
+    from file_manifest import load_blocklist, resolve_file_path
 import SimpleITK as sitk
 from monai import transforms as monai_transforms
 
@@ -378,10 +382,39 @@ def filter_records_by_available_shape(df, key_name=['volume_dim_2', 'volume_dim_
 
 
 
-def convert_hw_shape(oct_volume, num_frames=60, input_size=384, verbose_level=0):
+def average_pairs(volume, axis):
+    """
+    Halve the size of axis by averaging neighbouring pairs in the dtype of the volume: integer
+    volumes are summed in a wider integer type and rounded (uint8 + uint8 would wrap around in numpy)
+    """
+    first = np.take(volume, np.arange(0, volume.shape[axis] - 1, 2), axis=axis)
+    second = np.take(volume, np.arange(1, volume.shape[axis], 2), axis=axis)
+    if np.issubdtype(volume.dtype, np.integer):
+        wide_dtype = np.uint16 if volume.dtype == np.uint8 else np.int64
+        return ((first.astype(wide_dtype) + second + 1) // 2).astype(volume.dtype)
+    return (first + second) / 2
+
+
+def normalize_oct_volume(oct_volume, verbose_level=0):
+    """
+    Min-max normalize a raw [h, d, w] OCT volume to float32 [0, 1], after convert_hw_shape: the
+    downsampling and padding run in the raw dtype (uint8), the float32 volume is only
+    allocated at the converted shape
+    """
+    min_value, max_value = oct_volume.min(), oct_volume.max()
+    # padded with the minimum, i.e., 0 after the normalization
+    oct_volume = convert_hw_shape(oct_volume, verbose_level=verbose_level, pad_value=min_value)
+    oct_volume = oct_volume.astype(np.float32)
+    oct_volume -= np.float32(min_value)
+    oct_volume /= np.float32(max_value) - np.float32(min_value)
+    return oct_volume
+
+
+def convert_hw_shape(oct_volume, num_frames=60, input_size=384, verbose_level=0, pad_value=0):
     """
     Available shapes:
     [(49, 496, 512), (121, 496, 768), (49, 496, 1024), (25, 496, 512), (61, 496, 768), (121, 496, 1536), (97, 496, 512)]
+    The dtype of oct_volume is preserved, pad_value fills the padded frames and columns
     """
     transform = monai_transforms.Compose([
         monai_transforms.CropForegroundd(keys=["pixel_values"], source_key="pixel_values"),
@@ -394,7 +427,7 @@ def convert_hw_shape(oct_volume, num_frames=60, input_size=384, verbose_level=0)
 
     if w == 1536 or w == 1024:
         # interpolate to 768
-        oct_volume = (oct_volume[:, :, ::2] + oct_volume[:, :, 1::2]) / 2
+        oct_volume = average_pairs(oct_volume, axis=2)
     if h == 61 or h == 49 or h == 25 or h == 121 or h == 97:
         # with random probability, drop one frame
         if np.random.rand() > 0.5:
@@ -405,13 +438,13 @@ def convert_hw_shape(oct_volume, num_frames=60, input_size=384, verbose_level=0)
     if h == 193:
         # first add to 194, then interpolate to 97
         oct_volume = oct_volume[:-1]
-        oct_volume = (oct_volume[::2, :, :] + oct_volume[1::2, :, :]) / 2
+        oct_volume = average_pairs(oct_volume, axis=0)
 
     if h == 121 or h == 97 or h == 193:
-        oct_volume = (oct_volume[::2, :, :] + oct_volume[1::2, :, :]) / 2
+        oct_volume = average_pairs(oct_volume, axis=0)
     if h == 25:
         # pad both sides 3 to 30
-        oct_volume = np.pad(oct_volume, ((3, 3), (0, 0), (0, 0)), mode='constant', constant_values=0)
+        oct_volume = np.pad(oct_volume, ((3, 3), (0, 0), (0, 0)), mode='constant', constant_values=pad_value)
         if verbose_level > 0:
             print('25 Padded shape:', oct_volume.shape)
     if h == 19:
@@ -421,21 +454,19 @@ def convert_hw_shape(oct_volume, num_frames=60, input_size=384, verbose_level=0)
             pad = (6, 5) # Always pad 6 on the right side
 
         # pad both sides 5 and 6 to 30
-        oct_volume = np.pad(oct_volume, (pad, (0, 0), (0, 0)), mode='constant', constant_values=0)
+        oct_volume = np.pad(oct_volume, (pad, (0, 0), (0, 0)), mode='constant', constant_values=pad_value)
         if verbose_level > 0:
             print('19 Padded shape:', oct_volume.shape)
 
 
     if h == 49 or h == 97 or h == 48:
         # pad both sides 6 to 60
-        oct_volume = np.pad(oct_volume, ((6, 6), (0, 0), (0, 0)), mode='constant', constant_values=0)
+        oct_volume = np.pad(oct_volume, ((6, 6), (0, 0), (0, 0)), mode='constant', constant_values=pad_value)
 
 
-    if oct_volume.dtype == np.uint8:
-        oct_volume = oct_volume.astype(np.float32)
     if w == 512 or w == 1024:
         # pad to 768
-        oct_volume = np.pad(oct_volume, ((0, 0), (0, 0), (128, 128)), mode='constant', constant_values=0)
+        oct_volume = np.pad(oct_volume, ((0, 0), (0, 0), (128, 128)), mode='constant', constant_values=pad_value)
 
     return oct_volume
 
@@ -675,13 +706,17 @@ class OphthalDataset(Dataset):
     }
 
     def __init__(self, dataset, parent_dir, mode=6, oct_transform=None, enface_transform=None, pair_ir_key='paired_ir_file_path', return_path=False, oct_res_key=None, oct_fp_key='file_path',
-        process_BscansMeta=False, process_patch=False, faf_anonymized_fp=None, faf_anonymized_all_fp=None, dup_oct_3_channels=False, verbose_level=0):
+        process_BscansMeta=False, process_patch=False, faf_anonymized_fp=None, faf_anonymized_all_fp=None, dup_oct_3_channels=False, verbose_level=0, dicom_decode_threads=4,
+        blocklist_fp=None, max_read_retries=10):
         """
         Args:
             dataset (object): The preprocessed dataset object (e.g., chroma_dataset).
             parent_dir (str): The directory where the images are stored.
             mode (int): Index for the mode to filter images.
             transform (callable, optional): Optional transform to be applied on a sample.
+            dicom_decode_threads (int): threads decoding the frames of a compressed dicom volume, per DataLoader worker.
+            blocklist_fp (str, optional): manifest of validate_multimodal_files.py, the samples with a failed file are removed at init.
+            max_read_retries (int): neighbouring samples tried when a sample fails to read before raising.
         """
         self.dataset = dataset
         self.data = None
@@ -693,6 +728,11 @@ class OphthalDataset(Dataset):
         self.oct_fp_key = oct_fp_key
         self.process_BscansMeta = process_BscansMeta
         self.verbose_level = verbose_level
+        self.dicom_decode_threads = dicom_decode_threads
+        self.blocklist_fp = blocklist_fp
+        self.max_read_retries = max_read_retries
+        # indices that failed to read in this process (DataLoader worker), skipped afterwards
+        self.failed_indices = set()
 
         self.process_patch = process_patch
 
@@ -744,6 +784,8 @@ class OphthalDataset(Dataset):
         self.modalities = []
         if mode != -1:
             self.set_mode(mode)
+            if blocklist_fp:
+                self.exclude_blocked_files(load_blocklist(blocklist_fp))
 
 
 
@@ -943,6 +985,83 @@ class OphthalDataset(Dataset):
         else:
             raise ValueError("Invalid mode. Choose from the configured modes.")
 
+    def get_sample_file_paths(self, idx):
+        """
+        Get the resolved paths of the files of a sample.
+
+        Args:
+            idx (int): Sample index.
+
+        Returns:
+            dict: 'oct' (the image in single-modality modes) and 'ir' paths, None if missing,
+                'faf' and 'faf_all' lists of the candidate FAF paths.
+        """
+        fname = self.all_img_paths[idx]
+        faf_fps, faf_all_fps = [], []
+        if isinstance(fname, tuple):
+            oct_fp, ir_fp = fname[0], fname[1]
+            if len(fname) == 3 and fname[2]:
+                faf_fps = [fname[2]]
+            elif self.faf_anonymized_fp and getattr(self, 'paired_faf_img_paths', None):
+                faf_fps = self.paired_faf_img_paths[idx]
+                if self.faf_anonymized_all_fp and getattr(self, 'paired_faf_img_paths_all', None):
+                    faf_all_fps = [faf_fp for faf_fp, _ in self.paired_faf_img_paths_all[idx]]
+        else:
+            oct_fp, ir_fp = fname, None
+        return {
+            'oct': resolve_file_path(self.parent_dir, oct_fp),
+            'ir': resolve_file_path(self.parent_dir, ir_fp) if ir_fp and str(ir_fp) != 'nan' else None,
+            'faf': [resolve_file_path(self.parent_dir, faf_fp) for faf_fp in faf_fps],
+            'faf_all': [resolve_file_path(self.parent_dir, faf_fp) for faf_fp in faf_all_fps],
+        }
+
+    def get_all_file_paths(self):
+        """
+        Get the resolved paths of all the files the dataset may read, see file_manifest.validate_dataset_files.
+
+        Returns:
+            list: Unique file paths.
+        """
+        paths = []
+        for idx in range(len(self.all_img_paths)):
+            sample_paths = self.get_sample_file_paths(idx)
+            paths += [path for path in [sample_paths['oct'], sample_paths['ir']] if path]
+            paths += sample_paths['faf'] + sample_paths['faf_all']
+        return list(dict.fromkeys(paths))
+
+    def exclude_blocked_files(self, blocked_paths):
+        """
+        Remove the samples whose OCT or IR file is blocked, or whose FAF candidates are all blocked;
+        the blocked FAF candidates of the other samples are dropped. The per-sample lists are kept aligned.
+
+        Args:
+            blocked_paths (set): Resolved paths of the files that failed to read.
+        """
+        num_samples = len(self.all_img_paths)
+        paired_faf_img_paths = getattr(self, 'paired_faf_img_paths', None) if self.faf_anonymized_fp else None
+        paired_faf_img_paths_all = getattr(self, 'paired_faf_img_paths_all', None) if self.faf_anonymized_all_fp else None
+        keep_indices = []
+        for idx in range(num_samples):
+            sample_paths = self.get_sample_file_paths(idx)
+            if sample_paths['oct'] in blocked_paths or sample_paths['ir'] in blocked_paths:
+                continue
+            if sample_paths['faf'] and all(path in blocked_paths for path in sample_paths['faf']):
+                continue
+            if paired_faf_img_paths:
+                paired_faf_img_paths[idx] = [faf_fp for faf_fp in paired_faf_img_paths[idx] if resolve_file_path(self.parent_dir, faf_fp) not in blocked_paths]
+            if paired_faf_img_paths_all:
+                paired_faf_img_paths_all[idx] = [(faf_fp, field) for faf_fp, field in paired_faf_img_paths_all[idx] if resolve_file_path(self.parent_dir, faf_fp) not in blocked_paths]
+            keep_indices.append(idx)
+
+        aligned_keys = ['all_img_paths', 'modalities', 'paired_faf_img_paths', 'paired_faf_img_paths_all', 'faf_modalities']
+        if self.process_BscansMeta and self.mode_idx > 6:
+            aligned_keys.append('BscansMeta_dfs')
+        for key in aligned_keys:
+            values = getattr(self, key, None)
+            if isinstance(values, list) and len(values) == num_samples:
+                setattr(self, key, [values[idx] for idx in keep_indices])
+        print('Blocklist:', len(blocked_paths), 'blocked files, samples before:', num_samples, 'after:', len(keep_indices))
+
     def load_all_modality_image(self, img_path):
         h = None
         d = None
@@ -954,24 +1073,22 @@ class OphthalDataset(Dataset):
                 image = Image.fromarray(image).convert('RGB')
                 d, w = image.size
             elif len(image.shape) == 3: # 3D OCT volume
-                image = (image - image.min()) / (image.max() - image.min())
-
                 h, d, w = image.shape[0], image.shape[1], image.shape[2]
-                image = convert_hw_shape(image, verbose_level=self.verbose_level)
+                image = normalize_oct_volume(image, verbose_level=self.verbose_level)
 
                 image = np.expand_dims(image, axis=0)
 
         elif str(img_path).endswith('.mhd'):
             image, spacing, size, origin = load_mhd_image(img_path)
 
-            image = np.array(image).astype(np.float32)
+            image = np.asarray(image)
             if len(image.shape) == 3: # 3D OCT volume
-                image = (image - image.min()) / (image.max() - image.min())
-
                 h, d, w = image.shape[0], image.shape[1], image.shape[2]
-                image = convert_hw_shape(image, verbose_level=self.verbose_level)
+                image = normalize_oct_volume(image, verbose_level=self.verbose_level)
 
                 image = np.expand_dims(image, axis=0)
+            else:
+                image = image.astype(np.float32)
 
         else: # png files, probably IR or FAF image
             image = Image.open(img_path).convert('RGB')
@@ -1045,9 +1162,7 @@ class OphthalDataset(Dataset):
         Returns:
             np.array: Pixel data from the dicom file.
         """
-        dcm = pydicom.dcmread(path)
-
-        return dcm.pixel_array
+        return read_dicom_pixel_array(path, num_threads=self.dicom_decode_threads)
 
     def update_dataset_transform(self, oct_transform=None, enface_transform=None):
 
@@ -1070,6 +1185,27 @@ class OphthalDataset(Dataset):
             return parse_stringed_fname(fname)
 
     def __getitem__(self, idx, return_modality=False):
+        # A sample failing to read falls back to the previous samples (the next ones for idx 0), the
+        # failed indices are skipped afterwards. Corrupt files are best blocked at init with blocklist_fp.
+        num_samples = len(self.all_img_paths)
+        step = -1 if idx > 0 else 1
+        num_failed = 0
+        for _ in range(num_samples):
+            if idx not in self.failed_indices:
+                sample = self.load_sample(idx, return_modality=return_modality)
+                if sample is not None:
+                    return sample
+                self.failed_indices.add(idx)
+                num_failed += 1
+                if num_failed > self.max_read_retries:
+                    break
+            idx = (idx + step) % num_samples
+        raise RuntimeError(f"{num_failed} samples failed to read, validate the files with validate_multimodal_files.py")
+
+    def load_sample(self, idx, return_modality=False):
+        """
+        Load a sample, None if one of its files fails to read.
+        """
         # FIXME: For this multi-modal datset, I currently de facto removed the single modality support
 
         fname = self.all_img_paths[idx]
@@ -1146,8 +1282,7 @@ class OphthalDataset(Dataset):
             except Exception as e:
                 print(f"Error reading image: {oct_img_path}, {h, d, w}")
                 print(e)
-                idx = idx - 1 if idx > 0 else idx + 1
-                return self.__getitem__(idx)
+                return None
 
 
             if self.oct_transform:
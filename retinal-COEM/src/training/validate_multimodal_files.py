@@ -0,0 +1,69 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Offline validation of the OCT / IR / FAF files of the multi-modal datasets: the file paths of
+# the dataset csvs (e.g., the OCT metadata csv and the FAF anonymized csvs) are probed in a process
+# pool, reading headers only unless --decode, and their shapes and read errors are written to a
+# json manifest. OphthalDataset(..., blocklist_fp=<manifest>) then drops the samples with a
+# failed file at init, so corrupt files never reach the training loop.
+
+import argparse
+import os
+import time
+
+import pandas as pd
+
+try:
+    # Try to import as if the script is part of a package
+    from training.file_manifest import resolve_file_path, scan_files, write_file_manifest
+except ImportError:
+    # Fallback to a direct import if run as a standalone script
+    from file_manifest import resolve_file_path, scan_files, write_file_manifest
+
+home_directory = os.getenv('HOME')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Validate the OCT / IR / FAF files of the multi-modal datasets', add_help=False)
+    parser.add_argument('--csv_files', nargs='+', required=True, type=str, help='dataset csvs listing the files')
+    parser.add_argument('--path_keys', nargs='+', default=['file_path', 'paired_ir_file_path', 'oct_file_path', 'ir_file_path', 'faf_file_path'], type=str,
+        help='columns holding file paths, the columns missing from a csv are skipped')
+    parser.add_argument('--parent_dir', default='', type=str, help='parent_dir of OphthalDataset, the paths are resolved against it')
+    parser.add_argument('--output_fp', required=True, type=str, help='output manifest json')
+    parser.add_argument('--decode', action='store_true', help='decode the whole files instead of reading their headers')
+    parser.add_argument('--num_workers', default=8, type=int, help='number of processes')
+    return parser
+
+
+def get_csv_file_paths(csv_fp, path_keys, parent_dir):
+    df = pd.read_csv(csv_fp)
+    paths = []
+    for key in path_keys:
+        if key in df.columns:
+            paths += [resolve_file_path(parent_dir, path) for path in df[key].dropna()]
+    return paths
+
+
+def main(args):
+    paths = []
+    for csv_fp in args.csv_files:
+        csv_paths = get_csv_file_paths(csv_fp, args.path_keys, args.parent_dir)
+        print('%s: %d files' % (csv_fp, len(csv_paths)))
+        paths += csv_paths
+    paths = list(dict.fromkeys(paths))
+    print('Validating %d files' % len(paths))
+
+    start_time = time.time()
+    records = scan_files(paths, num_workers=args.num_workers, decode=args.decode)
+    write_file_manifest(args.output_fp, records, parent_dir=args.parent_dir, csv_files=args.csv_files, decode=args.decode)
+    print('%d/%d files failed, %.1f files/s, manifest written to %s' % (sum(not r['ok'] for r in records), len(records), len(records) / max(time.time() - start_time, 1e-6), args.output_fp))
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
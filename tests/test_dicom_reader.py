@@ -0,0 +1,40 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Frame decoding pool of OCTCube util.dicom_reader and retinal-COEM training.dicom_reader. Run from the repository root: python -m pytest tests
+
+import importlib
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_dicom_reader(tree, module):
+    sys.path.insert(0, os.path.join(REPO_DIR, tree))
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.path.pop(0)
+
+
+@pytest.mark.parametrize("tree, module", [("OCTCube", "util.dicom_reader"), ("retinal-COEM/src", "training.dicom_reader")])
+def test_decode_pool_replaced_on_thread_count(tree, module):
+    dicom_reader = import_dicom_reader(tree, module)
+    pool = dicom_reader.get_decode_pool(2)
+    assert dicom_reader.get_decode_pool(2) is pool
+    assert pool.submit(sum, [1, 2]).result() == 3
+
+    new_pool = dicom_reader.get_decode_pool(3)
+    assert new_pool is not pool
+    # the previous pool is shut down instead of leaking its threads
+    with pytest.raises(RuntimeError):
+        pool.submit(sum, [1, 2])
+    assert new_pool.submit(sum, [1, 2]).result() == 3
+    new_pool.shutdown()
+    dicom_reader.decode_pool = dicom_reader.decode_pool_key = None
@@ -0,0 +1,69 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Loading flash-attn checkpoints (mixer.Wqkv / mixer.out_proj) into the sdpa blocks of the OCTCube
+# 3D ViT through the load_state_dict pre-hook of util.video_vit. Run from the repository root: python -m pytest tests
+
+import importlib
+import os
+import re
+import sys
+
+import pytest
+import torch
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_KWARGS = dict(num_frames=6, t_patch_size=3, img_size=32, num_classes=2, global_pool=True, sep_pos_embed=True, cls_embed=True, attn_backend='sdpa', patch_size=16, embed_dim=64, depth=2, num_heads=4)
+
+
+def import_octcube(module):
+    sys.path.insert(0, os.path.join(REPO_DIR, 'OCTCube'))
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.path.pop(0)
+
+
+def to_flash_state_dict(state_dict):
+    # attn.q / k / v / proj -> mixer.Wqkv / out_proj, as saved by the flash-attn blocks
+    flash_state_dict = {}
+    for k, v in state_dict.items():
+        m = re.match(r"(blocks\.\d+)\.attn\.q\.(weight|bias)$", k)
+        if m:
+            flash_state_dict[f"{m.group(1)}.mixer.Wqkv.{m.group(2)}"] = torch.cat([v, state_dict[k.replace('.q.', '.k.')], state_dict[k.replace('.q.', '.v.')]])
+        elif not re.match(r"blocks\.\d+\.attn\.[kv]\.", k):
+            flash_state_dict[k.replace('.attn.proj.', '.mixer.out_proj.')] = v
+    return flash_state_dict
+
+
+@pytest.fixture(scope='module')
+def models():
+    return import_octcube('models_vit_st_flash_attn')
+
+
+@pytest.mark.parametrize("use_flash_attn", [False, True])
+@pytest.mark.parametrize("fused_qkv", [False, True])
+def test_load_flash_checkpoint(models, use_flash_attn, fused_qkv):
+    video_vit = import_octcube('util.video_vit')
+    torch.manual_seed(0)
+    src = models.VisionTransformer(use_flash_attn=use_flash_attn, **MODEL_KWARGS).eval()
+    torch.manual_seed(1)
+    dst = models.VisionTransformer(use_flash_attn=use_flash_attn, fused_qkv=fused_qkv, **MODEL_KWARGS).eval()
+    # flash-attn block structure with the sdpa kernel, or the plain blocks
+    assert type(dst.blocks[0]) is (video_vit.PrenormBlock if use_flash_attn else video_vit.Block)
+
+    video_vit.check_attention_keys_loaded(dst.load_state_dict(to_flash_state_dict(src.state_dict()), strict=True))
+    x = torch.randn(1, 1, 6, 32, 32)
+    with torch.no_grad():
+        torch.testing.assert_close(dst(x), src(x))
+
+
+def test_missing_attention_keys(models):
+    video_vit = import_octcube('util.video_vit')
+    model = models.VisionTransformer(**MODEL_KWARGS)
+    state_dict = {k: v for k, v in model.state_dict().items() if '.attn.' not in k}
+    with pytest.raises(AssertionError):
+        video_vit.check_attention_keys_loaded(model.load_state_dict(state_dict, strict=False))
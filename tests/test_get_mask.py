@@ -0,0 +1,94 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Equivalence of the batched get_mask (OCTCube util.misc, Pre-training custom_util.misc) with the
+# per-sample, per-frame reference it replaced. Run from the repository root: python -m pytest tests
+
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_misc(tree, module):
+    sys.path.insert(0, os.path.join(REPO_DIR, tree))
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.path.pop(0)
+
+
+# number of patches left masked from the max unmask ratio over the frames, which differs between the trees
+TO_MASK_NUMBER = {
+    'OCTCube': lambda pos_hw, max_unmask_ratio: min(pos_hw - int(pos_hw * max_unmask_ratio), pos_hw // 2),
+    'Pre-training': lambda pos_hw, max_unmask_ratio: max(int(pos_hw * max_unmask_ratio), pos_hw // 2),
+}
+
+
+def get_mask_reference(misc, to_mask_number, x, high_res=False, high_res_input_size=(20, 32, 32), input_size=(20, 16, 16), p_emb_mask_ratio=0.6):
+    # full [T * L, T * L] similarity, diagonal blocks sliced per frame, topk and masks per sample and frame
+    x_norm = F.normalize(x.float(), p=2, dim=2)
+    cosine_similarity = torch.matmul(x_norm, x_norm.transpose(1, 2))
+    actual_hwt = cosine_similarity.shape[1]
+    if high_res:
+        pos_hw = high_res_input_size[1] * high_res_input_size[2]
+        h = int(high_res_input_size[1])
+    else:
+        pos_hw = input_size[1] * input_size[2]
+        h = int(input_size[1])
+    num_frames = actual_hwt // pos_hw
+    diag_cosine_similarity_list = [torch.stack([cosine_similarity[n, i*pos_hw:(i+1)*pos_hw, i*pos_hw:(i+1)*pos_hw] for i in range(num_frames)]) for n in range(cosine_similarity.shape[0])]
+
+    fill_gap = 5 if high_res else 2
+    up_down_clear = 6 if high_res else 3
+    fill_bottom_center = not high_res
+    s_size = int(pos_hw ** 0.5)
+    top_k = int(pos_hw * p_emb_mask_ratio)
+    batched_filled_mask_list = []
+    for b in range(cosine_similarity.shape[0]):
+        unmask_ratio = np.zeros(num_frames)
+        adjusted_mask_list = np.zeros((num_frames, s_size, s_size))
+        for n in range(num_frames):
+            sum_cosine_similarity = diag_cosine_similarity_list[b][n].sum(dim=1) / pos_hw
+            _, indices = torch.topk(sum_cosine_similarity, top_k)
+            patched_imgs = torch.zeros(s_size, s_size)
+            patched_imgs[indices // s_size, indices % s_size] = 1
+            adjusted_mask, _ = misc.process_and_adjust_mask(patched_imgs, pos_idx=h, fill_gap=fill_gap, up_down_clear=up_down_clear, fill_bottom_center=fill_bottom_center)
+            unmask_ratio[n] = 1 - np.sum(adjusted_mask) / pos_hw
+            adjusted_mask_list[n] = adjusted_mask
+
+        actual_to_mask_number = to_mask_number(pos_hw, np.max(unmask_ratio))
+        filled_mask_list = torch.zeros(num_frames, s_size, s_size)
+        for n in range(num_frames):
+            filled_mask_list[n] = torch.tensor(misc.fill_patch_mask_to_ratio(adjusted_mask_list[n], to_mask_number=actual_to_mask_number))
+        batched_filled_mask_list.append(filled_mask_list)
+    return batched_filled_mask_list
+
+
+@pytest.mark.parametrize("tree, module", [("OCTCube", "util.misc"), ("Pre-training", "custom_util.misc")])
+@pytest.mark.parametrize("high_res", [False, True])
+def test_get_mask_matches_per_frame_reference(tree, module, high_res):
+    misc = import_misc(tree, module)
+    torch.manual_seed(0)
+    grid = 32 if high_res else 16
+    num_frames, dim = 3, 24
+    # smooth embeddings along the rows, as the retina band of the patch embeddings, so the masks are not trivial
+    x = torch.randn(2, num_frames, grid, 1, dim).cumsum(dim=2).expand(-1, -1, -1, grid, -1)
+    x = (x + 0.1 * torch.randn_like(x)).reshape(2, num_frames * grid * grid, dim)
+    kwargs = dict(high_res=high_res, high_res_input_size=(num_frames, 32, 32), input_size=(num_frames, 16, 16))
+
+    masks = misc.get_mask(x, img_type='3D', **kwargs)
+    reference = get_mask_reference(misc, TO_MASK_NUMBER[tree], x, **kwargs)
+
+    assert masks.shape == (2, num_frames, grid, grid)
+    assert torch.equal(masks, torch.stack(reference))
+    assert all(torch.equal(m, r) for m, r in zip(misc.get_mask(x, img_type='3D', return_tensor=False, **kwargs), reference))
@@ -0,0 +1,67 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# DirectoryManifest cache (OCTCube util.manifest_cache, Pre-training custom_util.manifest_cache).
+# Run from the repository root: python -m pytest tests
+
+import importlib
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TREES = [("OCTCube", "util.manifest_cache"), ("Pre-training", "custom_util.manifest_cache")]
+
+
+def import_manifest_cache(tree, module):
+    sys.path.insert(0, os.path.join(REPO_DIR, tree))
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.path.pop(0)
+
+
+def make_dataset(root_dir):
+    for cls_dir, names in [('AMD', ['p0_0.png', 'p0_1.png']), ('DME', ['p1_0.png'])]:
+        os.makedirs(os.path.join(root_dir, cls_dir))
+        for name in names:
+            open(os.path.join(root_dir, cls_dir, name), 'w').close()
+
+
+@pytest.mark.parametrize("tree, module", TREES)
+def test_manifest_cache_in_cache_dir(tree, module, tmp_path):
+    manifest_cache = import_manifest_cache(tree, module)
+    root_dir = str(tmp_path / 'data' / 'OCT')
+    make_dataset(root_dir)
+    cache_dir = str(tmp_path / 'output')
+
+    assert manifest_cache.get_manifest_path(root_dir, False) is None
+    assert manifest_cache.get_manifest_path(root_dir, True) == root_dir + '.manifest.npz'
+    cache_path = manifest_cache.get_manifest_path(root_dir, cache_dir)
+    assert os.path.dirname(cache_path) == cache_dir
+
+    manifest = manifest_cache.DirectoryManifest(root_dir, cache_path=cache_path)
+    assert manifest.num_rescanned == 2 and os.path.exists(cache_path)
+    assert not os.path.exists(root_dir + '.manifest.npz')
+
+    cached = manifest_cache.DirectoryManifest(root_dir, cache_path=cache_path)
+    assert cached.num_rescanned == 0
+    assert sorted(cached.listdir('AMD')) == ['p0_0.png', 'p0_1.png'] and cached.listdir('DME') == ['p1_0.png']
+
+
+@pytest.mark.parametrize("tree, module", TREES)
+def test_manifest_cache_write_failure(tree, module, tmp_path):
+    manifest_cache = import_manifest_cache(tree, module)
+    root_dir = str(tmp_path / 'OCT')
+    make_dataset(root_dir)
+    # a file where the cache dir should be: the cache cannot be written, the listing still is
+    open(tmp_path / 'output', 'w').close()
+    cache_path = manifest_cache.get_manifest_path(root_dir, str(tmp_path / 'output'))
+
+    manifest = manifest_cache.DirectoryManifest(root_dir, cache_path=cache_path)
+    assert sorted(manifest.listdir('AMD')) == ['p0_0.png', 'p0_1.png']
+    assert sorted(os.listdir(tmp_path)) == ['OCT', 'output']
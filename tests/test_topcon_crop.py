@@ -0,0 +1,58 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Pixel clipping and row cropping of the AI-READI Topcon volumes (OCTCube util.topcon_crop).
+# Run from the repository root: python -m pytest tests
+
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_topcon_crop():
+    sys.path.insert(0, os.path.join(REPO_DIR, 'OCTCube'))
+    try:
+        return importlib.import_module('util.topcon_crop')
+    finally:
+        sys.path.pop(0)
+
+
+def make_crop_params(min_pixel_val, max_pixel_value=200):
+    return {'crop_start_col': 2, 'crop_end_col': 6, 'first_row_not_all_zero': 2, 'last_row_not_all_zero': 5, 'actual_gap': 4, 'min_pixel_val': min_pixel_val, 'max_pixel_value': max_pixel_value}
+
+
+@pytest.mark.parametrize("min_pixel_val", [0, 3, 9])
+def test_maestro2_min_pixel_below_offset(min_pixel_val):
+    topcon_crop = import_topcon_crop()
+    # uint8 dicom pixels with a minimum below the Maestro2 offset of 10
+    volume = np.random.RandomState(0).randint(0, 256, size=(3, 8, 5)).astype(np.uint8)
+    volume[0, 3, 0] = 0
+
+    cropped = topcon_crop.apply_topcon_crop_params(volume.copy(), make_crop_params(min_pixel_val), 'Maestro2')
+
+    expected = volume[:, 2:6].copy()
+    expected[expected < min_pixel_val] = 0
+    expected[expected > 200] = 200
+    assert cropped.dtype == np.uint8
+    np.testing.assert_array_equal(cropped, expected)
+
+
+@pytest.mark.parametrize("manufacturers_model_name, clamp_value", [("Maestro2", 20), ("Triton", 30)])
+def test_min_pixel_offset(manufacturers_model_name, clamp_value):
+    topcon_crop = import_topcon_crop()
+    volume = np.full((2, 8, 4), 100, dtype=np.uint8)
+    volume[:, 3, 1] = 5
+    volume[:, 4, 2] = 250
+
+    cropped = topcon_crop.apply_topcon_crop_params(volume, make_crop_params(30), manufacturers_model_name)
+
+    assert cropped.shape == (2, 4, 4)
+    assert (cropped[:, 1, 1] == clamp_value).all() and (cropped[:, 2, 2] == 200).all()
@@ -0,0 +1,48 @@
+# Copyright (c) Zixuan Liu et al, OCTCubeM group
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Patient iterate mode of set_visit_index (OCTCube util.visit_index, Pre-training custom_util.visit_index)
+# for both layouts of the patients dict. Run from the repository root: python -m pytest tests
+
+import importlib
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_visit_index(tree, module):
+    sys.path.insert(0, os.path.join(REPO_DIR, tree))
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.path.pop(0)
+
+
+@pytest.mark.parametrize("tree, module", [("OCTCube", "util.visit_index"), ("Pre-training", "custom_util.visit_index")])
+@pytest.mark.parametrize("per_visit_frames", [False, True])
+def test_patient_mode_sample(tree, module, per_visit_frames):
+    visit_index = import_visit_index(tree, module)
+    if per_visit_frames:
+        # one frame list per visit, not indexable as rows
+        patients = {
+            'p0': {'frames': [['p0/v0/0.png', 'p0/v0/1.png'], ['p0/v1/0.png']], 'class_idx': [0, 0]},
+            'p1': {'frames': [['p1/v0/0.png']], 'class_idx': [1]},
+        }
+    else:
+        patients = {
+            'p0': {'frames': ['p0/0.png', 'p0/1.png'], 'class_idx': 0},
+            'p1': {'frames': ['p1/0.png'], 'class_idx': 1},
+        }
+    dataset = SimpleNamespace(iterate_mode='patient', patients=dict(patients))
+    visit_index.set_visit_index(dataset)
+
+    assert (dataset.visit_index is None) == per_visit_frames
+    for idx, patient_id in enumerate(patients):
+        assert visit_index.get_patient_sample(dataset, idx) == (patient_id, patients[patient_id])